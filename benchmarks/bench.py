@@ -0,0 +1,243 @@
+"""Throughput benchmarks against the in-process S3 emulator (or any S3 compatible endpoint)
+
+    python -m benchmarks.bench
+    python -m benchmarks.bench --scenarios tiny_upload,noop_sync --latency 0.01 --fault-rate 0.01
+    python -m benchmarks.bench --endpoint http://localhost:9000   # minio or similar
+    python -m benchmarks.bench --history
+
+Every run is appended to benchmarks/results.jsonl together with the s3shutil version and git revision,
+and compared with the previous run that used the same parameters.
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import re
+import secrets
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+from unittests.s3emulator import S3Emulator
+
+log = logging.getLogger('bench')
+
+DEFAULT_RESULTS = os.path.join(HERE, 'results.jsonl')
+MB = 1024 * 1024
+
+
+def s3shutil_version():
+    with open(os.path.join(ROOT, 'setup.py')) as f:
+        m = re.search(r"version='([^']+)'", f.read())
+    return m.group(1) if m else 'unknown'
+
+
+def git_revision():
+    try:
+        r = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True)
+        return r.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def write_tree(root, count, min_size, max_size, fanout=20):
+    rnd = secrets.SystemRandom()
+    total = 0
+    for i in range(count):
+        d = os.path.join(root, f'd{i % fanout:03}')
+        os.makedirs(d, exist_ok=True)
+        size = rnd.randint(min_size, max_size)
+        with open(os.path.join(d, f'f{i:07}'), 'wb') as f:
+            f.write(os.urandom(size))
+        total += size
+    return total
+
+
+class Bench:
+
+    def __init__(self, args, emulator):
+        self.args = args
+        self.emulator = emulator
+        import boto3
+        self.s3 = boto3.client('s3')
+        self.bucket = 's3shutil-bench'
+        self.s3.create_bucket(Bucket=self.bucket)
+        self.tmp = tempfile.mkdtemp(prefix='s3shutil-bench-')
+        self.run_id = secrets.token_hex(4)
+
+    def s3root(self, name):
+        return f's3://{self.bucket}/{self.run_id}/{name}/'
+
+    def fsroot(self, name):
+        return os.path.join(self.tmp, name)
+
+    def measure(self, name, files, size, f):
+        import s3shutil
+        before = dict(self.emulator.requests) if self.emulator else {}
+        t0 = time.perf_counter()
+        f(s3shutil)
+        seconds = time.perf_counter() - t0
+        requests = {}
+        if self.emulator:
+            requests = {k: v - before.get(k, 0) for k, v in self.emulator.requests.items() if v - before.get(k, 0)}
+        r = {
+            'scenario': name,
+            'seconds': round(seconds, 4),
+            'files': files,
+            'bytes': size,
+            'files_per_s': round(files / seconds, 2) if seconds else None,
+            'mb_per_s': round(size / MB / seconds, 3) if seconds else None,
+            'requests': requests,
+        }
+        log.info('%-16s %8.3fs %10.1f files/s %9.2f MB/s', name, seconds, r['files_per_s'] or 0, r['mb_per_s'] or 0)
+        return r
+
+    def tiny_upload(self):
+        src = self.fsroot('tiny')
+        size = write_tree(src, self.args.tiny_count, 1, self.args.tiny_size)
+        return self.measure('tiny_upload', self.args.tiny_count, size,
+                            lambda s: s.copytree(src, self.s3root('tiny')))
+
+    def tiny_download(self):
+        dst = self.fsroot('tiny-down')
+        size = self.tree_size(self.fsroot('tiny'))
+        return self.measure('tiny_download', self.args.tiny_count, size,
+                            lambda s: s.copytree(self.s3root('tiny'), dst))
+
+    def noop_sync(self):
+        src = self.fsroot('tiny')
+        return self.measure('noop_sync', self.args.tiny_count, 0,
+                            lambda s: s.tree_sync(src, self.s3root('tiny')))
+
+    def s3_copy(self):
+        size = self.tree_size(self.fsroot('tiny'))
+        return self.measure('s3_copy', self.args.tiny_count, size,
+                            lambda s: s.copytree(self.s3root('tiny'), self.s3root('tiny-copy')))
+
+    def rmtree(self):
+        return self.measure('rmtree', self.args.tiny_count, 0,
+                            lambda s: s.rmtree(self.s3root('tiny')))
+
+    def huge_upload(self):
+        src = self.fsroot('huge')
+        size = write_tree(src, self.args.huge_count, self.args.huge_size * MB, self.args.huge_size * MB)
+        return self.measure('huge_upload', self.args.huge_count, size,
+                            lambda s: s.copytree(src, self.s3root('huge')))
+
+    def huge_download(self):
+        size = self.tree_size(self.fsroot('huge'))
+        return self.measure('huge_download', self.args.huge_count, size,
+                            lambda s: s.copytree(self.s3root('huge'), self.fsroot('huge-down')))
+
+    def tree_size(self, root):
+        total = 0
+        for d, _, files in os.walk(root):
+            total += sum(os.path.getsize(os.path.join(d, f)) for f in files)
+        return total
+
+    def close(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+
+# order matters, later scenarios reuse the trees written by earlier ones
+SCENARIOS = ['tiny_upload', 'noop_sync', 'tiny_download', 's3_copy', 'rmtree', 'huge_upload', 'huge_download']
+
+
+def params_of(args):
+    return {k: getattr(args, k) for k in ('tiny_count', 'tiny_size', 'huge_count', 'huge_size',
+                                          'latency', 'jitter', 'fault_rate', 'bandwidth', 'endpoint')}
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(history, current):
+    previous = [h for h in history if h['params'] == current['params']]
+    if not previous:
+        return
+    prev = {r['scenario']: r for r in previous[-1]['results']}
+    log.info('compared with %s (%s)', previous[-1]['version'], previous[-1]['git'])
+    for r in current['results']:
+        p = prev.get(r['scenario'])
+        if p and p['files_per_s'] and r['files_per_s']:
+            change = (r['files_per_s'] / p['files_per_s'] - 1) * 100
+            log.info('%-16s %10.1f -> %10.1f files/s (%+.1f%%)', r['scenario'], p['files_per_s'],
+                     r['files_per_s'], change)
+
+
+def show_history(history):
+    for h in history:
+        line = ' '.join(f'{r["scenario"]}={r["files_per_s"]}f/s,{r["mb_per_s"]}MB/s' for r in h['results'])
+        print(f'{h["time"]} {h["version"]} {h["git"]} {line}')
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--scenarios', default=','.join(SCENARIOS))
+    p.add_argument('--tiny-count', type=int, default=2000)
+    p.add_argument('--tiny-size', type=int, default=4096, help='max bytes of a tiny file')
+    p.add_argument('--huge-count', type=int, default=3)
+    p.add_argument('--huge-size', type=int, default=64, help='MB per huge file')
+    p.add_argument('--latency', type=float, default=0.0, help='seconds added by the emulator to every request')
+    p.add_argument('--jitter', type=float, default=0.0)
+    p.add_argument('--fault-rate', type=float, default=0.0, help='probability of a 503 SlowDown')
+    p.add_argument('--bandwidth', type=float, default=None, help='emulated bytes per second per request')
+    p.add_argument('--endpoint', default=None, help='use this endpoint instead of the in-process emulator')
+    p.add_argument('--results', default=DEFAULT_RESULTS)
+    p.add_argument('--no-save', action='store_true')
+    p.add_argument('--history', action='store_true', help='print the saved results and exit')
+    args = p.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARN, format='%(message)s')
+    log.setLevel(logging.INFO)
+
+    if args.history:
+        show_history(load_history(args.results))
+        return
+
+    emulator = None
+    if args.endpoint:
+        os.environ['AWS_ENDPOINT_URL'] = args.endpoint
+    else:
+        emulator = S3Emulator(latency=args.latency, jitter=args.jitter, fault_rate=args.fault_rate,
+                              bandwidth=args.bandwidth).start()
+        os.environ.update(emulator.environ())
+
+    bench = Bench(args, emulator)
+    try:
+        results = [getattr(bench, name)() for name in args.scenarios.split(',')]
+    finally:
+        bench.close()
+        if emulator:
+            emulator.stop()
+
+    current = {
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'version': s3shutil_version(),
+        'git': git_revision(),
+        'python': platform.python_version(),
+        'boto3': __import__('boto3').__version__,
+        'params': params_of(args),
+        'results': results,
+    }
+    history = load_history(args.results)
+    compare(history, current)
+    if not args.no_save:
+        with open(args.results, 'a') as f:
+            f.write(json.dumps(current) + '\n')
+
+
+if __name__ == '__main__':
+    main()
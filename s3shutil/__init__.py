@@ -1,2 +1,6 @@
 from s3shutil.s3shutil import tree_copy, tree_rm, tree_move, tree_sync, \
-    rmtree, copytree, move, copyfile, copy
\ No newline at end of file
+    rmtree, copytree, move, copyfile, copyfileobj, copy, disk_usage, plan, execute, TransferPlan, shard_boundaries, \
+    verify, VerifyReport, VerifyError, TransferError, FailureReport, TransferReport
+from s3shutil.watch import watch
+from s3shutil.pack import pack, unpack, PackedTree
+from s3shutil.tracing import Tracer
@@ -0,0 +1,143 @@
+"""Command line entry point, mostly to run one shard of a large sync on each host
+
+    python -m s3shutil sync s3://bucket/data/ /mnt/data/ --shard 3/16
+    python -m s3shutil copytree /mnt/data/ s3://bucket/data/ --shard 3/16 --shard-mode hash
+    python -m s3shutil sync /mnt/data/ s3://bucket-us/data/ s3://bucket-eu/data/
+    python -m s3shutil boundaries s3://bucket/data/ 16
+    python -m s3shutil watch /mnt/data/ s3://bucket/data/
+    python -m s3shutil pack /mnt/small-files/ s3://bucket/packed/
+    pg_dump db | gzip | python -m s3shutil cp - s3://bucket/dumps/db.gz
+    python -m s3shutil watch s3://bucket/data/ /mnt/data/ --events https://sqs.us-east-1.amazonaws.com/1234/data-events
+"""
+import argparse
+import json
+import logging
+import sys
+
+import s3shutil
+
+
+def parse_shard(value):
+    index, count = value.split('/')
+    return int(index), int(count)
+
+
+def write_report(path, report):
+    if path:
+        with open(path, 'w') as f:
+            json.dump(report.to_dict(), f, indent=2)
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(prog='python -m s3shutil', description=__doc__,
+                                formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('-v', '--verbose', action='store_true')
+    commands = p.add_subparsers(dest='command', required=True)
+
+    for name in ('sync', 'copytree', 'rmtree'):
+        c = commands.add_parser(name)
+        if name != 'rmtree':
+            c.add_argument('src')
+            c.add_argument('dst', nargs='+', help='one or more destinations, the source is read once for all')
+        else:
+            c.add_argument('dst')
+        c.add_argument('--shard', type=parse_shard, help='index/count, the shard of the keyspace to process')
+        c.add_argument('--shard-mode', choices=('range', 'hash'), default='range' if name != 'rmtree' else 'hash')
+        c.add_argument('--shard-boundaries', help='json list of boundaries, see the boundaries command')
+        if name != 'rmtree':
+            c.add_argument('--src-inventory', help='manifest.json of an S3 Inventory report read instead of listing src')
+        c.add_argument('--dst-inventory', help='manifest.json of an S3 Inventory report read instead of listing dst')
+        c.add_argument('--check-inventory', action='store_true', help='list the sides anyway, the inventories may be stale')
+        if name != 'rmtree':
+            c.add_argument('--incremental', help='state file, from a local directory only what changed since '
+                                                 'the last successful run is copied')
+            c.add_argument('--dedup', type=int, metavar='BYTES',
+                           help='local files of at least BYTES with the same content are uploaded once')
+            c.add_argument('--order', choices=('spread', 'key', 'largest', 'smallest', 'newest', 'locality'),
+                           help='the order of the transfers within the reorder window')
+        if name == 'rmtree':
+            c.add_argument('--versions', action='store_true',
+                           help='in a versioned bucket, delete all the versions and delete markers')
+        c.add_argument('--report', help='where the json report of the operation is written')
+        c.add_argument('--failure-manifest', nargs='+', help='where the actions that failed are written as a plan, '
+                                                             'one per destination')
+
+    c = commands.add_parser('watch', help='syncs, then uploads and deletes changed files until interrupted')
+    c.add_argument('src')
+    c.add_argument('dst')
+    c.add_argument('--debounce', type=float, default=1.0, help='seconds a file must be quiet before upload')
+    c.add_argument('--events', help='from s3, the SQS queue url (or json lines file) of its event notifications')
+    c.add_argument('--reconcile-interval', type=float, default=3600, help='seconds between full syncs, from s3')
+
+    c = commands.add_parser('cp', help='copies one file, - is stdin or stdout')
+    c.add_argument('src')
+    c.add_argument('dst')
+    c.add_argument('--part-size', type=int, default=8 * 1024 * 1024, help='bytes per part of multipart uploads')
+    c.add_argument('--report', help='where the json report of the copy is written')
+
+    c = commands.add_parser('pack', help='uploads a directory with its small files packed in tar shards')
+    c.add_argument('src')
+    c.add_argument('dst')
+    c.add_argument('--shard-size', type=int, default=64 * 1024 * 1024)
+    c.add_argument('--small', type=int, default=1024 * 1024, help='files of fewer bytes are packed')
+
+    c = commands.add_parser('unpack', help='restores a packed tree')
+    c.add_argument('src')
+    c.add_argument('dst')
+
+    c = commands.add_parser('boundaries', help='prints the json boundaries of range shards')
+    c.add_argument('src')
+    c.add_argument('count', type=int)
+
+    args = p.parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARN,
+                        format='%(asctime)s %(levelname)s:%(name)s:%(message)s')
+
+    if args.command == 'boundaries':
+        print(json.dumps(s3shutil.shard_boundaries(args.src, args.count)))
+        return
+
+    if args.command == 'cp':
+        write_report(args.report, s3shutil.copyfile(args.src, args.dst, part_size=args.part_size))
+        return
+
+    if args.command == 'pack':
+        files, shards = s3shutil.pack(args.src, args.dst, args.shard_size, args.small)
+        print(f'{files} files, {shards} shards')
+        return
+    if args.command == 'unpack':
+        s3shutil.unpack(args.src, args.dst)
+        return
+
+    if args.command == 'watch':
+        try:
+            s3shutil.watch(args.src, args.dst, debounce=args.debounce, events=args.events,
+                           reconcile_interval=args.reconcile_interval)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    options = {'shard': args.shard, 'shard_mode': args.shard_mode}
+    if args.shard_boundaries:
+        options['shard_boundaries'] = json.loads(args.shard_boundaries)
+    for option in 'src_inventory', 'dst_inventory', 'check_inventory', 'incremental', 'dedup', 'order':
+        if getattr(args, option, None):
+            options[option] = getattr(args, option)
+    if args.failure_manifest:
+        manifests = args.failure_manifest
+        options['failure_manifest'] = manifests[0] if len(manifests) == 1 else manifests
+
+    if args.command in ('sync', 'copytree'):
+        dst = args.dst[0] if len(args.dst) == 1 else args.dst
+        operation = s3shutil.tree_sync if args.command == 'sync' else s3shutil.tree_copy
+        write_report(args.report, operation(args.src, dst, **options))
+    elif args.command == 'rmtree':
+        r = s3shutil.tree_rm(args.dst, versions=args.versions, **options)
+        if args.versions:
+            print(r)
+        else:
+            write_report(args.report, r)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,135 @@
+"""S3 Inventory reports as a listing, see Inventory"""
+import os
+import csv
+import gzip
+import json
+import heapq
+import logging
+import tempfile
+import urllib.parse
+
+import boto3
+
+log = logging.getLogger('s3shutil.inventory')
+
+
+class Inventory:
+    """An S3 Inventory report, read from its manifest.json on s3 (s3://bucket/key) or in a local copy of the report.
+
+    objects() streams the current objects of the source bucket in key order, the data files are in no order
+    so the records are sorted in runs of run_size spilled to temporary files and merged.
+    CSV reports are read with the standard library, Parquet and ORC ones require the pyarrow package."""
+
+    def __init__(self, manifest, s3=None, run_size=1_000_000):
+        self.manifest_path = manifest
+        self.s3 = s3 or boto3.client('s3')
+        self.run_size = run_size
+        self.manifest = json.loads(self.read_bytes(manifest))
+        self.bucket = self.manifest['sourceBucket']
+        self.destination = self.manifest['destinationBucket'].split(':::')[-1]
+        self.format = self.manifest['fileFormat'].lower()
+        # seconds since the epoch when the report was made
+        self.created = int(self.manifest['creationTimestamp']) / 1000
+
+    def open(self, path):
+        if path.startswith('s3://'):
+            bucket, key = path[5:].split('/', 1)
+            return self.s3.get_object(Bucket=bucket, Key=key)['Body']
+        return open(path, 'rb')
+
+    def read_bytes(self, path):
+        with self.open(path) as f:
+            return f.read()
+
+    def data_path(self, key):
+        """where a data file is, in the destination bucket or next to a local manifest"""
+        if self.manifest_path.startswith('s3://'):
+            return f's3://{self.destination}/{key}'
+        # a local copy keeps the layout of the report, <config>/<date>/manifest.json and <config>/data/
+        here = os.path.dirname(self.manifest_path)
+        for path in os.path.join(here, '..', 'data', os.path.basename(key)), os.path.join(here, os.path.basename(key)):
+            if os.path.exists(path):
+                return path
+        raise FileNotFoundError(f'inventory data file {key} not found near {self.manifest_path}')
+
+    def rows(self):
+        """(key, size) of every current object of the report, in no particular order"""
+        for f in self.manifest['files']:
+            path = self.data_path(f['key'])
+            log.info('reading %s', path)
+            if self.format == 'csv':
+                rows = self.csv_rows(path)
+            elif self.format in ('parquet', 'orc'):
+                rows = self.arrow_rows(path)
+            else:
+                raise ValueError(f'unsupported inventory format {self.format}')
+            for key, size, latest, delete_marker in rows:
+                if latest and not delete_marker:
+                    yield key, size
+
+    def csv_rows(self, path):
+        columns = [c.strip() for c in self.manifest['fileSchema'].split(',')]
+        k, s = columns.index('Key'), columns.index('Size')
+        latest = columns.index('IsLatest') if 'IsLatest' in columns else None
+        marker = columns.index('IsDeleteMarker') if 'IsDeleteMarker' in columns else None
+        with self.open(path) as raw, gzip.open(raw, 'rt', newline='') as f:
+            for row in csv.reader(f):
+                yield (urllib.parse.unquote_plus(row[k]), int(row[s] or 0),
+                       latest is None or row[latest] == 'true', marker is not None and row[marker] == 'true')
+
+    def arrow_rows(self, path):
+        try:
+            import pyarrow
+            if self.format == 'parquet':
+                import pyarrow.parquet
+            else:
+                import pyarrow.orc
+        except ImportError as e:
+            raise ImportError(f'{self.format} inventories require the pyarrow package') from e
+        source = pyarrow.BufferReader(self.read_bytes(path))
+        if self.format == 'parquet':
+            table = pyarrow.parquet.read_table(source)
+        else:
+            table = pyarrow.orc.ORCFile(source).read()
+        names = set(table.column_names)
+        keys = table.column('key').to_pylist()
+        sizes = table.column('size').to_pylist()
+        latest = table.column('is_latest').to_pylist() if 'is_latest' in names else [True] * len(keys)
+        markers = table.column('is_delete_marker').to_pylist() if 'is_delete_marker' in names else [False] * len(keys)
+        for row in zip(keys, sizes, latest, markers):
+            yield row[0], row[1] or 0, row[2], row[3]
+
+    def objects(self, prefix=''):
+        """(key, size) of the current objects under prefix, sorted by key like a listing"""
+        runs = []
+        batch = []
+        try:
+            for key, size in self.rows():
+                if key.startswith(prefix):
+                    batch.append((key, size))
+                    if len(batch) >= self.run_size:
+                        runs.append(self.spill(batch))
+                        batch = []
+            if not runs:
+                batch.sort()
+                yield from batch
+                return
+            runs.append(self.spill(batch))
+            yield from heapq.merge(*[self.read_run(run) for run in runs])
+        finally:
+            for run in runs:
+                run.close()
+
+    def spill(self, batch):
+        batch.sort()
+        run = tempfile.TemporaryFile('w+', encoding='utf-8')
+        for record in batch:
+            run.write(json.dumps(record) + '\n')
+        run.seek(0)
+        log.info('spilled a run of %s keys', len(batch))
+        return run
+
+    def read_run(self, run):
+        for line in run:
+            key, size = json.loads(line)
+            yield key, size
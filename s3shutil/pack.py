@@ -0,0 +1,186 @@
+"""Packing millions of tiny files into tar shards, see pack(), unpack() and PackedTree
+
+A packed tree under an s3 prefix is made of:
+
+    .s3shutil-pack/shard-000000.tar ...   the files smaller than small, in shards of about shard_size bytes
+    .s3shutil-pack/index.jsonl.gz         one [key, shard, offset of the data, size] line per file
+    <key>                                 the files of at least small bytes, as regular objects (shard is null)
+
+The index is uploaded last, a tree without one is incomplete.
+"""
+import io
+import os
+import gzip
+import json
+import logging
+import tarfile
+import tempfile
+
+from s3shutil.s3shutil import Engine, generic_parse_path, fs_path
+
+log = logging.getLogger('s3shutil.pack')
+
+PACK_DIR = '.s3shutil-pack/'
+INDEX = PACK_DIR + 'index.jsonl.gz'
+
+
+def shard_name(number):
+    return f'{PACK_DIR}shard-{number:06}.tar'
+
+
+class Packer:
+    """builds the shards of a local tree and uploads them, with the large files, through the engine"""
+
+    def __init__(self, src, dst, shard_size=64 * 1024 * 1024, small=1024 * 1024, **options):
+        self.src = generic_parse_path(src)
+        self.dst = generic_parse_path(dst)
+        if self.src.get_type() != 'fs' or self.dst.get_type() != 's3':
+            raise ValueError(f'pack uploads a local directory to s3, not {src} to {dst}')
+        # every shard in flight is held in memory
+        options.setdefault('concurrency', 8)
+        self.engine = Engine(**options)
+        self.engine.sides(self.src, self.dst)
+        self.ops = self.engine.generic_ops
+        self.shard_size = shard_size
+        self.small = small
+        self.shards = 0
+        self.files = 0
+
+    def run(self):
+        try:
+            with tempfile.TemporaryDirectory(prefix='s3shutil-pack-') as tmp:
+                path = os.path.join(tmp, 'index.jsonl.gz')
+                with gzip.open(path, 'wt', encoding='utf-8') as index:
+                    with self.engine.tp() as tp:
+                        self.engine.dispatch(tp, self.tasks(index))
+                self.engine.run(self.engine.cp, (fs_path(path), self.dst.join(INDEX)))
+        finally:
+            self.engine.finish()
+        log.info('packed %s files in %s shards', self.files, self.shards)
+        return self.files, self.shards
+
+    def tasks(self, index):
+        """uploads of the large files and of every shard as soon as it is full, the index lines
+        are written as files are added"""
+        root = self.src.get_path()
+        shard = None
+        pending = []
+        for key, entry in self.ops.walk_sorted(root, '', key_filter=self.engine.key_filter):
+            st = entry.stat()
+            self.files += 1
+            if st.st_size >= self.small:
+                index.write(json.dumps([key, None, None, st.st_size]) + '\n')
+                yield self.engine.cp, (self.src.join(key), self.dst.join(key)), key
+                continue
+            if shard is None:
+                buffer = io.BytesIO()
+                shard = tarfile.open(fileobj=buffer, mode='w', format=tarfile.PAX_FORMAT)
+            info = tarfile.TarInfo(key)
+            info.size = st.st_size
+            info.mtime = st.st_mtime
+            info.mode = st.st_mode & 0o777
+            with open(entry.path, 'rb') as f:
+                shard.addfile(info, f)
+            pending.append(key)
+            if buffer.tell() >= self.shard_size:
+                shard.close()
+                yield self.shard_task(buffer, pending, index)
+                shard = None
+                pending = []
+        if shard is not None:
+            shard.close()
+            yield self.shard_task(buffer, pending, index)
+
+    def shard_task(self, buffer, keys, index):
+        name = shard_name(self.shards)
+        self.shards += 1
+        data = buffer.getvalue()
+        # the data offsets, read back from the headers tarfile wrote
+        with tarfile.open(fileobj=io.BytesIO(data), mode='r') as tar:
+            for member in tar.getmembers():
+                index.write(json.dumps([member.name, name, member.offset_data, member.size]) + '\n')
+        log.info('shard %s of %s files, %s bytes, %s to %s', name, len(keys), len(data), keys[0], keys[-1])
+        return self.put, (name, data), keys[0]
+
+    def put(self, args):
+        name, data = args
+        self.ops.put_bytes(self.dst.join(name), data)
+
+
+def safe_key(key):
+    """a relative key that can not escape the destination directory"""
+    parts = key.split('/')
+    if key.startswith('/') or '..' in parts or '\\' in key or not key:
+        raise ValueError(f'unsafe key in packed tree: {key}')
+    return key
+
+
+class PackedTree:
+    """A packed tree on s3, read through its index: keys(), and read(key) with one ranged GET"""
+
+    def __init__(self, src, **options):
+        self.src = generic_parse_path(src)
+        self.engine = Engine(**options)
+        self.engine.sides(self.src, None)
+        self.ops = self.engine.generic_ops
+        data = self.get(self.src.join(INDEX))
+        self.index = {}
+        for line in gzip.decompress(data).decode('utf-8').splitlines():
+            key, shard, offset, size = json.loads(line)
+            self.index[key] = (shard, offset, size)
+
+    def keys(self):
+        return sorted(self.index)
+
+    def get(self, path, offset=None, size=None):
+        return self.engine.run(lambda args: self.ops.get_bytes(*args), (path, offset, size))
+
+    def read(self, key):
+        shard, offset, size = self.index[key]
+        if shard is None:
+            return self.get(self.src.join(key))
+        if size == 0:
+            return b''
+        return self.get(self.src.join(shard), offset, size)
+
+    def shards(self):
+        return sorted({shard for shard, _, _ in self.index.values() if shard is not None})
+
+    def extract(self, dst):
+        """restores the tree under the local directory dst, shards and large files are downloaded in parallel"""
+        dst = generic_parse_path(dst)
+        root = dst.get_path()
+
+        def extract_shard(name):
+            body = self.ops.get_stream(self.src.join(name))
+            with tarfile.open(fileobj=body, mode='r|') as tar:
+                for member in tar:
+                    if not member.isfile():
+                        continue
+                    path = os.path.join(root, safe_key(member.name))
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    with open(path, 'wb') as f:
+                        f.write(tar.extractfile(member).read())
+                    os.utime(path, (member.mtime, member.mtime))
+                    os.chmod(path, member.mode or 0o644)
+
+        tasks = [(extract_shard, name, name) for name in self.shards()]
+        tasks += [(self.engine.cp, (self.src.join(key), dst.join(safe_key(key))), key)
+                  for key, (shard, _, _) in sorted(self.index.items()) if shard is None]
+        try:
+            with self.engine.tp() as tp:
+                self.engine.dispatch(tp, iter(tasks))
+        finally:
+            self.engine.finish()
+
+
+def pack(src, dst, shard_size=64 * 1024 * 1024, small=1024 * 1024, **options):
+    """Uploads the local directory src to the s3 prefix dst with the files smaller than small packed
+    in tar shards of about shard_size bytes, and an index of where every file is.
+    Returns (files, shards)"""
+    return Packer(src, dst, shard_size, small, **options).run()
+
+
+def unpack(src, dst, **options):
+    """Restores a tree packed under the s3 prefix src in the local directory dst"""
+    PackedTree(src, **options).extract(dst)
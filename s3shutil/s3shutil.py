@@ -1,14 +1,36 @@
 import os.path
+import sys
 from os.path import join, relpath, dirname, basename, isdir
-from os import walk, unlink, makedirs
+from os import unlink, makedirs, scandir
 
 import logging
 import threading
+import time
 import itertools
 import heapq
+import random
+import collections
+import json
+import gzip
+import math
+import zlib
+import base64
+import hashlib
+import re
+import fnmatch
 import boto3
-import functools
+import boto3.s3.transfer
+import botocore.config
+import botocore.exceptions
+import s3transfer.subscribers
 import shutil
+import functools
+import contextlib
+import queue
+import tempfile
+
+from s3shutil.tracing import NullTracer, default_tracer
+from s3shutil.inventory import Inventory
 
 log = logging.getLogger('s3shutil')
 debug_iterators = False
@@ -38,6 +60,163 @@ def debug_iterator(name, it):
 
     return copy2
 
+def key_prefix(key, depth=1):
+    """the first depth directories of a relative key, '' for keys at the root"""
+    parts = key.split('/')
+    return '/'.join(parts[:min(depth, len(parts) - 1)])
+
+
+def spread_by_prefix(items, prefix_of, window=1000, deferred=None):
+    """Reorders items within a bounded window so that consecutive items alternate
+    between prefixes (round robin), instead of all workers hitting the same prefix.
+    Items of the same prefix keep their order. deferred(prefix) returning True skips
+    that prefix in the current round, unless all the prefixes in the window are deferred."""
+    groups = collections.OrderedDict()
+    buffered = 0
+    it = iter(items)
+    exhausted = False
+    while True:
+        while not exhausted and buffered < window:
+            try:
+                x = next(it)
+            except StopIteration:
+                exhausted = True
+                break
+            groups.setdefault(prefix_of(x), collections.deque()).append(x)
+            buffered += 1
+
+        if not groups:
+            return
+
+        prefixes = list(groups)
+        if deferred is not None:
+            ready = [p for p in prefixes if not deferred(p)]
+            prefixes = ready or prefixes
+
+        for p in prefixes:
+            group = groups[p]
+            yield group.popleft()
+            buffered -= 1
+            if not group:
+                del groups[p]
+
+def order_within_window(items, sort_key, window=1000):
+    """Reorders items within a bounded window: of the window items read ahead, the one with the smallest
+    sort_key is yielded first and the next item read takes its place. An item overtakes at most window - 1
+    others, ties keep their order"""
+    heap = []
+    for i, x in enumerate(items):
+        heapq.heappush(heap, (sort_key(x), i, x))
+        if len(heap) >= window:
+            yield heapq.heappop(heap)[2]
+    while heap:
+        yield heapq.heappop(heap)[2]
+
+
+def shard_of_key(key, count):
+    """deterministic shard of a relative key, the same in every process and python version"""
+    return zlib.crc32(key.encode('utf-8')) % count
+
+
+def _just_before(key):
+    """the greatest string smaller than key, for an exclusive StartAfter that includes key"""
+    last = ord(key[-1])
+    if last == 0:
+        return key[:-1]
+    return key[:-1] + chr(last - 1) + '\U0010ffff'
+
+
+_REGEX_SPECIAL = set('.^$*+?{}[]\\|()')
+
+
+def _literal_prefix(rule):
+    """the fixed beginning of a glob or of a compiled regex, every key the rule matches starts with it"""
+    if isinstance(rule, str):
+        return re.split(r'[*?\[]', rule, maxsplit=1)[0]
+    pattern = rule.pattern
+    # the branches of an alternation start differently, conservatively any | gives no prefix
+    if rule.flags & re.IGNORECASE or '|' in pattern:
+        return ''
+    prefix = []
+    for i, c in enumerate(pattern):
+        if c in _REGEX_SPECIAL:
+            if c in '*?{' and prefix:
+                prefix.pop()
+            break
+        prefix.append(c)
+    return ''.join(prefix)
+
+
+class KeyFilter:
+    """include and exclude rules on keys relative to the root of a tree operation.
+    Strings are globs where * also matches /, a rule ending with / matches the whole directory,
+    compiled regular expressions are matched from the beginning of the key.
+    A key is selected when it matches an include, or there are no includes, and no exclude.
+
+    The rules are pushed down into the listing: literal beginnings of the includes become
+    narrower listing prefixes, and directories that cannot hold a selected key are not listed."""
+
+    def __init__(self, include=None, exclude=None):
+        self.include = [self._normalize(r) for r in self._as_list(include)]
+        self.exclude = [self._normalize(r) for r in self._as_list(exclude)]
+        self.include_re = [self._compile(r) for r in self.include]
+        self.exclude_re = [self._compile(r) for r in self.exclude]
+        self.include_prefixes = [_literal_prefix(r) for r in self.include]
+        # excludes like logs/tmp/* exclude every key starting with logs/tmp/
+        self.exclude_subtrees = [r[:-1] for r in self.exclude
+                                 if isinstance(r, str) and r.endswith('*') and _literal_prefix(r) == r[:-1]]
+
+    @staticmethod
+    def _as_list(rules):
+        if rules is None:
+            return []
+        if isinstance(rules, (str, re.Pattern)):
+            return [rules]
+        return list(rules)
+
+    @staticmethod
+    def _normalize(rule):
+        if isinstance(rule, str) and rule.endswith('/'):
+            return rule + '*'
+        return rule
+
+    @staticmethod
+    def _compile(rule):
+        if isinstance(rule, str):
+            return re.compile(fnmatch.translate(rule))
+        return rule
+
+    def match(self, key):
+        if self.include_re and not any(r.match(key) for r in self.include_re):
+            return False
+        return not any(r.match(key) for r in self.exclude_re)
+
+    def excluded_subtree(self, key):
+        """the beginning shared by key and all the keys that follow it and are excluded, or None"""
+        for prefix in self.exclude_subtrees:
+            if key.startswith(prefix):
+                return prefix
+        return None
+
+    def prune_dir(self, dir_key):
+        """True when no key under the directory dir_key (ending with /) can be selected"""
+        if self.excluded_subtree(dir_key) is not None:
+            return True
+        if self.include_prefixes:
+            return not any(p.startswith(dir_key) or dir_key.startswith(p) for p in self.include_prefixes)
+        return False
+
+    def prefixes(self):
+        """the sorted, non overlapping, beginnings of the keys that can be selected"""
+        if not self.include_prefixes or '' in self.include_prefixes:
+            return ['']
+        result = []
+        for p in sorted(set(self.include_prefixes)):
+            if not result or not p.startswith(result[-1]):
+                result.append(p)
+        return result
+
+
 def parse_s3_path(s3path):
     """"returns a (bucket, fullpath) tuple from a s3://bucket/path/to/key string"""
     assert s3path[:5] == 's3://'
@@ -53,6 +232,8 @@ def _is_s3(path):
     return path.startswith('s3://')
 
 def generic_parse_path(path):
+    if path == '-':
+        return stream_path(None)
     if _is_s3(path):
         return parse_s3_path(path)
     else:
@@ -61,8 +242,13 @@ def generic_parse_path(path):
 
 class ThreadLocalBoto3:
 
-    def __init__(self):
+    def __init__(self, client_config=None, session_args=None, client_args=None, on_client=None):
+        """on_client is called with every client created, to register event handlers"""
         self.thread_local = threading.local()
+        self.client_config = client_config
+        self.session_args = session_args or {}
+        self.client_args = client_args or {}
+        self.on_client = on_client
 
     def _get_thread_local(self, name, factory_func):
         v = getattr(self.thread_local, name, None)
@@ -73,10 +259,16 @@ class ThreadLocalBoto3:
         return v
 
     def _get_session(self):
-        return self._get_thread_local('session', boto3.Session)
+        return self._get_thread_local('session', lambda: boto3.Session(**self.session_args))
 
     def _get_client(self, service):
-        return self._get_thread_local(service, lambda: self._get_session().client(service))
+        return self._get_thread_local(service, lambda: self._new_client(service))
+
+    def _new_client(self, service):
+        client = self._get_session().client(service, config=self.client_config, **self.client_args)
+        if self.on_client is not None:
+            self.on_client(client)
+        return client
 
     def client(self, service):
         return self._get_client(service)
@@ -91,7 +283,26 @@ def get_thread_local_boto3():
     return _thread_local_boto3_singleton
 
 
+class Endpoint:
+    """Where one side of a copy is, when it is not where the default session points: another account, region
+    or s3 compatible service. profile_name is passed to boto3.Session, the other arguments (endpoint_url,
+    region_name, aws_access_key_id, config...) to its clients"""
+
+    def __init__(self, transfer_config=None, profile_name=None, on_client=None, retry_config=None, **client_args):
+        session_args = {'profile_name': profile_name} if profile_name else None
+        config = client_args.pop('config', None)
+        if transfer_config is not None and config is not None:
+            transfer_config = transfer_config.merge(config)
+        if retry_config is not None and config is not None:
+            retry_config = retry_config.merge(config)
+        self.b3 = ThreadLocalBoto3(transfer_config or config, session_args, client_args, on_client)
+        # listing and the transfer managers keep botocore's retries, like GenericOps.list_b3 and transfer_b3
+        self.list_b3 = ThreadLocalBoto3(config, session_args, client_args, on_client)
+        self.transfer_b3 = ThreadLocalBoto3(retry_config or config, session_args, client_args, on_client)
+
+
 class generic_path:
+    __slots__ = ()
 
     def relative(self, path, start):
         pass
@@ -114,18 +325,25 @@ class generic_path:
 
 class fs_path(generic_path):
     """valid objects are strings"""
+    __slots__ = ('path', 'size')
 
-    def __init__(self, path):
+    def __init__(self, path, size=None):
         self.path = path
+        self.size = size
 
     def get_type(self):
         return 'fs'
 
     def relative(self, start):
-        return relpath(self.path, start.path)
+        root = start.path if start.path.endswith(os.sep) else start.path + os.sep
+        if self.path.startswith(root):
+            rel = self.path[len(root):]
+        else:
+            rel = relpath(self.path, start.path)
+        return rel if os.sep == '/' else rel.replace(os.sep, '/')
 
-    def join(self, relative):
-        return fs_path(join(self.path, relative))
+    def join(self, relative, size=None):
+        return fs_path(join(self.path, relative), size)
 
     def delete_batch_size(self):
         return 1
@@ -146,20 +364,25 @@ class fs_path(generic_path):
 
 
 class s3_path(generic_path):
+    __slots__ = ('bucket', 'path', 'size', 'endpoint')
 
-    def __init__(self, path):
+    def __init__(self, path, size=None, endpoint=None):
         self.bucket, self.path = path
+        self.size = size
+        self.endpoint = endpoint
 
     def get_type(self):
         return 's3'
 
     def relative(self, start):
         assert self.bucket == start.bucket
-        return self.path.replace(start.path, '')
+        if not self.path.startswith(start.path):
+            raise ValueError(f'{self} is not under {start}')
+        return self.path[len(start.path):]
 
-    def join(self, relative):
+    def join(self, relative, size=None):
         p = (self.bucket, f'{self.path}{relative}')
-        return s3_path(p)
+        return s3_path(p, size, self.endpoint)
 
     def delete_batch_size(self):
         return 1000
@@ -179,84 +402,656 @@ class s3_path(generic_path):
     __repr__ = __str__
 
 
-class GenericOps:
+class stream_path(generic_path):
+    """an open binary file object read or written from its current position, None is stdin or stdout"""
+    __slots__ = ('fileobj', 'size')
+
+    def __init__(self, fileobj, size=None):
+        self.fileobj = fileobj
+        self.size = size
+
+    def get_type(self):
+        return 'stream'
+
+    def get_path(self):
+        return self.fileobj
+
+    def reader(self):
+        f = self.fileobj if self.fileobj is not None else sys.stdin.buffer
+        seekable = getattr(f, 'seekable', None)
+        return f if seekable is not None and seekable() else FullReader(f)
+
+    def writer(self):
+        return self.fileobj if self.fileobj is not None else sys.stdout.buffer
+
+    def filename(self):
+        raise ValueError('a stream has no file name')
+
+    def __str__(self):
+        return '-' if self.fileobj is None else repr(self.fileobj)
+
+    __repr__ = __str__
+
+
+class FullReader:
+    """reads as many bytes as asked until the end of a stream, pipes and sockets return less, and every part
+    of a multipart upload but the last must be at least 5 MB"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return self.fileobj.read()
+        chunks = []
+        while size > 0:
+            data = self.fileobj.read(size)
+            if not data:
+                break
+            chunks.append(data)
+            size -= len(data)
+        return b''.join(chunks)
+
+
+class InOrderWriter:
+    """hides the seek of a file object, so that the transfer manager writes the parts of a download
+    in order from the current position rather than at their offsets"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def write(self, data):
+        return self.fileobj.write(data)
+
+
+CHECKSUM_ALGORITHMS = ('CRC32', 'CRC32C', 'SHA1', 'SHA256', 'CRC64NVME')
+
+
+def _crt_checksums():
+    try:
+        from awscrt import checksums
+        return checksums
+    except ImportError:
+        return None
+
+
+class _Crc:
+
+    def __init__(self, f, size):
+        self.f = f
+        self.size = size
+        self.crc = 0
+
+    def update(self, data):
+        self.crc = self.f(data, self.crc)
+
+    def digest(self):
+        return self.crc.to_bytes(self.size, 'big')
+
+
+def new_checksum(algorithm):
+    """a hashlib like object computing the checksum S3 stores for algorithm, None when it needs
+    the awscrt package and it is not installed"""
+    if algorithm in ('SHA1', 'SHA256', 'MD5'):
+        return hashlib.new(algorithm.lower())
+    if algorithm == 'CRC32':
+        return _Crc(zlib.crc32, 4)
+    crt = _crt_checksums()
+    if crt is None:
+        return None
+    if algorithm == 'CRC32C':
+        return _Crc(crt.crc32c, 4)
+    if algorithm == 'CRC64NVME':
+        return _Crc(crt.crc64nvme, 8)
+    return None
+
+
+def file_checksum(path, algorithm, part_sizes=None, block=1024 * 1024):
+    """the base64 checksum of a local file as S3 stores it, composite (of the parts' checksums) when
+    part_sizes is given, None when the algorithm can not be computed here"""
+    whole = new_checksum(algorithm)
+    if whole is None:
+        return None
+    with open(path, 'rb') as f:
+        if not part_sizes:
+            for data in iter(lambda: f.read(block), b''):
+                whole.update(data)
+            return base64.b64encode(whole.digest()).decode()
+        for size in part_sizes:
+            part = new_checksum(algorithm)
+            while size > 0:
+                data = f.read(min(block, size))
+                if not data:
+                    break
+                part.update(data)
+                size -= len(data)
+            whole.update(part.digest())
+    return f'{base64.b64encode(whole.digest()).decode()}-{len(part_sizes)}'
+
+
+def data_checksum(algorithm, data):
+    """the base64 checksum of bytes as S3 stores it, for the algorithms new_checksum computes"""
+    h = new_checksum(algorithm)
+    h.update(data)
+    return base64.b64encode(h.digest()).decode()
+
+
+class VerifyReport:
+    """the keys verify compared: equal checksums, mismatches, and the ones with nothing to compare
+    (no stored checksum, a multipart ETag, or an algorithm that needs awscrt)"""
 
     def __init__(self):
-        self.b3 = get_thread_local_boto3()
+        self.verified = 0
+        self.mismatched = []
+        self.unverifiable = []
+        self.lock = threading.Lock()
+
+    def add(self, key, result):
+        with self.lock:
+            if result == 'ok':
+                self.verified += 1
+            elif result == 'mismatch':
+                self.mismatched.append(key)
+            else:
+                self.unverifiable.append(key)
+
+    def __repr__(self):
+        return (f'VerifyReport(verified={self.verified}, mismatched={len(self.mismatched)}, '
+                f'unverifiable={len(self.unverifiable)})')
+
+
+class VerifyError(Exception):
+    """raised by tree operations with verify when checksums differ, report is the VerifyReport"""
+
+    def __init__(self, report):
+        super().__init__(f'{len(report.mismatched)} objects differ, the first ones are {report.mismatched[:10]}')
+        self.report = report
+
+
+class KnownSize(s3transfer.subscribers.BaseSubscriber):
+    """tells the transfer manager the size of a transfer when it is queued"""
+
+    def __init__(self, size):
+        self.size = size
+
+    def on_queued(self, future, **kwargs):
+        future.meta.provide_transfer_size(self.size)
+
+
+class RangeReader:
+    """A read only file object over an s3 object, fetched in ranged GETs of part_size bytes with read_ahead
+    of them in flight. The ranges after the first must match its ETag, a failed range is retried alone"""
+
+    def __init__(self, s3, bucket, key, part_size=8 * 1024 * 1024, read_ahead=4, attempts=5):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.attempts = attempts
+        first = self.get(0)
+        self.etag = first['ETag']
+        self.size = int(first['ContentRange'].split('/')[-1]) if 'ContentRange' in first else first['ContentLength']
+        self.buffer = bytearray(first['Body'].read())
+        self.offsets = iter(range(part_size, self.size, part_size))
+        self.read_ahead = read_ahead
+        self.pool = None
+        self.pending = collections.deque()
+
+    def get(self, offset):
+        kwargs = {'Bucket': self.bucket, 'Key': self.key, 'Range': f'bytes={offset}-{offset + self.part_size - 1}'}
+        if offset:
+            kwargs['IfMatch'] = self.etag
+        attempt = 0
+        while True:
+            try:
+                r = self.s3.get_object(**kwargs)
+                if offset:
+                    return r['Body'].read()
+                return r
+            except Exception as e:
+                attempt += 1
+                if not is_transient(e) or attempt >= self.attempts:
+                    raise
+                time.sleep(random.uniform(0, min(5.0, 0.1 * 2 ** attempt)))
+
+    def fill(self):
+        if self.pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self.pool = ThreadPoolExecutor(max_workers=self.read_ahead, thread_name_prefix='range')
+        while len(self.pending) < self.read_ahead:
+            offset = next(self.offsets, None)
+            if offset is None:
+                return
+            self.pending.append(self.pool.submit(self.get, offset))
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            self.fill()
+            if not self.pending:
+                break
+            self.buffer += self.pending.popleft().result()
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def readable(self):
+        return True
+
+    def close(self):
+        for future in self.pending:
+            future.cancel()
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class GenericOps:
+
+    def __init__(self, tracer=None, b3=None, checksum=None, small_object=8 * 1024 * 1024, transfer_config=None,
+                 list_b3=None, transfer_b3=None):
+        self.b3 = b3 or get_thread_local_boto3()
+        # listing is sequential, it keeps botocore's own retries
+        self.list_b3 = list_b3 or get_thread_local_boto3()
+        # and so do the parts of the transfer managers, a failed part would fail its whole file
+        self.transfer_b3 = transfer_b3 or self.list_b3
+        self.checksum = checksum
+        self.upload_args = {'ChecksumAlgorithm': checksum} if checksum else None
+        self.download_args = {'ChecksumMode': 'ENABLED'} if checksum else None
+        # objects smaller than this are one put_object / get_object on the calling thread
+        self.small_object = small_object
+        # larger ones go through one transfer manager, shared by all the workers, see transfer_manager()
+        self.transfer_config = transfer_config or boto3.s3.transfer.TransferConfig()
+        self.transfer_managers = {}
+        self.fan_out_pool = None
+        self.manager_lock = threading.Lock()
         self.log = logging.getLogger('s3shutil.ops')
+        self.tracer = tracer or NullTracer()
+
+    def client(self, path):
+        """the client for requests on the s3 path, of its endpoint when it has one"""
+        return (path.endpoint.b3 if path.endpoint else self.b3).client('s3')
+
+    def list_client(self, path):
+        return (path.endpoint.list_b3 if path.endpoint else self.list_b3).client('s3')
+
+    def transfer_client(self, path):
+        return (path.endpoint.transfer_b3 if path.endpoint else self.transfer_b3).client('s3')
 
-    def generic_list(self, src):
-        self.log.info('generic_list src=%s', src)
+    def generic_list(self, src, start=None, end=None, key_filter=None):
+        """lists the files under src as path objects, see list_keys"""
+        for key, size, _ in self.list_keys(src, start, end, key_filter):
+            yield src.join(key, size)
+
+    def list_keys(self, src, start=None, end=None, key_filter=None):
+        """lists the files under src as (relative key, size, mtime) tuples, in key order. start and end restrict
+        the listing to the relative keys in [start, end), key_filter to the keys it selects.
+        Tuples of a key sliced once from the listing are what a diff of tens of millions of keys can afford"""
+        self.log.info('list_keys src=%s, start=%s, end=%s', src, start, end)
         if src.get_type() == 's3':
-            bucket, prefix = src.get_path()
-            s3 = self.b3.client('s3')
-            paginator = s3.get_paginator('list_objects_v2')
-            self.log.info('paginate Bucket=%s, Prefix=%s', bucket, prefix)
-            for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
-                for entry in page.get('Contents', []):
-                    key = entry['Key']
-                    obj = s3_path((bucket, key))
-                    self.log.debug('Found %s', obj)
-                    yield obj
+            for p in key_filter.prefixes() if key_filter else ['']:
+                if start and p + '\U0010ffff' < start or end is not None and p >= end:
+                    continue
+                yield from self.list_s3(src, p, start if start and start > p else None, end, key_filter)
 
         elif src.get_type() == 'fs':
             path = src.get_path()
-            self.log.info('os.walk %s', path)
-            for directory, dirs, files in walk(path):
-                dirs.sort()
-                files.sort()
-                for f in files:
-                    fp = join(directory, f)
-                    obj = fs_path(fp)
-                    self.log.info('Found %s', obj)
-                    yield obj
+            self.log.info('walk %s', path)
+            if not isdir(path):
+                return
+            for key, entry in self.walk_sorted(path, '', start, end, key_filter):
+                st = entry.stat()
+                yield key, st.st_size, st.st_mtime
 
         else:
             raise Exception(f'unsupported type {src.get_type()}')
 
+    def list_s3(self, src, rel_prefix, start, end, key_filter):
+        """lists the (relative key, size, mtime) under src that start with rel_prefix. When a page ends inside
+        a subtree that key_filter excludes, the listing jumps after the subtree"""
+        bucket, root = src.get_path()
+        s3 = self.list_client(src)
+        paginator = s3.get_paginator('list_objects_v2')
+        prefix = root + rel_prefix
+        stop = root + end if end is not None else None
+        start_after = _just_before(root + start) if start else None
+        while True:
+            kwargs = {'Bucket': bucket, 'Prefix': prefix}
+            if start_after:
+                kwargs['StartAfter'] = start_after
+            self.log.info('paginate %s', kwargs)
+            pages = paginator.paginate(**kwargs)
+            pages = self.tracer.timed_iterator('list.page', pages, bucket=bucket, prefix=prefix)
+            start_after = None
+            for page in pages:
+                contents = page.get('Contents', [])
+                for entry in contents:
+                    key = entry['Key']
+                    if stop is not None and key >= stop:
+                        return
+                    rel = key[len(root):]
+                    if key_filter is not None and not key_filter.match(rel):
+                        continue
+                    yield rel, entry['Size'], entry['LastModified'].timestamp()
+                if key_filter is not None and contents:
+                    skip = key_filter.excluded_subtree(contents[-1]['Key'][len(root):])
+                    if skip is not None:
+                        start_after = root + skip + '\U0010ffff'
+                        self.log.info('skipping the excluded %s', skip)
+                        break
+            if start_after is None:
+                return
+
+    def scan_sorted(self, directory):
+        """(key name, DirEntry) of a directory sorted by key name, directories are named with a trailing /"""
+        with self.tracer.span('list.walk', path=directory):
+            with scandir(directory) as it:
+                entries = list(it)
+            entries = [(e.name + '/' if e.is_dir(follow_symlinks=False) else e.name, e) for e in entries]
+            entries.sort(key=lambda x: x[0])
+        return entries
+
+    def walk_sorted(self, directory, rel='', start=None, end=None, key_filter=None):
+        """yields the (key relative to directory, DirEntry) of every file under directory, in key order,
+        the same order s3 lists keys so both can be merged.
+        Subtrees entirely outside of the relative keys range [start, end), or that
+        key_filter prunes, are not walked.
+        Like os.walk, symbolic links to directories are not followed"""
+        for name, entry in self.scan_sorted(directory):
+            key = rel + name
+            if end is not None and key >= end:
+                return
+            if name[-1] == '/':
+                if start is not None and key + '\U0010ffff' < start:
+                    continue
+                if key_filter is not None and key_filter.prune_dir(key):
+                    continue
+                yield from self.walk_sorted(entry.path, key, start, end, key_filter)
+            elif not entry.is_dir():
+                if start is not None and key < start:
+                    continue
+                if key_filter is not None and not key_filter.match(key):
+                    continue
+                yield key, entry
+
+    def walk_changed(self, directory, dst_root, since, rel='', key_filter=None):
+        """the (relative key, action, size, mtime) that bring the s3 dst_root up to date with the local directory,
+        when nothing changed before since (a time.time()). Files whose mtime and ctime are older are not copied.
+        Only the directories modified since, where entries were added, removed or renamed, are listed in
+        dst_root, with a delimiter: missing files are copied, missing subdirectories copied whole, and the
+        keys of entries that are gone are yielded as deletes. Keys are yielded in no particular order"""
+        changed = os.stat(directory).st_mtime >= since
+        if changed:
+            dst_files, dst_dirs = self.list_s3_dir(dst_root, rel)
+        names = set()
+        for name, entry in self.scan_sorted(directory):
+            key = rel + name
+            names.add(name)
+            if name[-1] == '/':
+                if key_filter is not None and key_filter.prune_dir(key):
+                    continue
+                if changed and name not in dst_dirs:
+                    # new, or moved in with its old times
+                    for sub, e in self.walk_sorted(entry.path, key, key_filter=key_filter):
+                        st = e.stat()
+                        yield sub, 'copy', st.st_size, st.st_mtime
+                else:
+                    yield from self.walk_changed(entry.path, dst_root, since, key, key_filter)
+            elif not entry.is_dir():
+                if key_filter is not None and not key_filter.match(key):
+                    continue
+                st = entry.stat()
+                if max(st.st_mtime, st.st_ctime) >= since or changed and name not in dst_files:
+                    yield key, 'copy', st.st_size, st.st_mtime
+        if not changed:
+            return
+        for name, size in dst_files.items():
+            if name not in names and (key_filter is None or key_filter.match(rel + name)):
+                yield rel + name, 'delete', size, None
+        for name in dst_dirs - names:
+            for key, size, mtime in self.list_s3(dst_root, rel + name, None, None, key_filter):
+                yield key, 'delete', size, mtime
+
+    def list_s3_dir(self, root, rel):
+        """the files {name: size} and the subdirectory names, ending with /, directly under the relative
+        directory rel of the s3 root"""
+        bucket, prefix = root.get_path()
+        start = len(prefix) + len(rel)
+        files, dirs = {}, set()
+        paginator = self.list_client(root).get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix + rel, Delimiter='/'):
+            dirs.update(p['Prefix'][start:] for p in page.get('CommonPrefixes', []))
+            files.update((c['Key'][start:], c['Size']) for c in page.get('Contents', []))
+        return files, dirs
+
+    def list_first_level(self, root, versions=False):
+        """sorted names of the entries directly under root, directories end with /.
+        With versions, s3 entries that only have old versions or delete markers are included"""
+        if root.get_type() == 's3':
+            bucket, prefix = root.get_path()
+            s3 = self.list_client(root)
+            paginator = s3.get_paginator('list_object_versions' if versions else 'list_objects_v2')
+            names = set()
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+                names.update(p['Prefix'][len(prefix):] for p in page.get('CommonPrefixes', []))
+                for kind in ('Versions', 'DeleteMarkers') if versions else ('Contents',):
+                    names.update(c['Key'][len(prefix):] for c in page.get(kind, []))
+            return sorted(names)
+        if not isdir(root.get_path()):
+            return []
+        return [name for name, entry in self.scan_sorted(root.get_path())]
+
+    def stored_checksum(self, path):
+        """(size, algorithm, checksum, etag) of an s3 object, algorithm and checksum are None
+        when it has no additional checksum, etag is None when it is not derived from the md5 of the content,
+        as with SSE-KMS and SSE-C"""
+        bucket, key = path.get_path()
+        r = self.client(path).head_object(Bucket=bucket, Key=key, ChecksumMode='ENABLED')
+        etag = r['ETag'].strip('"')
+        if r.get('ServerSideEncryption', '').startswith('aws:kms') or r.get('SSECustomerAlgorithm'):
+            etag = None
+        for algorithm in CHECKSUM_ALGORITHMS:
+            if r.get(f'Checksum{algorithm}'):
+                return r['ContentLength'], algorithm, r[f'Checksum{algorithm}'], etag
+        return r['ContentLength'], None, None, etag
+
+    def part_sizes(self, path):
+        bucket, key = path.get_path()
+        r = self.client(path).get_object_attributes(Bucket=bucket, Key=key, ObjectAttributes=['ObjectParts'],
+                                                    MaxParts=10000)
+        return [p['Size'] for p in r.get('ObjectParts', {}).get('Parts', [])]
+
+    def local_matches(self, s3, fs):
+        """compares the checksums stored for the s3 object with the ones of the local file"""
+        size, algorithm, checksum, etag = self.stored_checksum(s3)
+        if size != os.path.getsize(fs.get_path()):
+            return 'mismatch'
+        if algorithm is None:
+            if etag is None or '-' in etag:
+                return 'unverifiable'
+            # the ETag of a single part upload is its md5
+            algorithm, checksum = 'MD5', base64.b64encode(bytes.fromhex(etag)).decode()
+        parts = None
+        if '-' in checksum:
+            parts = self.part_sizes(s3)
+            if not parts:
+                return 'unverifiable'
+        computed = file_checksum(fs.get_path(), algorithm, parts)
+        if computed is None:
+            return 'unverifiable'
+        return 'ok' if computed == checksum else 'mismatch'
+
+    def matches(self, src, dst):
+        """'ok', 'mismatch' or 'unverifiable', without downloading s3 objects"""
+        if src.get_type() == 'fs' and dst.get_type() == 'fs':
+            if os.path.getsize(src.get_path()) != os.path.getsize(dst.get_path()):
+                return 'mismatch'
+            same = file_checksum(src.get_path(), 'SHA256') == file_checksum(dst.get_path(), 'SHA256')
+            return 'ok' if same else 'mismatch'
+        if src.get_type() == 'fs':
+            return self.local_matches(dst, src)
+        if dst.get_type() == 'fs':
+            return self.local_matches(src, dst)
+        src_size, src_algorithm, src_checksum, src_etag = self.stored_checksum(src)
+        dst_size, dst_algorithm, dst_checksum, dst_etag = self.stored_checksum(dst)
+        if src_size != dst_size:
+            return 'mismatch'
+        if src_algorithm is not None and src_algorithm == dst_algorithm:
+            if src_checksum == dst_checksum:
+                return 'ok'
+            # composite checksums of different part sizes differ for the same content
+            if '-' not in src_checksum and '-' not in dst_checksum:
+                return 'mismatch'
+        if src_etag is None or dst_etag is None:
+            return 'unverifiable'
+        if src_etag == dst_etag:
+            return 'ok'
+        if '-' not in src_etag and '-' not in dst_etag:
+            return 'mismatch'
+        return 'unverifiable'
+
+    def list_versions(self, root, start=None, end=None):
+        """(key, version id, size) of every version under the s3 root with a relative key in [start, end),
+        size is None for delete markers. Versions of a key are in no particular order"""
+        bucket, prefix = root.get_path()
+        paginator = self.list_client(root).get_paginator('list_object_versions')
+        kwargs = {'Bucket': bucket, 'Prefix': prefix}
+        if start:
+            kwargs['KeyMarker'] = _just_before(prefix + start)
+        stop = prefix + end if end is not None else None
+        pages = self.tracer.timed_iterator('list.page', paginator.paginate(**kwargs), bucket=bucket, prefix=prefix)
+        for page in pages:
+            entries = [(v['Key'], v['VersionId'], v['Size']) for v in page.get('Versions', [])]
+            entries += [(m['Key'], m['VersionId'], None) for m in page.get('DeleteMarkers', [])]
+            entries.sort(key=lambda x: x[0])
+            for entry in entries:
+                if stop is not None and entry[0] >= stop:
+                    return
+                yield entry
+
+    def rm_versions(self, root, objects):
+        """deletes up to 1000 {'Key': key, 'VersionId': id} in the bucket of root for good"""
+        bucket = root.get_path()[0]
+        self.log.info('rm %s versions, the first one is %s:%s', len(objects), bucket, objects[0]['Key'])
+        r = self.client(root).delete_objects(Bucket=bucket, Delete={'Objects': objects, 'Quiet': True})
+        _raise_delete_errors(r)
+        return r
+
     def rm_s3(self, keys):
         bucket, key = keys[0].get_path()
         self.log.info('rm %s keys, the first one is %s:%s', len(keys), bucket, key)
-        keys = [{'Key': k.get_path()[1]} for k in keys]
+        objects = [{'Key': k.get_path()[1]} for k in keys]
 
         if self.log.isEnabledFor(logging.DEBUG):
-            for i, key in enumerate(keys):
+            for i, key in enumerate(objects):
                 self.log.debug('key %s is %s', i, key)
 
-        s3 = self.b3.client('s3')
-        r = s3.delete_objects(Bucket=bucket, Delete={'Objects': keys})
+        s3 = self.client(keys[0])
+        r = s3.delete_objects(Bucket=bucket, Delete={'Objects': objects})
+        _raise_delete_errors(r)
         return r
 
     def rm_fs(self, keys):
         assert len(keys) == 1 # in fs the batch size is 1
         self.log.info('rm 1 key %s', keys[0])
         for key in keys:
-            unlink(key)
+            unlink(key.get_path())
 
     def rm_generic(self, keys):
         assert len(keys) > 0
         tp = keys[0].get_type()
         assert tp in ('fs', 's3')
-        if tp == 'fs':
-            self.rm_fs(keys)
-        elif tp == 's3':
-            self.rm_s3(keys)
+        with self.tracer.span('delete', count=len(keys)):
+            if tp == 'fs':
+                self.rm_fs(keys)
+            elif tp == 's3':
+                self.rm_s3(keys)
+
+    def put_bytes(self, dst, data):
+        bucket, key = dst.get_path()
+        with self.tracer.span('transfer', dst=str(dst), size=len(data)):
+            self.client(dst).put_object(Bucket=bucket, Key=key, Body=data, **(self.upload_args or {}))
+
+    def get_stream(self, src, offset=None, size=None):
+        """the streaming body of an s3 object, or of size bytes of it from offset"""
+        bucket, key = src.get_path()
+        kwargs = {'Bucket': bucket, 'Key': key}
+        if offset is not None:
+            kwargs['Range'] = f'bytes={offset}-{offset + size - 1}'
+        return self.client(src).get_object(**kwargs)['Body']
+
+    def get_bytes(self, src, offset=None, size=None):
+        with self.tracer.span('transfer', src=str(src), size=size):
+            return self.get_stream(src, offset, size).read()
+
+    def transfer_manager(self, path):
+        """the transfer manager of the endpoint of the s3 path, created on first use with a client
+        shared by its threads"""
+        with self.manager_lock:
+            manager = self.transfer_managers.get(path.endpoint)
+            if manager is None:
+                manager = boto3.s3.transfer.create_transfer_manager(self.transfer_client(path), self.transfer_config)
+                self.transfer_managers[path.endpoint] = manager
+            return manager
+
+    def close(self):
+        """shuts the transfer managers down, the next transfer creates another one"""
+        with self.manager_lock:
+            managers = list(self.transfer_managers.values())
+            self.transfer_managers.clear()
+            pool, self.fan_out_pool = self.fan_out_pool, None
+        for manager in managers:
+            manager.shutdown()
+        if pool is not None:
+            pool.shutdown()
+
+    def transfer(self, method, path, size, *args, extra_args=None):
+        """submits an upload or download of the s3 path to the shared manager and waits for it, the parts of
+        all the files in flight are interleaved in its threads. A known size saves the stat or HEAD of the submission"""
+        subscribers = [KnownSize(size)] if size is not None else None
+        manager = self.transfer_manager(path)
+        future = getattr(manager, method)(*args, extra_args=extra_args, subscribers=subscribers)
+        return future.result()
 
     def generic_copy(self, src, dst):
-        s3 = self.b3.client('s3')
+        if not self.tracer.enabled:
+            return self._generic_copy(src, dst)
+        with self.tracer.span('transfer', src=str(src), dst=str(dst)):
+            return self._generic_copy(src, dst)
+
+    def _generic_copy(self, src, dst):
         if type(src) == fs_path:
             if type(dst) == s3_path: #local to s3
                 full_path = src.get_path()
                 bucket, key = dst.get_path()
                 self.log.info('uploading %s to %s:%s', full_path, bucket, key)
-                r = s3.upload_file(full_path, bucket, key)
-                return r
+                size = src.size if src.size is not None else os.path.getsize(full_path)
+                if size < self.small_object:
+                    with open(full_path, 'rb') as f:
+                        return self.client(dst).put_object(Bucket=bucket, Key=key, Body=f, **(self.upload_args or {}))
+                return self.transfer('upload', dst, size, full_path, bucket, key, extra_args=self.upload_args)
+        elif type(src) == stream_path:
+            if type(dst) == s3_path:
+                bucket, key = dst.get_path()
+                self.log.info('uploading %s to %s:%s', src, bucket, key)
+                # of unknown length, read in parts with a bounded number of them in memory
+                return self.transfer('upload', dst, src.size, src.reader(), bucket, key, extra_args=self.upload_args)
         elif type(src) == s3_path:
             src_bucket, src_key = src.get_path()
             if type(dst) == s3_path: #s3 to s3
                 dst_bucket, dst_key = dst.get_path()
+                if src.endpoint is not dst.endpoint:
+                    r = self.relay(src, dst)
+                    self.log.info('relayed %s:%s to %s:%s', src_bucket, src_key, dst_bucket, dst_key)
+                    return r
                 copy_src = {'Bucket': src_bucket, 'Key': src_key}
-                r = s3.copy_object(Bucket=dst_bucket, Key=dst_key, CopySource=copy_src)
+                r = self.client(dst).copy_object(Bucket=dst_bucket, Key=dst_key, CopySource=copy_src, **(self.upload_args or {}))
                 self.log.info('copy %s:%s to %s:%s', src_bucket, src_key, dst_bucket, dst_key)
                 result = r['CopyObjectResult']
                 self.log.info('Result %s', result)
@@ -265,150 +1060,1847 @@ class GenericOps:
                 path = dst.get_path()
                 directory = dirname(path)
                 makedirs(directory, 0o777, exist_ok=True)
-                r = s3.download_file(src_bucket, src_key, path)
+                if src.size is not None and src.size < self.small_object:
+                    r = self.download_small(self.client(src), src_bucket, src_key, path)
+                    self.log.info('downloaded %s:%s to %s', src_bucket, src_key, path)
+                    return r
+                r = self.transfer('download', src, src.size, src_bucket, src_key, path, extra_args=self.download_args)
+                # botocore only validates whole object GETs, not the ranged ones of the transfer manager
+                if self.download_args and self.local_matches(src, dst) == 'mismatch':
+                    unlink(path)
+                    raise botocore.exceptions.FlexibleChecksumError(
+                        error_msg=f'{path} does not match the checksum stored for {src_bucket}:{src_key}')
                 self.log.info('downloaded %s:%s to %s', src_bucket, src_key, path)
                 return r
+            elif type(dst) == stream_path:
+                # ranged GETs in parallel, buffered until they can be written in order
+                writer = dst.writer()
+                r = self.transfer('download', src, src.size, src_bucket, src_key, InOrderWriter(writer),
+                                  extra_args=self.download_args)
+                writer.flush()
+                self.log.info('downloaded %s:%s to %s', src_bucket, src_key, dst)
+                return r
 
         raise Exception('unsupported')
 
-class Engine:
+    def relay(self, src, dst):
+        """copies an object between endpoints that copy_object can not span, without local disk: one get_object
+        and put_object below the multipart threshold, above it ranged GETs of the source piped into
+        a multipart upload of the destination. A few parts per object are held in memory"""
+        src_bucket, src_key = src.get_path()
+        bucket, key = dst.get_path()
+        source = self.client(src)
+        size = src.size
+        if size is None:
+            size = source.head_object(Bucket=src_bucket, Key=src_key)['ContentLength']
+        if size < self.transfer_config.multipart_threshold:
+            r = source.get_object(Bucket=src_bucket, Key=src_key, **(self.download_args or {}))
+            return self.client(dst).put_object(Bucket=bucket, Key=key, Body=r['Body'].read(),
+                                               **(self.upload_args or {}))
+        with RangeReader(self.transfer_client(src), src_bucket, src_key, self.transfer_config.multipart_chunksize) as reader:
+            return self.transfer('upload', dst, reader.size, reader, bucket, key, extra_args=self.upload_args)
+
+    def fan_out(self, src, dsts, read_ahead=4):
+        """copies src to every path of dsts, a dict of the destinations to their index in the operation.
+        A local file is read and checksummed once for s3 destinations: its data, or each of its parts, is put
+        to all of them at the same time, with read_ahead parts in memory. The destinations done are removed
+        from dsts, a retry only copies to the others"""
+        if src.get_type() != 'fs' or any(dst.get_type() != 's3' for dst in dsts):
+            for dst in list(dsts):
+                self.generic_copy(src, dst)
+                del dsts[dst]
+            return
+        path = src.get_path()
+        size = src.size if src.size is not None else os.path.getsize(path)
+        # botocore computes CRC32 for every upload by default, here it is computed once for all of them
+        algorithm = self.checksum or 'CRC32'
+        self.log.info('uploading %s to %s destinations', path, len(dsts))
+        with self.tracer.span('transfer', src=str(src), size=size, destinations=len(dsts)), open(path, 'rb') as f:
+            if size < self.transfer_config.multipart_threshold:
+                data = f.read()
+                checksum = {f'Checksum{algorithm}': data_checksum(algorithm, data)}
+                futures = {dst: self.fan_out_executor().submit(self.put_retried, dst, data, checksum)
+                           for dst in dsts}
+                self.fan_out_results(dsts, futures)
+            else:
+                self.fan_out_multipart(f, dsts, algorithm, read_ahead)
+
+    def fan_out_executor(self):
+        """the threads of the requests of fan outs, shared by all the workers"""
+        with self.manager_lock:
+            if self.fan_out_pool is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self.fan_out_pool = ThreadPoolExecutor(max_workers=self.transfer_config.max_concurrency,
+                                                       thread_name_prefix='fan-out')
+            return self.fan_out_pool
+
+    def fan_out_results(self, dsts, futures, error=None):
+        """waits for one request per destination, removes the ones that succeeded and raises the first error"""
+        for dst, future in futures.items():
+            e = future.exception()
+            if e is None:
+                del dsts[dst]
+            elif error is None:
+                error = e
+        if error is not None:
+            raise error
+
+    def fan_out_multipart(self, f, dsts, algorithm, read_ahead):
+        """one multipart upload per destination, fed with the same parts. A destination whose part failed
+        is aborted and dropped, the others go on"""
+        pool = self.fan_out_executor()
+        part_size = self.transfer_config.multipart_chunksize
+        args = {'ChecksumAlgorithm': algorithm}
+        uploads = {}
+        for dst in dsts:
+            bucket, key = dst.get_path()
+            uploads[dst] = self.retried(self.client(dst).create_multipart_upload, Bucket=bucket, Key=key,
+                                        **args)['UploadId']
+        parts = {dst: [] for dst in dsts}
+        failed = {}
+        pending = collections.deque()
+
+        def collect(dst, future):
+            try:
+                parts[dst].append(future.result())
+            except Exception as e:
+                if dst not in failed:
+                    failed[dst] = e
+                    self.abort(dst, uploads.pop(dst))
+
+        try:
+            for number, data in enumerate(iter(lambda: f.read(part_size), b''), 1):
+                checksum = {f'Checksum{algorithm}': data_checksum(algorithm, data)}
+                for dst, upload_id in uploads.items():
+                    pending.append((dst, pool.submit(self.upload_part, dst, upload_id, number, data, checksum)))
+                while len(pending) > read_ahead * len(dsts):
+                    collect(*pending.popleft())
+            while pending:
+                collect(*pending.popleft())
+            futures = {dst: pool.submit(self.complete, dst, upload_id, parts[dst])
+                       for dst, upload_id in uploads.items()}
+        except BaseException:
+            for dst, future in pending:
+                future.cancel()
+            for dst, upload_id in uploads.items():
+                self.abort(dst, upload_id)
+            raise
+        self.fan_out_results(dsts, futures, next(iter(failed.values()), None))
+
+    def retried(self, f, *args, attempts=5, **kwargs):
+        """f(*args, **kwargs), retried after transient errors, for the requests inside one task"""
+        attempt = 0
+        while True:
+            try:
+                return f(*args, **kwargs)
+            except Exception as e:
+                attempt += 1
+                if not is_transient(e) or attempt >= attempts:
+                    raise
+                time.sleep(random.uniform(0, min(5.0, 0.1 * 2 ** attempt)))
+
+    def put_retried(self, dst, data, checksum):
+        bucket, key = dst.get_path()
+        return self.retried(self.client(dst).put_object, Bucket=bucket, Key=key, Body=data, **checksum)
+
+    def upload_part(self, dst, upload_id, number, data, checksum):
+        bucket, key = dst.get_path()
+        r = self.retried(self.client(dst).upload_part, Bucket=bucket, Key=key, UploadId=upload_id,
+                         PartNumber=number, Body=data, **checksum)
+        return {'PartNumber': number, 'ETag': r['ETag'], **checksum}
+
+    def complete(self, dst, upload_id, parts):
+        bucket, key = dst.get_path()
+        parts.sort(key=lambda part: part['PartNumber'])
+        return self.retried(self.client(dst).complete_multipart_upload, Bucket=bucket, Key=key,
+                            UploadId=upload_id, MultipartUpload={'Parts': parts})
+
+    def abort(self, dst, upload_id):
+        bucket, key = dst.get_path()
+        try:
+            self.client(dst).abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        except Exception as e:
+            self.log.warning('could not abort the upload of %s: %s', dst, e)
+
+    def download_small(self, s3, bucket, key, path):
+        """streams the body of one get_object to a temporary file next to path, renamed over it when complete"""
+        r = s3.get_object(Bucket=bucket, Key=key, **(self.download_args or {}))
+        fd, tmp = tempfile.mkstemp(dir=dirname(path), prefix='.' + basename(path) + '.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(r['Body'], f, 1024 * 1024)
+            os.replace(tmp, path)
+        except BaseException:
+            unlink(tmp)
+            raise
+        return r
+
+ORDERS = ('spread', 'key', 'largest', 'smallest', 'newest', 'locality')
+
+THROTTLE_CODES = {'SlowDown', 'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottled',
+                  'RequestLimitExceeded', 'TooManyRequestsException', 'ProvisionedThroughputExceededException',
+                  'RequestThrottledException', 'BandwidthLimitExceeded', 'EC2ThrottledException'}
+
+TRANSIENT_CODES = {'InternalError', 'ServiceUnavailable', 'RequestTimeout', 'RequestTimeoutException',
+                   'PriorConditionFailed', 'IDPCommunicationError'}
+
+
+def _client_error(e):
+    """the botocore ClientError behind e, boto3's transfer wrappers keep it as the context"""
+    while e is not None:
+        if isinstance(e, botocore.exceptions.ClientError):
+            return e
+        e = e.__cause__ or e.__context__
+    return None
+
+
+def _raise_delete_errors(r):
+    """delete_objects succeeds even when some keys failed, raises a ClientError for the first one
+    so that throttled (SlowDown) and internal errors are retried like any other request"""
+    errors = r.get('Errors')
+    if errors:
+        first = errors[0]
+        raise botocore.exceptions.ClientError(
+            {'Error': {'Code': first.get('Code'), 'Message': f'{len(errors)} keys failed, {first}'}},
+            'DeleteObjects')
+
+
+def error_code(e):
+    ce = _client_error(e)
+    if ce is None:
+        return None, None
+    return ce.response.get('Error', {}).get('Code'), ce.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+
+
+def is_throttle(e):
+    code, status = error_code(e)
+    return code in THROTTLE_CODES or status in (429, 503)
+
+
+def is_transient(e):
+    if is_throttle(e):
+        return True
+    code, status = error_code(e)
+    if code is not None:
+        return code in TRANSIENT_CODES or (status or 0) >= 500
+    while e is not None:
+        if isinstance(e, (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError,
+                          ConnectionError, TimeoutError)):
+            return True
+        e = e.__cause__ or e.__context__
+    return False
+
+
+class AdaptiveConcurrency:
+    """Limits the requests in flight, the limit is adjusted with AIMD:
+
+    it grows by `increase` once per window of `limit` fast successes,
+    and is multiplied by `decrease` when a request is throttled,
+    at most once per window, throttles of requests that started before the last decrease are ignored.
+    A success is fast when the latency average is within `latency_tolerance` of the best seen,
+    so the limit stops growing when requests start queueing somewhere.
+    """
+
+    def __init__(self, initial=25, minimum=1, maximum=128, increase=1, decrease=0.5, latency_tolerance=3.0):
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        self.epoch = 0
+        self.successes = 0
+        self.throttles = 0
+        self.latency_avg = None
+        self.latency_best = None
+        self.cond = threading.Condition()
+        self.log = logging.getLogger('s3shutil.concurrency')
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+            return self.epoch, time.perf_counter()
+
+    def release(self, token, throttled=False):
+        epoch, started = token
+        latency = time.perf_counter() - started
+        with self.cond:
+            self.in_flight -= 1
+            if throttled:
+                self.on_throttle(epoch)
+            else:
+                self.on_success(latency)
+            self.cond.notify_all()
+
+    def keep(self, token, throttled):
+        """a failed request that keeps its slot for the retry, a throttle still decreases the limit"""
+        with self.cond:
+            if throttled:
+                self.on_throttle(token[0])
+
+    def renew(self):
+        """the token of a retry in a kept slot"""
+        with self.cond:
+            return self.epoch, time.perf_counter()
+
+    def on_success(self, latency):
+        if self.latency_avg is None:
+            self.latency_avg = latency
+        else:
+            self.latency_avg = 0.9 * self.latency_avg + 0.1 * latency
+        if self.latency_best is None or self.latency_avg < self.latency_best:
+            self.latency_best = self.latency_avg
+        if self.latency_avg > self.latency_best * self.latency_tolerance:
+            return
+        self.successes += 1
+        if self.successes >= int(self.limit) and self.limit < self.maximum:
+            self.limit = min(self.maximum, self.limit + self.increase)
+            self.successes = 0
+
+    def on_throttle(self, epoch):
+        self.throttles += 1
+        if epoch != self.epoch:
+            return
+        self.epoch += 1
+        self.successes = 0
+        self.limit = max(self.minimum, self.limit * self.decrease)
+        self.log.info('throttled, concurrency limit decreased to %s', int(self.limit))
+
+
+class RetryBudget:
+    """Retries shared by all the workers of an engine. Each retry spends a token,
+    each success earns back `refill` tokens and `per_second` tokens come back with time,
+    so when most requests fail the engine stops retrying instead of piling more load
+    on a throttled service."""
+
+    def __init__(self, tokens=100, refill=0.1, per_second=2.0):
+        self.capacity = tokens
+        self.tokens = float(tokens)
+        self.refill = refill
+        self.per_second = per_second
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def spend(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.per_second)
+            self.last = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def earn(self):
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + self.refill)
+
+
+# S3 Standard request prices in USD per request (us-east-1), only used for estimates
+PUT_CLASS_PRICE = 0.005 / 1000
+GET_CLASS_PRICE = 0.0004 / 1000
+PUT_CLASS = {'PutObject', 'CopyObject', 'CreateMultipartUpload', 'UploadPart', 'CompleteMultipartUpload'}
+GET_CLASS = {'GetObject', 'HeadObject'}
+# s3transfer's default multipart threshold and part size
+MULTIPART_CHUNK = 8 * 1024 * 1024
+
+
+class TransferPlan:
+    """The diff of a tree operation: totals per action and, when it has a path,
+    the actions themselves in a json lines file (gzipped when the path ends with .gz).
+    The first line of the file is a header, then one [action, relative key, size] per line,
+    followed in failure manifests by the error, the last line holds the totals."""
+
+    version = 1
+
+    def __init__(self, src, dst, sync, path=None):
+        self.src = src
+        self.dst = dst
+        self.sync = sync
+        self.path = path
+        self.counts = collections.Counter()
+        self.bytes = collections.Counter()
+        self.requests = collections.Counter()
+
+    def add(self, action, size):
+        size = size or 0
+        self.counts[action] += 1
+        self.bytes[action] += size
+        if action == 'copy':
+            self.add_copy_requests(size)
+
+    def add_copy_requests(self, size):
+        src_s3, dst_s3 = _is_s3(self.src or ''), _is_s3(self.dst)
+        parts = max(1, math.ceil(size / MULTIPART_CHUNK))
+        if src_s3 and dst_s3:
+            self.requests['CopyObject'] += 1
+        elif dst_s3:
+            if size > MULTIPART_CHUNK:
+                self.requests['CreateMultipartUpload'] += 1
+                self.requests['UploadPart'] += parts
+                self.requests['CompleteMultipartUpload'] += 1
+            else:
+                self.requests['PutObject'] += 1
+        elif src_s3:
+            self.requests['HeadObject'] += 1
+            self.requests['GetObject'] += parts
+
+    def add_delete_requests(self):
+        if _is_s3(self.dst):
+            self.requests['DeleteObjects'] = math.ceil(self.counts['delete'] / 1000)
+
+    def estimated_cost(self):
+        """request charges in USD, data transfer is not included"""
+        put = sum(n for api, n in self.requests.items() if api in PUT_CLASS)
+        get = sum(n for api, n in self.requests.items() if api in GET_CLASS)
+        return put * PUT_CLASS_PRICE + get * GET_CLASS_PRICE
+
+    def estimated_seconds(self, files_per_s=100, mb_per_s=100):
+        """the transfer is limited either by the number of objects or by the bandwidth"""
+        objects = self.counts['copy'] + self.counts['delete']
+        return max(objects / files_per_s, self.bytes['copy'] / (mb_per_s * 1024 * 1024))
+
+    def totals(self):
+        return {
+            'counts': dict(self.counts),
+            'bytes': dict(self.bytes),
+            'requests': dict(self.requests),
+            'estimated_cost': self.estimated_cost(),
+            'estimated_seconds': self.estimated_seconds(),
+        }
+
+    def header(self):
+        return {'version': self.version, 'src': self.src, 'dst': self.dst, 'sync': self.sync}
+
+    def __str__(self):
+        t = self.totals()
+        return (f'plan {self.src} -> {self.dst}: copy {self.counts["copy"]} objects '
+                f'({self.bytes["copy"]} bytes), delete {self.counts["delete"]}, '
+                f'about ${t["estimated_cost"]:.6f} in requests and {t["estimated_seconds"]:.0f}s')
+
+    __repr__ = __str__
+
+    @staticmethod
+    def _open(path, mode):
+        if path.endswith('.gz'):
+            return gzip.open(path, mode + 't')
+        return open(path, mode)
+
+    def write(self, actions):
+        """consumes (relative key, action, size, mtime) tuples, writing them when the plan has a path"""
+        if self.path is None:
+            for key, action, size, _ in actions:
+                self.add(action, size)
+            self.add_delete_requests()
+            return self
+
+        with self._open(self.path, 'w') as f:
+            f.write(json.dumps(self.header()) + '\n')
+            for key, action, size, _ in actions:
+                self.add(action, size)
+                f.write(json.dumps([action, key, size]) + '\n')
+            self.add_delete_requests()
+            f.write(json.dumps({'totals': self.totals()}) + '\n')
+        return self
+
+    @classmethod
+    def load(cls, path):
+        with cls._open(path, 'r') as f:
+            header = json.loads(f.readline())
+            if header.get('version') != cls.version:
+                raise Exception(f'unsupported plan version {header.get("version")} in {path}')
+            plan = cls(header['src'], header['dst'], header['sync'], path)
+            last = None
+            for last in f:
+                pass
+        totals = json.loads(last)['totals'] if last else None
+        if totals is None:
+            raise Exception(f'plan {path} is truncated')
+        plan.counts.update(totals['counts'])
+        plan.bytes.update(totals['bytes'])
+        plan.requests.update(totals['requests'])
+        return plan
+
+    def actions(self):
+        """streams the (relative key, action, size, mtime) tuples back from the plan file, without the mtimes"""
+        with self._open(self.path, 'r') as f:
+            f.readline()
+            for line in f:
+                x = json.loads(line)
+                if isinstance(x, dict):
+                    return
+                action, key, size = x[:3]
+                yield key, action, size, None
+
+
+class FailureReport:
+    """The objects of a tree operation that still failed after their retries. When path is given they are streamed
+    to it as a manifest, a plan file that execute() replays, with the error of every object. fail_fast failures in a row with
+    the same error and no success in between mean the errors are systematic (AccessDenied on every key,
+    a missing bucket) and stop the operation"""
+
+    def __init__(self, src_root, dst_root, path=None, fail_fast=100):
+        self.src_root = src_root
+        self.dst_root = dst_root
+        self.path = path
+        self.fail_fast = fail_fast
+        self.plan = None
+        self.file = None
+        self.count = 0
+        self.bytes = 0
+        self.errors = collections.Counter()
+        self.first = []
+        self.first_exception = None
+        self.succeeded = 0
+        self.streak = 0
+        self.last_error = None
+        self.systematic = None
+        self.lock = threading.Lock()
+
+    def success(self):
+        with self.lock:
+            self.succeeded += 1
+            self.streak = 0
+
+    def failure(self, f, arg, key, e):
+        """records the objects of a failed copy or delete batch, returns True when the operation should stop"""
+        if isinstance(arg, list):
+            entries = [(p.relative(self.dst_root), 'delete', None) for p in arg]
+        else:
+            entries = [(key, 'copy', arg[0].size)]
+        code, status = error_code(e)
+        error = code or type(e).__name__
+        details = {'error': error, 'status': status, 'transient': is_transient(e), 'message': str(e)[:1000]}
+        with self.lock:
+            if self.path is not None:
+                if self.file is None:
+                    self.open()
+                for rel, action, size in entries:
+                    self.plan.add(action, size)
+                    self.file.write(json.dumps([action, rel, size, details]) + '\n')
+            self.count += len(entries)
+            self.bytes += sum(size or 0 for rel, action, size in entries)
+            self.errors[error] += len(entries)
+            if self.first_exception is None:
+                self.first_exception = e
+            if len(self.first) < 10:
+                self.first.append(f'{entries[0][0]}: {error}')
+            self.streak = self.streak + 1 if error == self.last_error else 1
+            self.last_error = error
+            if self.fail_fast and self.streak >= self.fail_fast and self.systematic is None:
+                self.systematic = error
+            return self.systematic is not None
+
+    def open(self):
+        self.plan = TransferPlan(_path_str(self.src_root), _path_str(self.dst_root), True, self.path)
+        self.file = TransferPlan._open(self.path, 'w')
+        self.file.write(json.dumps(self.plan.header()) + '\n')
+
+    def close(self):
+        if self.file is not None:
+            self.plan.add_delete_requests()
+            self.file.write(json.dumps({'totals': self.plan.totals()}) + '\n')
+            self.file.close()
+            self.file = None
+
+    def __str__(self):
+        where = f', the failures are in {self.path}' if self.path is not None else ''
+        return f'{self.count} objects failed {dict(self.errors)}, {self.succeeded} tasks succeeded{where}'
+
+    __repr__ = __str__
+
+
+class FanOutReport:
+    """The failures of a copy to several destinations, each recorded in the FailureReport of its destination"""
+
+    def __init__(self, reports):
+        self.reports = reports
+
+    def success(self):
+        for report in self.reports:
+            report.success()
+
+    def failure(self, f, arg, key, e):
+        if isinstance(arg[0], int):
+            index, keys = arg
+            return self.reports[index].failure(f, keys, key, e)
+        src, dsts = arg
+        systematic = False
+        for dst, index in list(dsts.items()):
+            systematic = self.reports[index].failure(f, (src, dst), key, e) or systematic
+        return systematic
+
+    def close(self):
+        for report in self.reports:
+            report.close()
+
+
+class TransferError(Exception):
+    """Raised at the end of a tree operation when some objects failed, the others were transferred.
+    report is the FailureReport, manifest the plan file of the failed actions, when failure_manifest was given:
+    execute(manifest) retries them.
+    When several destinations failed, reports has the FailureReport of each"""
+
+    def __init__(self, report, others=()):
+        if report.systematic:
+            what = f'stopped after {report.fail_fast} objects in a row failed with {report.systematic}'
+        else:
+            what = f'{report.count} objects failed'
+        message = f'{what}, the first ones {report.first}'
+        if report.path is not None:
+            message += f', execute({report.path!r}) retries them'
+        if others:
+            message += f', and the copies to {len(others)} other destinations failed too'
+        super().__init__(message)
+        self.report = report
+        self.reports = [report, *others]
+        self.manifest = report.path
+
+
+class RequestCounter:
+    """Counts the HTTP requests the clients it is registered on send, per API and retries included"""
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+
+    def register(self, client):
+        client.meta.events.register('before-send.s3', self.count)
+
+    def count(self, event_name, **kwargs):
+        with self.lock:
+            self.counts[event_name.rsplit('.', 1)[-1]] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return collections.Counter(self.counts)
+
+
+class LatencyHistogram:
+    """Latencies in buckets about 9% wide, the percentiles of millions of objects in constant memory"""
+
+    base = 2 ** 0.125
 
     def __init__(self):
-        self.b3 = ThreadLocalBoto3()
-        self.generic_ops = GenericOps()
+        self.buckets = collections.Counter()
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.buckets[math.floor(math.log(max(seconds, 1e-6), self.base))] += 1
+        self.count += 1
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q):
+        """the upper bound of the bucket of the q-th percentile, q from 0 to 100, None without latencies"""
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(q / 100 * self.count))
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self.base ** (bucket + 1), self.max)
+
+
+class TransferReport:
+    """What an operation did, returned by the tree operations and the copies: objects and bytes per outcome
+    (copied, skipped, deleted, failed), seconds per phase (list, the listing and diffing, transfer and verify),
+    the requests sent per API with their retries, and the latency of each copy. to_dict() is for dashboards"""
+
+    def __init__(self, requests=None):
+        self.started = time.perf_counter()
+        self.seconds = None
+        self.counts = collections.Counter()
+        self.bytes = collections.Counter()
+        self.phases = collections.Counter()
+        self.request_counter = requests
+        self.requests_before = requests.snapshot() if requests is not None else collections.Counter()
+        self.requests = collections.Counter()
+        self.latency = LatencyHistogram()
+        self.lock = threading.Lock()
+
+    def add(self, outcome, count=1, size=None, latency=None):
+        with self.lock:
+            self.counts[outcome] += count
+            self.bytes[outcome] += size or 0
+            if latency is not None:
+                self.latency.add(latency)
+
+    def add_phase(self, name, seconds):
+        with self.lock:
+            self.phases[name] += seconds
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - start)
+
+    def timed(self, name, it):
+        """yields from the lazy iterator it, the time spent in its next() is added to the phase name"""
+        it = iter(it)
+        while True:
+            start = time.perf_counter()
+            x = next(it, _end)
+            self.add_phase(name, time.perf_counter() - start)
+            if x is _end:
+                return
+            yield x
+
+    def finish(self):
+        self.seconds = time.perf_counter() - self.started
+        if self.request_counter is not None:
+            self.requests = self.request_counter.snapshot() - self.requests_before
+        return self
+
+    def elapsed(self):
+        return self.seconds if self.seconds is not None else time.perf_counter() - self.started
+
+    def objects_per_second(self):
+        return self.counts['copied'] / self.elapsed() if self.elapsed() else 0.0
+
+    def bytes_per_second(self):
+        return self.bytes['copied'] / self.elapsed() if self.elapsed() else 0.0
+
+    def percentile(self, q):
+        """seconds, the q-th percentile of the latency of the copies"""
+        return self.latency.percentile(q)
+
+    def to_dict(self):
+        return {
+            'seconds': self.elapsed(),
+            'counts': dict(self.counts),
+            'bytes': dict(self.bytes),
+            'phases': dict(self.phases),
+            'requests': dict(self.requests),
+            'objects_per_second': self.objects_per_second(),
+            'bytes_per_second': self.bytes_per_second(),
+            'latency': {'p50': self.percentile(50), 'p99': self.percentile(99), 'max': self.latency.max},
+        }
+
+    def __str__(self):
+        p50, p99 = self.percentile(50), self.percentile(99)
+        latency = f', copies p50 {p50:.3f}s p99 {p99:.3f}s' if p50 is not None else ''
+        return (f'copied {self.counts["copied"]} ({self.bytes["copied"]} bytes), skipped {self.counts["skipped"]}, '
+                f'deleted {self.counts["deleted"]}, failed {self.counts["failed"]} in {self.elapsed():.1f}s, '
+                f'{self.objects_per_second():.1f} objects/s, {self.bytes_per_second() / 1024 / 1024:.1f} MB/s, '
+                f'{sum(self.requests.values())} requests{latency}')
+
+    __repr__ = __str__
+
+
+_end = object()
+
+
+def _task_objects(arg):
+    """the number of objects of the arg of a copy or delete task"""
+    if isinstance(arg, list):
+        return len(arg)
+    if isinstance(arg[0], int):
+        return len(arg[1])
+    return len(arg[1]) if isinstance(arg[1], dict) else 1
+
+
+def _copied_size(src, dst):
+    """the size of a copy, when the listing or a local side tells it"""
+    if src.size is not None:
+        return src.size
+    for path in src, dst:
+        if path.get_type() == 'fs':
+            return os.path.getsize(path.get_path())
+    return None
+
+
+class HighWaterMark:
+    """The state file of incremental syncs from a local directory: when the last successful run of the same
+    source, destination and filters started, less a margin for the timestamp granularity of file systems"""
+
+    version = 1
+    margin = 2.0
+
+    def __init__(self, path, src_root, dst_root, key_filter=None):
+        self.path = path
+        self.id = {'src': _path_str(src_root), 'dst': _path_str(dst_root),
+                   'filter': None if key_filter is None else repr((key_filter.include, key_filter.exclude))}
+
+    def load(self):
+        """the time before which nothing changed, None when there was no successful run of the same sync"""
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        if state.get('version') != self.version or {k: state.get(k) for k in self.id} != self.id:
+            log.warning('%s is the state of another sync, running a full one', self.path)
+            return None
+        return state['since']
+
+    def save(self, started):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'version': self.version, **self.id, 'since': started - self.margin}, f)
+        os.replace(tmp, self.path)
+
+
+class Content:
+    """A local file uploaded once for all the files with the same content, the others wait for its upload
+    and are copied from it in s3"""
+
+    def __init__(self, src, dst):
+        self.src = src
+        self.dst = dst
+        self.digest = None
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.failed = False
+
+    def hash(self):
+        with self.lock:
+            if self.digest is None:
+                self.digest = file_checksum(self.src.get_path(), 'SHA256')
+            return self.digest
+
+    def finish(self, failed):
+        self.failed = failed
+        self.done.set()
+
+
+class Deduplicator:
+    """Uploads local files of at least min_size bytes with the same content once, the others are copy_object
+    of the first one. Hardlinks are the same content, other files are hashed only when another file of the same
+    size was seen. The sizes and hashes of the files of an operation are held in memory"""
+
+    def __init__(self, ops, min_size=1024 * 1024):
+        self.ops = ops
+        self.min_size = min_size
+        self.inodes = {}
+        self.sizes = {}
+        self.hashes = {}
+        self.lock = threading.Lock()
+        self.copies = 0
+        self.saved = 0
+
+    def cp(self, args):
+        src, dst = args
+        st = os.stat(src.get_path())
+        if st.st_size < self.min_size:
+            return self.ops.generic_copy(src, dst)
+        inode = st.st_dev, st.st_ino
+        with self.lock:
+            content = self.inodes.get(inode)
+            first = None
+            if content is None:
+                first = self.sizes.get(st.st_size)
+                if first is None:
+                    content = self.sizes[st.st_size] = self.inodes[inode] = Content(src, dst)
+                    return self.upload(content)
+        if content is None:
+            digest = file_checksum(src.get_path(), 'SHA256')
+            # the first file of the size is hashed when a second one shows up
+            first_digest = first.hash()
+            with self.lock:
+                self.hashes.setdefault((st.st_size, first_digest), first)
+                content = self.hashes.get((st.st_size, digest))
+                if content is None:
+                    content = self.hashes[st.st_size, digest] = self.inodes[inode] = Content(src, dst)
+                    return self.upload(content)
+        if content.dst is dst:
+            # a retry of the upload that failed
+            content.done.clear()
+            return self.upload(content)
+        # the upload of content is running on another worker
+        content.done.wait()
+        if content.failed:
+            return self.ops.generic_copy(src, dst)
+        self.ops.log.info('%s has the content of %s', src, content.src)
+        r = self.ops.generic_copy(content.dst, dst)
+        with self.lock:
+            self.copies += 1
+            self.saved += st.st_size
+        return r
+
+    def upload(self, content):
+        try:
+            r = self.ops.generic_copy(content.src, content.dst)
+        except BaseException:
+            content.finish(True)
+            raise
+        content.finish(False)
+        return r
+
+    def __str__(self):
+        return f'{self.copies} duplicates copied in s3, {self.saved} bytes not uploaded'
+
+
+class DiskUsage:
+    """what disk_usage returns: total bytes and objects, a histogram of object sizes
+    and the objects and bytes under every first level prefix ('' holds the objects at the root)"""
+
+    # upper bounds of the histogram buckets, the last bucket has no bound
+    buckets = [(0, '0'), (1024, '<1KB'), (16 * 1024, '<16KB'), (128 * 1024, '<128KB'), (1024 ** 2, '<1MB'),
+               (8 * 1024 ** 2, '<8MB'), (64 * 1024 ** 2, '<64MB'), (1024 ** 3, '<1GB'), (None, '>=1GB')]
+
+    def __init__(self):
+        self.bytes = 0
+        self.objects = 0
+        self.histogram = dict.fromkeys((label for bound, label in self.buckets), 0)
+        self.prefixes = {}
+
+    def add(self, key, size):
+        self.bytes += size
+        self.objects += 1
+        for bound, label in self.buckets:
+            if bound is None or size < bound or (bound == 0 and size == 0):
+                self.histogram[label] += 1
+                break
+        p = key_prefix(key)
+        totals = self.prefixes.get(p)
+        if totals is None:
+            totals = self.prefixes[p] = [0, 0]
+        totals[0] += 1
+        totals[1] += size
+
+    def merge(self, other):
+        self.bytes += other.bytes
+        self.objects += other.objects
+        for label, n in other.histogram.items():
+            self.histogram[label] += n
+        for p, (objects, size) in other.prefixes.items():
+            totals = self.prefixes.setdefault(p, [0, 0])
+            totals[0] += objects
+            totals[1] += size
+        return self
+
+    def __str__(self):
+        return f'{self.objects} objects, {self.bytes} bytes in {len(self.prefixes)} prefixes'
+
+    __repr__ = __str__
+
+
+class PurgeReport:
+    """what a versioned rmtree returns: the versions and delete markers deleted, the bytes freed and the rate"""
+
+    def __init__(self):
+        self.versions = 0
+        self.delete_markers = 0
+        self.bytes = 0
+        self.started = time.monotonic()
+        self.seconds = 0.0
+        self.logged = self.started
+        self.lock = threading.Lock()
+
+    def add(self, batch, log=None, every=10.0):
+        with self.lock:
+            for _, size in batch:
+                if size is None:
+                    self.delete_markers += 1
+                else:
+                    self.versions += 1
+                    self.bytes += size
+            now = time.monotonic()
+            self.seconds = now - self.started
+            if log is not None and now - self.logged >= every:
+                self.logged = now
+                log.info('purged %s', self)
+
+    @property
+    def per_second(self):
+        return (self.versions + self.delete_markers) / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return (f'{self.versions} versions ({self.bytes} bytes) and {self.delete_markers} delete markers '
+                f'in {self.seconds:.1f}s, {self.per_second:.0f}/s')
+
+    __repr__ = __str__
+
+
+class Engine:
+
+    def __init__(self, tracer=None, concurrency='adaptive', max_concurrency=128, max_retries=10,
+                 spread_window=1000, prefix_depth=1, shard=None, shard_mode='range', shard_boundaries=None,
+                 include=None, exclude=None, src_inventory=None, dst_inventory=None, check_inventory=False,
+                 checksum=None, verify=None, small_object=8 * 1024 * 1024, src_endpoint=None, dst_endpoint=None,
+                 part_size=8 * 1024 * 1024, failure_manifest=None, fail_fast=100, incremental=None, dedup=None,
+                 order='spread'):
+        """concurrency: 'adaptive' starts with 25 requests in flight and adjusts to throttling and latency,
+                     an int fixes the number of requests in flight
+        max_retries: attempts per object after transient errors, bounded as well by a shared retry budget
+        spread_window: actions are reordered within windows of this size, see order, 0 keeps the sorted key order
+        order: how actions are reordered within the window. 'spread' alternates between key prefixes of
+               prefix_depth directories when s3 is involved, 'key' keeps the sorted key order, 'largest' and
+               'smallest' go by size (largest first shortens the tail of skewed trees), 'newest' by
+               modification time for runs with a deadline, 'locality' by directory and inode for the disk
+               reads of local sources. A function of the (relative key, action, size, mtime) tuples returns
+               the sort key of another order
+        shard: (index, count), only the index-th of count shards of the keyspace is listed, diffed and transferred
+        shard_mode: 'range' splits the first level entries of the source in count contiguous ranges,
+                    each shard lists only its range. 'hash' assigns keys by a hash, every shard lists everything
+                    but the load is balanced even when the first level is skewed
+        shard_boundaries: the count - 1 keys where range shards start, as returned by
+                          s3shutil.shard_boundaries, instead of computing them in every worker. Deleting a range
+                          shard, with no source, requires them
+        include, exclude: a glob, a compiled regex or a list of them, on keys relative to the tree root,
+                          see KeyFilter. Both sides of a sync are filtered, excluded keys are not deleted
+        src_inventory, dst_inventory: the manifest.json of an S3 Inventory report, on s3 or local,
+                                      read instead of listing that side
+        check_inventory: list the sides anyway, instead of trusting reports that may be stale: objects written
+                         or deleted since are then seen, at the cost of the listing. Without it, copies of sources
+                         deleted since the report are skipped and objects written since are missed
+        checksum: 'CRC32', 'CRC32C', 'SHA1' or 'SHA256', computed while uploading and stored by S3, downloads
+                  are validated against the stored checksums. CRC32C needs awscrt, CRC32 is used without it
+        verify: after a tree operation, compare the checksums of the keys on both sides, of all of them ('full')
+                or of a random fraction (a float), and raise VerifyError when some differ
+        small_object: files and objects of fewer bytes are transferred with a single put_object or get_object
+                      on the worker thread instead of through the s3transfer manager, 0 always uses the manager
+        src_endpoint, dst_endpoint: a dict of boto3 Session and client arguments (profile_name, endpoint_url,
+                                    region_name, credentials) for an s3 side in another account, region or service,
+                                    see Endpoint. Copies between different endpoints are streamed through memory
+        part_size: bytes per part of multipart uploads and ranged GETs. An upload is at most 10000 parts, streams
+                   of unknown length larger than 78 GB need a larger part_size
+        failure_manifest: where the actions that failed after their retries are written, as a plan that
+                          execute() replays, none by default. The other objects are still transferred
+                          and TransferError is raised at the end. With several destinations, a list of paths
+        fail_fast: stop after this many failures in a row with the same error, 0 never stops
+        incremental: a state file, from a local directory to s3 only what changed since the last successful run
+                     is copied and only the directories modified since are listed in s3, see walk_changed
+        dedup: from a local directory to s3, files of at least this many bytes (1 MB with True) with the same
+               content are uploaded once and copied in s3 from there, see Deduplicator"""
+        # the engine does the retries so that it sees the throttling
+        config = botocore.config.Config(retries={'total_max_attempts': 1, 'mode': 'standard'},
+                                        max_pool_connections=max_concurrency)
+        # except in the transfer managers, whose parts it does not run
+        retry_config = botocore.config.Config(retries={'mode': 'standard'}, max_pool_connections=max_concurrency)
+        self.requests = RequestCounter()
+        self.b3 = ThreadLocalBoto3(config, on_client=self.requests.register)
+        self.tracer = tracer or default_tracer()
         self.log = logging.getLogger('s3shutil.engine')
+        if checksum is not None:
+            checksum = checksum.upper()
+            if checksum not in CHECKSUM_ALGORITHMS:
+                raise ValueError(f'unsupported checksum {checksum}')
+            if checksum in ('CRC32C', 'CRC64NVME') and _crt_checksums() is None:
+                self.log.warning('%s needs the awscrt package, using CRC32', checksum)
+                checksum = 'CRC32'
+        if concurrency == 'adaptive':
+            self.concurrency = AdaptiveConcurrency(maximum=max_concurrency)
+        else:
+            self.concurrency = AdaptiveConcurrency(concurrency, concurrency, concurrency)
+        # one transfer manager for the whole operation. Its part threads are its own, outside the adaptive limit,
+        # so it is sized from the starting limit rather than the maximum the limit may grow to
+        transfer_config = boto3.s3.transfer.TransferConfig(max_concurrency=int(self.concurrency.limit),
+                                                           multipart_chunksize=part_size)
+        self.generic_ops = GenericOps(self.tracer, self.b3, checksum, small_object, transfer_config,
+                                      ThreadLocalBoto3(on_client=self.requests.register),
+                                      ThreadLocalBoto3(retry_config, on_client=self.requests.register))
+        self.src_endpoint = self.endpoint(src_endpoint, config, retry_config)
+        self.dst_endpoint = self.endpoint(dst_endpoint, config, retry_config)
+        self.retry_budget = RetryBudget()
+        self.max_retries = max_retries
+        if not callable(order) and order not in ORDERS:
+            raise ValueError(f'order is a function or one of {ORDERS}, not {order}')
+        self.order = order
+        self.spread_window = spread_window
+        self.prefix_depth = prefix_depth
+        self.throttled_prefixes = collections.Counter()
+        self.throttled_at = {}
+        if shard is not None:
+            index, count = shard
+            if not 0 <= index < count or shard_mode not in ('range', 'hash'):
+                raise ValueError(f'invalid shard {shard} or shard_mode {shard_mode}')
+        self.shard = shard
+        self.shard_mode = shard_mode
+        self.shard_boundaries = shard_boundaries
+        self.key_filter = KeyFilter(include, exclude) if include or exclude else None
+        self.src_inventory = src_inventory
+        self.dst_inventory = dst_inventory
+        self.check_inventory = check_inventory
+        if verify not in (None, 'full') and not 0 < verify <= 1:
+            raise ValueError(f"verify is 'full' or a fraction, not {verify}")
+        self.verify = verify
+        self.failure_manifest = failure_manifest
+        self.fail_fast = fail_fast
+        self.incremental = incremental
+        self.dedup = 1024 * 1024 if dedup is True else dedup
+        self.report = TransferReport(self.requests)
+
+    def endpoint(self, args, config, retry_config):
+        if not args:
+            return None
+        return Endpoint(config, on_client=self.requests.register, retry_config=retry_config, **args)
 
     def empty_iterator(self):
         return []
 
+    def sides(self, src_root, dst_root):
+        """points the s3 roots of an operation at their endpoints, the paths joined to them follow"""
+        for root, endpoint in (src_root, self.src_endpoint), (dst_root, self.dst_endpoint):
+            if root is not None and root.get_type() == 's3':
+                root.endpoint = endpoint
+
+    def finish(self):
+        """ends an operation: shuts the transfer manager down, reports the trace and returns the TransferReport
+        of the operation, the next one starts another"""
+        try:
+            self.generic_ops.close()
+        finally:
+            self.tracer.finish()
+        report, self.report = self.report, TransferReport(self.requests)
+        self.log.info('%s', report.finish())
+        return report
+
     def tp(self):
         from concurrent.futures import ThreadPoolExecutor
-        return ThreadPoolExecutor(max_workers=25, thread_name_prefix='tp')
+        return ThreadPoolExecutor(max_workers=self.concurrency.maximum, thread_name_prefix='tp')
 
     def map_and_collect(self, f, iterator):
         with self.tp() as tp:
-            rs = tp.map(f, iterator)
-            self.exhaust_iterator(rs)
+            self.dispatch(tp, map(lambda x: (f, x, None), iterator))
+
+    def dispatch(self, tp, tasks, report=None):
+        """runs the (f, arg, key) tasks in the pool, submitting only when the concurrency limit allows,
+        so that the tasks iterator is consumed lazily. Raises the first failure after the
+        tasks in flight complete, or with a FailureReport records the failures and goes on
+        until they are systematic"""
+        failures = []
+        pending = set()
+        lock = threading.Lock()
+
+        def done(f, arg, key, future):
+            with lock:
+                pending.discard(future)
+            e = future.exception()
+            if report is None:
+                if e is not None:
+                    failures.append(e)
+            elif e is None:
+                report.success()
+            elif report.failure(f, arg, key, e):
+                failures.append(e)
+
+        count = 0
+        for f, arg, key in tasks:
+            if failures:
+                break
+            token = self.concurrency.acquire()
+            future = tp.submit(self.run_task, f, arg, key, token)
+            with lock:
+                pending.add(future)
+            future.add_done_callback(functools.partial(done, f, arg, key))
+            count += 1
 
-    def exhaust_iterator(self, it):
         self.log.info('waiting for results')
-        ones = map(lambda x: 1, it)
-        count = functools.reduce(lambda x, y: x+y, ones, 0)
-        self.log.info('Iterator count = %s', count)
+        with lock:
+            waiting = list(pending)
+        for future in waiting:
+            future.exception()
+        self.log.info('Tasks count = %s, concurrency limit %s, throttled %s times',
+                      count, int(self.concurrency.limit), self.concurrency.throttles)
+        if self.throttled_prefixes:
+            self.log.info('Throttled prefixes %s', self.throttled_prefixes.most_common(20))
+        if failures and report is None:
+            raise failures[0]
         return count
 
+    def run_task(self, f, arg, key, token):
+        """runs f(arg) holding the concurrency slot acquired when submitting,
+        transient errors are retried with jittered exponential backoff"""
+        if self.tracer.enabled:
+            self.tracer.record('queue', time.perf_counter() - token[1])
+        attempt = 0
+        while True:
+            try:
+                r = f(arg)
+            except Exception as e:
+                throttled = is_throttle(e)
+                if throttled and key is not None:
+                    self.prefix_throttled(key_prefix(key, self.prefix_depth))
+                attempt += 1
+                if not is_transient(e) or attempt > self.max_retries or not self.retry_budget.spend():
+                    self.concurrency.release(token, throttled=throttled)
+                    raise
+                # the slot is kept through the backoff: acquiring another one here would wait for
+                # tasks queued behind the workers of the pool, which are all waiting the same way
+                self.concurrency.keep(token, throttled)
+                delay = random.uniform(0, min(20.0, 0.05 * 2 ** attempt))
+                self.log.info('retry %s of %s in %.2fs after %s', attempt, arg, delay, e)
+                time.sleep(delay)
+                token = self.concurrency.renew()
+                continue
+            self.concurrency.release(token)
+            self.retry_budget.earn()
+            return r
+
+    def prefix_throttled(self, prefix):
+        with self.concurrency.cond:
+            self.throttled_prefixes[prefix] += 1
+            self.throttled_at[prefix] = time.monotonic()
+
+    def prefix_cooling(self, prefix, cooldown=1.0):
+        """True when the prefix was throttled in the last cooldown seconds"""
+        t = self.throttled_at.get(prefix)
+        return t is not None and time.monotonic() - t < cooldown
+
+    def run(self, f, arg, key=None):
+        """runs one task on the calling thread, retried like the tasks of dispatch"""
+        return self.run_task(f, arg, key, self.concurrency.acquire())
+
     def cp(self, args):
         src, dst = args
         return self.generic_ops.generic_copy(src, dst)
 
+    def counted(self, f, outcome):
+        """the task f, recording the objects and bytes of its successful calls in the report of the operation,
+        with the latency of the copies"""
+        report = self.report
+
+        def run(arg):
+            count = _task_objects(arg)
+            start = time.perf_counter()
+            r = f(arg)
+            if outcome == 'copied':
+                src, dst = arg
+                size = src.size if isinstance(dst, dict) else _copied_size(src, dst)
+                report.add(outcome, count, (size or 0) * count, time.perf_counter() - start)
+            else:
+                keys = arg if isinstance(arg, list) else arg[1]
+                report.add(outcome, count, sum(k.size or 0 for k in keys))
+            return r
+        return run
+
     def generic_copy_file(self, src, dst):
-        self.generic_ops.generic_copy(src, dst)
+        self.sides(src, dst)
+        try:
+            with self.report.phase('transfer'):
+                copy = self.counted(self.cp, 'copied')
+                if 'stream' in (src.get_type(), dst.get_type()):
+                    # read or written once, only the parts are retried, by the transfer manager
+                    copy((src, dst))
+                else:
+                    self.run(copy, (src, dst))
+        finally:
+            report = self.finish()
+        return report
 
     def generic_copy_tree(self, src_root, dst_root, sync=False):
+        self.sides(src_root, dst_root)
+        try:
+            self._generic_copy_tree(src_root, dst_root, sync)
+        finally:
+            report = self.finish()
+        return report
+
+    def _generic_copy_tree(self, src_root, dst_root, sync):
         self.log.info('generic copy tree %s, %s, sync=%s', src_root, dst_root, sync)
+        state = since = None
+        if self.incremental:
+            if src_root is None or src_root.get_type() != 'fs' or dst_root.get_type() != 's3' or self.shard:
+                raise ValueError(f'incremental runs copy a local directory to s3 without shards, '
+                                 f'not {src_root} to {dst_root}')
+            state = HighWaterMark(self.incremental, src_root, dst_root, self.key_filter)
+            since = state.load()
+            started = time.time()
+        if since is None:
+            actions = self.diff(src_root, dst_root, sync)
+        else:
+            self.log.info('copying what changed since %s', time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(since)))
+            actions = self.incremental_actions(src_root, dst_root, since, sync)
+        self.execute_actions(src_root, dst_root, actions)
+        if self.verify and src_root is not None:
+            with self.report.phase('verify'):
+                report = self.verify_tree(src_root, dst_root, 1.0 if self.verify == 'full' else self.verify)
+            if report.mismatched:
+                raise VerifyError(report)
+        if state is not None:
+            state.save(started)
+
+    def incremental_actions(self, src_root, dst_root, since, sync):
+        path = src_root.get_path()
+        if not isdir(path):
+            return
+        for x in self.generic_ops.walk_changed(path, dst_root, since, key_filter=self.key_filter):
+            if sync or x[1] == 'copy':
+                yield x
+
+    def fan_out_tree(self, src_root, dst_roots, sync=False):
+        """copies or syncs src_root to every destination of dst_roots, each with its own diff.
+        The source is listed once and every file copied to any of them is read once, see GenericOps.fan_out"""
+        for dst_root in dst_roots:
+            self.sides(src_root, dst_root)
+        try:
+            self._fan_out_tree(src_root, dst_roots, sync)
+        finally:
+            report = self.finish()
+        return report
+
+    def _fan_out_tree(self, src_root, dst_roots, sync):
+        self.log.info('fan out %s to %s, sync=%s', src_root, ', '.join(map(str, dst_roots)), sync)
+        if self.incremental:
+            raise ValueError('incremental runs copy to a single destination')
+        manifests = self.failure_manifest or [None] * len(dst_roots)
+        if isinstance(manifests, str) or len(manifests) != len(dst_roots):
+            raise ValueError(f'with {len(dst_roots)} destinations failure_manifest is a list of as many paths')
+        actions = self.ordered(self.fan_out_diff(src_root, dst_roots, sync), src_root, True)
+        reports = [FailureReport(src_root, dst_root, manifest, self.fail_fast)
+                   for dst_root, manifest in zip(dst_roots, manifests)]
+        report = FanOutReport(reports)
+        try:
+            self.run_tasks(self.fan_out_tasks(src_root, dst_roots, actions), report)
+        finally:
+            report.close()
+            for r in reports:
+                self.report.add('failed', r.count, r.bytes)
+        failed = [r for r in reports if r.count]
+        if failed:
+            for r in failed:
+                self.log.warning('%s to %s', r, r.dst_root)
+            raise TransferError(failed[0], failed[1:]) from failed[0].first_exception
+        if self.verify:
+            for dst_root in dst_roots:
+                with self.report.phase('verify'):
+                    report = self.verify_tree(src_root, dst_root, 1.0 if self.verify == 'full' else self.verify)
+                if report.mismatched:
+                    raise VerifyError(report)
+
+    def fan_out_diff(self, src_root, dst_roots, sync):
+        """merges the diffs of src_root with every destination into
+        (relative key, [(index, action, size on that side)], size, mtime of the source) tuples in key order,
+        the listing of the source is shared by the diffs"""
+        start, end = self.shard_range(src_root)
+        listings = itertools.tee(self.list_side(src_root, self.src_inventory, start, end), len(dst_roots))
+
+        def tagged(index, actions):
+            for key, action, size, mtime in actions:
+                yield key, index, action, size, mtime
+
+        diffs = [tagged(i, self.diff(src_root, dst_root, sync, listing))
+                 for i, (dst_root, listing) in enumerate(zip(dst_roots, listings))]
+        for key, group in itertools.groupby(heapq.merge(*diffs, key=lambda x: x[0]), lambda x: x[0]):
+            group = list(group)
+            size, mtime = next(((x[3], x[4]) for x in group if x[2] == 'copy'), (None, None))
+            yield key, [(index, action, side_size) for _, index, action, side_size, _ in group], size, mtime
+
+    def fan_out_tasks(self, src_root, dst_roots, actions):
+        """one copy task per key to all the destinations missing it, deletes are batched per destination"""
+        deletes = [[] for _ in dst_roots]
+        first_deletes = [None] * len(dst_roots)
+        cp, rm = self.counted(self.fan_out_cp, 'copied'), self.counted(self.fan_out_rm, 'deleted')
+        for key, targets, size, _ in actions:
+            copies = {dst_roots[i].join(key): i for i, action, _ in targets if action == 'copy'}
+            if copies:
+                yield cp, (src_root.join(key, size), copies), key
+            for i, action, dst_size in targets:
+                if action != 'delete':
+                    continue
+                if not deletes[i]:
+                    first_deletes[i] = key
+                deletes[i].append(dst_roots[i].join(key, dst_size))
+                if len(deletes[i]) == dst_roots[i].delete_batch_size():
+                    yield rm, (i, deletes[i]), first_deletes[i]
+                    deletes[i] = []
+        for i, batch in enumerate(deletes):
+            if batch:
+                yield rm, (i, batch), first_deletes[i]
+
+    def fan_out_cp(self, args):
+        src, dsts = args
+        return self.generic_ops.fan_out(src, dsts)
+
+    def fan_out_rm(self, args):
+        index, keys = args
+        return self.generic_ops.rm_generic(keys)
+
+    def verify_tree(self, src_root, dst_root, sample=1.0):
+        """compares the stored checksums of the keys on both sides, or of a random sample of them"""
+        self.sides(src_root, dst_root)
+        report = VerifyReport()
+        both = (x[0] for x in self.compare(src_root, dst_root, True) if x[1] == 'skip')
+        if sample < 1:
+            both = (key for key in both if random.random() < sample)
+
+        def verify_one(key):
+            result = self.generic_ops.matches(src_root.join(key), dst_root.join(key))
+            if result != 'ok':
+                self.log.warning('%s %s', key, result)
+            report.add(key, result)
+
+        with self.tp() as tp:
+            self.dispatch(tp, ((verify_one, key, key) for key in both))
+        self.log.info('verified %s', report)
+        return report
+
+    def diff(self, src_root, dst_root, sync, src_keys=None):
+        """lazily merges the listings of both sides into (relative key, action, size, mtime) tuples,
+        action is copy or delete, keys that exist on both sides are skipped. The size and mtime are
+        of the source for copies, of the destination for deletes"""
+        report = self.report
+
+        def changed(x):
+            if x[1] == 'skip':
+                report.add('skipped', 1, x[2])
+                return False
+            return True
+
+        without_skip = filter(changed, self.compare(src_root, dst_root, sync, src_keys))
+        return debug_iterator('Without skip', without_skip)
+
+    def compare(self, src_root, dst_root, sync, src_keys=None):
+        """the diff including the keys on both sides, with the action skip. src_keys is the listing of
+        src_root when it was already made"""
         assert issubclass(type(src_root), generic_path) or src_root is None
         assert issubclass(type(dst_root), generic_path)
 
+        if src_root is None and self.shard is not None and self.shard_mode == 'range' and self.shard_boundaries is None:
+            # computed from the tree, the boundaries would move while the other workers delete it
+            raise ValueError("deleting a range shard needs shard_boundaries, or shard_mode='hash'")
+        start, end = self.shard_range(src_root or dst_root)
+
         if src_root is None:
             self.log.info('Src is root, we are deleting dst')
             src_keys = self.empty_iterator()
-        else:
-            src_keys = self.generic_ops.generic_list(src_root)
+        elif src_keys is None:
+            src_keys = self.list_side(src_root, self.src_inventory, start, end)
 
         if sync:
-            dst_keys = self.generic_ops.generic_list(dst_root)
+            dst_keys = self.list_side(dst_root, self.dst_inventory, start, end)
         else:
             dst_keys = self.empty_iterator()
 
         src_keys = debug_iterator('Source Keys', src_keys)
         dst_keys = debug_iterator('Dest Keys  ', dst_keys)
 
-        rel_src_keys = map(lambda src_key: src_key.relative(src_root), src_keys)
-        rel_dst_keys = map(lambda dst_key: dst_key.relative(dst_root), dst_keys)
+        src_tagged = map(lambda x: (x[0], 'src', x[1], x[2]), src_keys)
+        dst_tagged = map(lambda x: (x[0], 'dst', x[1], x[2]), dst_keys)
 
-        src_tagged = map(lambda x:(x, 'src'), rel_src_keys)
-        dst_tagged = map(lambda x:(x, 'dst'), rel_dst_keys)
+        if self.shard is not None and self.shard_mode == 'hash':
+            index, count = self.shard
+            src_tagged = filter(lambda x: shard_of_key(x[0], count) == index, src_tagged)
+            dst_tagged = filter(lambda x: shard_of_key(x[0], count) == index, dst_tagged)
 
         merged = heapq.merge(src_tagged, dst_tagged, key=lambda x: x[0])
         grouped = itertools.groupby(merged, lambda x:x[0])
 
-        grouped = map(lambda x: (x[0], tuple((y[1] for y in x[1]))), grouped)
+        grouped = map(lambda x: (x[0], tuple(x[1])), grouped)
         actions = {
             ('src', 'dst'): 'skip',
             ('src',): 'copy',
             ('dst',): 'delete'
         }
 
-        with_action = map(lambda x: (x[0], actions[x[1]]), grouped)
-        with_action = debug_iterator('With action', with_action)
-
-        without_skip = filter(lambda x:x[1] != 'skip', with_action)
-
-        without_skip = debug_iterator('Without skip', without_skip)
-
-        t1, t2 = itertools.tee(without_skip)
-
-        cp = filter(lambda x:x[1] == 'copy', t1)
+        with_action = map(lambda x: (x[0], actions[tuple(y[1] for y in x[1])], x[1][0][2], x[1][0][3]), grouped)
+        with_action = self.tracer.timed_iterator('diff', with_action)
+        return debug_iterator('With action', with_action)
+
+    def list_side(self, root, inventory, start, end):
+        if inventory is None or self.check_inventory:
+            return self.generic_ops.list_keys(root, start, end, self.key_filter)
+        return self.list_inventory(root, inventory, start, end)
+
+    def list_inventory(self, root, manifest, start, end):
+        """the (relative key, size, mtime) under root in an S3 Inventory report, like list_keys,
+        the mtimes are not read"""
+        if root.get_type() != 's3':
+            raise ValueError(f'an inventory can only list s3, not {root}')
+        bucket, prefix = root.get_path()
+        inventory = Inventory(manifest, self.generic_ops.list_client(root))
+        if inventory.bucket != bucket:
+            raise ValueError(f'the inventory {manifest} is of the bucket {inventory.bucket}, not {bucket}')
+        self.log.info('listing %s from the inventory of %s', root,
+                      time.strftime('%Y-%m-%d %H:%M', time.gmtime(inventory.created)))
+        for key, size in self.tracer.timed_iterator('inventory', inventory.objects(prefix)):
+            rel = key[len(prefix):]
+            if start and rel < start:
+                continue
+            if end is not None and rel >= end:
+                return
+            if self.key_filter is not None and not self.key_filter.match(rel):
+                continue
+            yield rel, size, None
+
+    def inventory_cp(self, cp, args):
+        """a copy from an inventory, whose source may have been deleted since the report"""
+        try:
+            return cp(args)
+        except Exception as e:
+            if error_code(e)[1] != 404:
+                raise
+            self.log.info('%s was deleted since the inventory', args[0])
+            self.report.add('skipped')
+
+    def shard_range(self, root):
+        """[start, end) relative keys of this engine's shard in range mode, (None, None) means everything.
+        Every worker computes the same boundaries from the entries of the first levels of root"""
+        if self.shard is None or self.shard_mode != 'range':
+            return None, None
+        index, count = self.shard
+        boundaries = self.shard_boundaries
+        if boundaries is None:
+            boundaries = self.compute_shard_boundaries(root, count)
+        if len(boundaries) != count - 1:
+            raise ValueError(f'{count} shards need {count - 1} boundaries, got {len(boundaries)}')
+        boundaries = [None] + list(boundaries) + [None]
+        start, end = boundaries[index], boundaries[index + 1]
+        self.log.info('shard %s of %s is [%s, %s)', index, count, start, end)
+        return start, end
+
+    def compute_shard_boundaries(self, root, count, versions=False):
+        """count - 1 relative keys splitting the entries of root in ranges of about the same number of entries,
+        the same in every worker as long as root does not change"""
+        names = self.shard_candidates(root, count, versions=versions)
+        if not names:
+            return [''] * (count - 1)
+        return [names[k * len(names) // count] for k in range(1, count)]
+
+    def shard_candidates(self, root, count, max_depth=3, versions=False):
+        """entries of the first level of root, directories are replaced by their own entries
+        level after level until there are enough of them to balance count shards.
+        Directories the filters exclude are left out"""
+        names = self.unpruned(self.generic_ops.list_first_level(root, versions))
+        depth = 1
+        while len(names) < 8 * count and depth < max_depth:
+            expanded = []
+            for name in names:
+                if name[-1] == '/':
+                    children = self.generic_ops.list_first_level(root.join(name), versions)
+                    children = self.unpruned(name + child for child in children)
+                    expanded += children or [name]
+                else:
+                    expanded.append(name)
+            if len(expanded) == len(names):
+                break
+            names = expanded
+            depth += 1
+        return names
+
+    def unpruned(self, names):
+        if self.key_filter is None:
+            return list(names)
+        return [name for name in names if name[-1] != '/' or not self.key_filter.prune_dir(name)]
+
+    def disk_usage(self, root, parallelism=16):
+        """totals of the tree under root, listed in parallel key ranges, only totals are kept in memory"""
+        self.sides(root, None)
+        boundaries = [None] + self.compute_shard_boundaries(root, parallelism) + [None]
+        ranges = sorted(set(zip(boundaries[:-1], boundaries[1:])), key=lambda r: r[0] or '')
+
+        def usage_of_range(r):
+            usage = DiskUsage()
+            for key, size, _ in self.generic_ops.list_keys(root, *r, self.key_filter):
+                usage.add(key, size)
+            return usage
 
-        cp_keys = map(lambda x:x[0], cp)
-        cp_params = map(lambda x: (src_root.join(x), dst_root.join(x)), cp_keys)
-        cp_params = debug_iterator('Upload params', cp_params)
-
-
-        deletes = filter(lambda x:x[1] == 'delete', t2)
-        delete_keys = map(lambda x:x[0], deletes)
-        delete_keys = debug_iterator('Deletes', delete_keys)
-        delete_absolute = map(dst_root.join, delete_keys)
-        delete_batched = itertools_batched(delete_absolute, 1000)
-        delete_batched = debug_iterator('delete batched', delete_batched)
+        from concurrent.futures import ThreadPoolExecutor
+        try:
+            with ThreadPoolExecutor(max_workers=parallelism, thread_name_prefix='du') as tp:
+                return functools.reduce(DiskUsage.merge, tp.map(usage_of_range, ranges), DiskUsage())
+        finally:
+            self.finish()
+
+    def purge(self, root, parallelism=16):
+        """deletes every version and delete marker under the s3 root, what rmtree leaves behind in versioned
+        buckets. Key ranges are listed in parallel and deleted in batches of 1000 through the dispatcher"""
+        if root.get_type() != 's3':
+            raise ValueError(f'only s3 has versions, not {root}')
+        self.sides(None, root)
+        bucket, prefix = root.get_path()
+        boundaries = [None] + self.compute_shard_boundaries(root, parallelism, versions=True) + [None]
+        ranges = sorted(set(zip(boundaries[:-1], boundaries[1:])), key=lambda r: r[0] or '')
+        report = PurgeReport()
+        batches = queue.Queue(maxsize=2 * parallelism)
+        stopped = threading.Event()
+
+        def put(item):
+            """False when the deletes stopped after a failure"""
+            while not stopped.is_set():
+                try:
+                    batches.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def list_range(r):
+            try:
+                batch = []
+                for key, version_id, size in self.generic_ops.list_versions(root, *r):
+                    rel = key[len(prefix):]
+                    if self.key_filter is not None and not self.key_filter.match(rel):
+                        continue
+                    if self.shard is not None and shard_of_key(rel, self.shard[1]) != self.shard[0]:
+                        continue
+                    batch.append(({'Key': key, 'VersionId': version_id}, size))
+                    if len(batch) == 1000:
+                        if not put(batch):
+                            return
+                        batch = []
+                if batch:
+                    put(batch)
+            finally:
+                put(None)
+
+        def tasks():
+            remaining = len(ranges)
+            while remaining:
+                batch = batches.get()
+                if batch is None:
+                    remaining -= 1
+                    continue
+                yield delete_batch, batch, batch[0][0]['Key'][len(prefix):]
+
+        def delete_batch(batch):
+            self.generic_ops.rm_versions(root, [obj for obj, _ in batch])
+            report.add(batch, self.log)
 
+        from concurrent.futures import ThreadPoolExecutor
+        try:
+            with ThreadPoolExecutor(max_workers=parallelism, thread_name_prefix='versions') as listers:
+                listed = [listers.submit(list_range, r) for r in ranges]
+                try:
+                    with self.tp() as tp:
+                        self.dispatch(tp, tasks())
+                finally:
+                    stopped.set()
+                for future in listed:
+                    future.result()
+            self.log.info('purged %s', report)
+            return report
+        finally:
+            self.finish()
+
+    def execute_actions(self, src_root, dst_root, actions):
+        """runs (relative key, action, size, mtime) tuples, as produced by diff or read from a plan"""
+        actions = self.ordered(actions, src_root, 's3' in (dst_root.get_type(), src_root and src_root.get_type()))
+
+        dedup = None
+        if self.dedup and src_root is not None and src_root.get_type() == 'fs' and dst_root.get_type() == 's3':
+            dedup = Deduplicator(self.generic_ops, self.dedup)
+        tasks = self.tasks(src_root, dst_root, actions, dedup)
+
+        report = FailureReport(src_root, dst_root, self.failure_manifest, self.fail_fast)
+        try:
+            self.run_tasks(tasks, report)
+        finally:
+            report.close()
+            self.report.add('failed', report.count, report.bytes)
+        if dedup is not None:
+            self.log.info('%s', dedup)
+        if report.count:
+            self.log.warning('%s', report)
+            raise TransferError(report) from report.first_exception
+
+    def ordered(self, actions, src_root, s3):
+        """the actions of a tree operation reordered within windows of spread_window, see order"""
+        if not self.spread_window or self.order == 'key':
+            return actions
+        if self.order == 'spread':
+            if not s3:
+                return actions
+            return spread_by_prefix(actions, lambda x: key_prefix(x[0], self.prefix_depth),
+                                    self.spread_window, self.prefix_cooling)
+        if callable(self.order):
+            sort_key = self.order
+        elif self.order == 'largest':
+            sort_key = lambda x: -(x[2] or 0)
+        elif self.order == 'smallest':
+            sort_key = lambda x: x[2] or 0
+        elif self.order == 'newest':
+            sort_key = lambda x: -(x[3] or 0)
+        else:
+            sort_key = functools.partial(self.locality, src_root)
+        return order_within_window(actions, sort_key, self.spread_window)
+
+    def locality(self, src_root, x):
+        """the directory of a key, then the inode of a local source, about where its data is on the disk"""
+        key = x[0]
+        directory = key.rpartition('/')[0]
+        if src_root is None or src_root.get_type() != 'fs' or x[1] == 'delete':
+            return directory, 0
+        try:
+            return directory, os.stat(src_root.join(key).get_path()).st_ino
+        except OSError:
+            return directory, 0
+
+    def run_tasks(self, tasks, failures):
+        """dispatches the copies and deletes of a tree operation, the time spent listing and diffing to produce
+        them is the list phase of the report, the rest the transfer phase"""
+        listed = self.report.phases['list']
+        start = time.perf_counter()
         with self.tp() as tp:
-            self.log.info('submitting deletes')
-            del_r = tp.map(self.generic_ops.rm_generic, delete_batched)
-            self.log.info('submitting copies')
-            cp_r = tp.map(self.cp, cp_params)
-            self.exhaust_iterator(itertools.chain(cp_r, del_r))
-
-
-def tree_sync(src, dst):
+            self.log.info('submitting copies and deletes')
+            self.dispatch(tp, self.report.timed('list', tasks), failures)
+        self.report.add_phase('transfer', time.perf_counter() - start - (self.report.phases['list'] - listed))
+
+    def plan(self, src_root, dst_root, sync, path=None):
+        plan = TransferPlan(_path_str(src_root), _path_str(dst_root), sync, path)
+        self.sides(src_root, dst_root)
+        try:
+            return plan.write(self.diff(src_root, dst_root, sync))
+        finally:
+            self.finish()
+
+    def execute(self, plan):
+        src_root, dst_root = _parse_optional(plan.src), generic_parse_path(plan.dst)
+        self.sides(src_root, dst_root)
+        try:
+            self.execute_actions(src_root, dst_root, plan.actions())
+        finally:
+            report = self.finish()
+        return report
+
+    def tasks(self, src_root, dst_root, actions, dedup=None):
+        """turns (relative key, action) pairs into (f, arg, key) tasks, deletes are batched"""
+        batch_size = dst_root.delete_batch_size()
+        cp, rm = self.cp, self.generic_ops.rm_generic
+        if dedup is not None:
+            cp = dedup.cp
+        cp, rm = self.counted(cp, 'copied'), self.counted(rm, 'deleted')
+        if self.src_inventory and not self.check_inventory:
+            cp = functools.partial(self.inventory_cp, cp)
+        deletes = []
+        first_delete = None
+        for key, action, size, _ in actions:
+            if action == 'copy':
+                yield cp, (src_root.join(key, size), dst_root.join(key)), key
+            elif action == 'delete':
+                if not deletes:
+                    first_delete = key
+                deletes.append(dst_root.join(key, size))
+                if len(deletes) == batch_size:
+                    yield rm, deletes, first_delete
+                    deletes = []
+        if deletes:
+            yield rm, deletes, first_delete
+
+
+def _path_str(path):
+    """the string a path was parsed from"""
+    if path is None:
+        return None
+    if path.get_type() == 's3':
+        return str(path)
+    return path.get_path()
+
+
+def _parse_optional(path):
+    return None if path is None else generic_parse_path(path)
+
+
+def plan(src, dst, path=None, sync=True, **options):
+    """Lists and diffs src and dst without transferring anything.
+    Returns a TransferPlan with totals and estimates, when path is given
+    the actions are streamed there so that execute() can run them later without listing again.
+    src None plans the deletion of dst"""
+    e = Engine(**options)
+    return e.plan(_parse_optional(src), generic_parse_path(dst), sync, path)
+
+
+def execute(plan, **options):
+    """runs a plan written by plan(), plan is a TransferPlan or the path of a plan file. Returns a TransferReport"""
+    if not isinstance(plan, TransferPlan):
+        plan = TransferPlan.load(plan)
+    e = Engine(**options)
+    return e.execute(plan)
+
+
+def shard_boundaries(src, count, **options):
+    """computes once the boundaries of count range shards of src, to pass as shard_boundaries to the workers"""
+    e = Engine(**options)
+    root = generic_parse_path(src)
+    e.sides(root, None)
+    return e.compute_shard_boundaries(root, count)
+
+
+def tree_sync(src, dst, **options):
+    """dst may be a list of destinations, see Engine.fan_out_tree"""
     src_path = generic_parse_path(src)
-    dst_path = generic_parse_path(dst)
 
-    e = Engine()
-    e.generic_copy_tree(src_path, dst_path, sync=True)
+    e = Engine(**options)
+    if isinstance(dst, (list, tuple)):
+        return e.fan_out_tree(src_path, [generic_parse_path(d) for d in dst], sync=True)
+    return e.generic_copy_tree(src_path, generic_parse_path(dst), sync=True)
 
 
-def tree_copy(src, dst):
+def tree_copy(src, dst, **options):
+    """dst may be a list of destinations, see Engine.fan_out_tree"""
     src_path = generic_parse_path(src)
-    dst_path = generic_parse_path(dst)
 
-    e = Engine()
-    e.generic_copy_tree(src_path, dst_path, sync=False)
+    e = Engine(**options)
+    if isinstance(dst, (list, tuple)):
+        return e.fan_out_tree(src_path, [generic_parse_path(d) for d in dst], sync=False)
+    return e.generic_copy_tree(src_path, generic_parse_path(dst), sync=False)
 
 
-def tree_rm(src):
+def tree_rm(src, versions=False, **options):
+    """deletes the tree under src and returns a TransferReport. In a versioned bucket, versions=True deletes all
+    the versions and delete markers too, instead of adding delete markers, and returns a PurgeReport"""
     src_path = generic_parse_path(src)
 
-    e = Engine()
-    e.generic_copy_tree(None, src_path, sync=True)
-
-
-def tree_move(src, dst):
-    tree_copy(src, dst)
-    if _is_s3(src):
-        tree_rm(src)
+    e = Engine(**options)
+    if versions:
+        return e.purge(src_path)
+    return e.generic_copy_tree(None, src_path, sync=True)
+
+
+# the options of a move that also apply to deleting its source
+_MOVE_RM_OPTIONS = ('tracer', 'concurrency', 'max_concurrency', 'max_retries', 'spread_window', 'prefix_depth',
+                    'shard', 'shard_mode', 'shard_boundaries', 'include', 'exclude', 'fail_fast', 'order')
+
+
+def _move_rm_options(options):
+    """the options of deleting the source of a move: how its keys are selected and its endpoint,
+    the tree deleted is on the dst side of tree_rm"""
+    rm = {k: v for k, v in options.items() if k in _MOVE_RM_OPTIONS}
+    if options.get('src_endpoint'):
+        rm['dst_endpoint'] = options['src_endpoint']
+    return rm
+
+
+def tree_move(src, dst, **options):
+    """returns the TransferReport of the copy. With include, exclude or shard, only the keys they select
+    are deleted from src, like they were the only ones copied"""
+    if options.get('src_inventory') and not options.get('check_inventory'):
+        # the delete lists src, it would remove the objects written since the report without copying them
+        raise ValueError('a move from an inventory needs check_inventory')
+    if not options.get('tracer'):
+        # one tracer for both phases, a profile from S3SHUTIL_PROFILE would only show the delete
+        options = dict(options, tracer=default_tracer())
+    shard = options.get('shard')
+    if shard and options.get('shard_mode', 'range') == 'range' and options.get('shard_boundaries') is None:
+        # computed once, so that the copy and the delete of the source select the same range
+        src_options = {k: v for k, v in options.items() if k in ('src_endpoint', 'include', 'exclude')}
+        options = dict(options, shard_boundaries=shard_boundaries(src, shard[1], **src_options))
+    report = tree_copy(src, dst, **options)
+    if _is_s3(src) or any(options.get(o) for o in ('include', 'exclude', 'shard')):
+        tree_rm(src, **_move_rm_options(options))
     else:
         shutil.rmtree(src)
+    return report
 
 
-def copyfile(src, dst):
+def copyfile(src, dst, **options):
     src_path = generic_parse_path(src)
     dst_path = generic_parse_path(dst)
 
-    e = Engine()
-    e.generic_copy_file(src_path, dst_path)
-
-def copy(src, dst):
+    e = Engine(**options)
+    return e.generic_copy_file(src_path, dst_path)
+
+def copyfileobj(src, dst, **options):
+    """Like shutil.copyfileobj between an open binary file object and an s3 object: one of src and dst is
+    the file object, the other an s3:// url. Streams of unknown length are uploaded in parts, a bounded number
+    of them in memory. Downloads are ranged GETs in parallel written in order from the current position"""
+    src_path = generic_parse_path(src) if isinstance(src, str) else stream_path(src)
+    dst_path = generic_parse_path(dst) if isinstance(dst, str) else stream_path(dst)
+    if 's3' not in (src_path.get_type(), dst_path.get_type()):
+        raise ValueError(f'copyfileobj copies to or from s3, not {src} to {dst}')
+    e = Engine(**options)
+    return e.generic_copy_file(src_path, dst_path)
+
+def copy(src, dst, **options):
     src_path = generic_parse_path(src)
     dst_path = generic_parse_path(dst)
 
@@ -425,11 +2917,23 @@ def copy(src, dst):
             joined = join(path, basename)
             dst_path = fs_path(joined)
 
-    e = Engine()
-    e.generic_copy_file(src_path, dst_path)
+    e = Engine(**options)
+    return e.generic_copy_file(src_path, dst_path)
+
+def verify(src, dst, sample=1.0, **options):
+    """compares the checksums stored in s3, or computed for local files, of the keys in both trees.
+    Nothing is downloaded, sample checks a random fraction of the keys. Returns a VerifyReport"""
+    e = Engine(**options)
+    try:
+        return e.verify_tree(generic_parse_path(src), generic_parse_path(dst), sample)
+    finally:
+        e.finish()
+
 
-def disk_usage(src):
-    pass
+def disk_usage(src, parallelism=16, **options):
+    """sizes a tree in s3 or in the file system, returns a DiskUsage"""
+    e = Engine(**options)
+    return e.disk_usage(generic_parse_path(src), parallelism)
 
 copy2 = copy
 
@@ -0,0 +1,249 @@
+import os
+import json
+import time
+import heapq
+import logging
+import threading
+import itertools
+
+log = logging.getLogger('s3shutil.trace')
+
+
+class StageStats:
+    """aggregated timings of all the spans of one stage"""
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.self_total = 0.0
+        self.min = None
+        self.max = 0.0
+        self.slowest = []
+
+    def add(self, duration, self_time, attrs, keep):
+        self.count += 1
+        self.total += duration
+        self.self_total += self_time
+        if self.min is None or duration < self.min:
+            self.min = duration
+        if duration > self.max:
+            self.max = duration
+        if keep:
+            item = (duration, next(_tiebreak), attrs)
+            if len(self.slowest) < keep:
+                heapq.heappush(self.slowest, item)
+            elif duration > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, item)
+
+    def to_dict(self):
+        return {
+            'stage': self.name,
+            'count': self.count,
+            'total': self.total,
+            'self': self.self_total,
+            'min': self.min or 0.0,
+            'max': self.max,
+            'avg': self.total / self.count if self.count else 0.0,
+            'slowest': [{'duration': d, **a} for d, _, a in sorted(self.slowest, reverse=True)],
+        }
+
+
+_tiebreak = itertools.count()
+
+
+class Span:
+    __slots__ = ('tracer', 'name', 'attrs', 'start', 'child_time', 'otel_span')
+
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.child_time = 0.0
+        self.otel_span = None
+
+    def __enter__(self):
+        self.tracer._push(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        self.tracer._pop(self, duration, exc)
+        return False
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+
+class _NullSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+_null_span = _NullSpan()
+
+
+class NullTracer:
+    """the tracer used when tracing is disabled, every method is a no-op"""
+
+    enabled = False
+
+    def span(self, name, **attrs):
+        return _null_span
+
+    def record(self, name, duration, **attrs):
+        pass
+
+    def timed_iterator(self, name, it, **attrs):
+        return it
+
+    def finish(self):
+        pass
+
+
+class Tracer:
+    """Records spans per stage (list, diff, queue, transfer, delete) and per object
+
+    Only aggregates and the slowest `keep_slowest` spans of every stage are kept in memory,
+    so tracing a run of millions of objects costs constant memory.
+
+    profile: when True, a breakdown is logged at the end of each operation,
+             when a path, the breakdown is written there as json.
+             It covers every operation traced so far, both phases of a move for example
+    otel:    export every span to OpenTelemetry, requires the opentelemetry-api package
+    """
+
+    enabled = True
+
+    def __init__(self, profile=False, otel=False, keep_slowest=10):
+        self.profile = profile
+        self.keep_slowest = keep_slowest
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = time.perf_counter()
+        self.otel_tracer = None
+        self.otel_root = None
+        self.otel_context = None
+        if otel:
+            self._init_otel()
+
+    def _init_otel(self):
+        try:
+            from opentelemetry import trace
+        except ImportError as e:
+            raise ImportError('otel=True requires the opentelemetry-api package') from e
+        self.otel_tracer = trace.get_tracer('s3shutil')
+        self.otel_root = self.otel_tracer.start_span('s3shutil')
+        self.otel_context = trace.set_span_in_context(self.otel_root)
+
+    def _stack(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def _push(self, span):
+        self._stack().append(span)
+        if self.otel_tracer is not None:
+            span.otel_span = self.otel_tracer.start_span(span.name, context=self.otel_context,
+                                                         attributes=_otel_attrs(span.attrs))
+
+    def _pop(self, span, duration, exc=None):
+        stack = self._stack()
+        stack.pop()
+        if stack:
+            stack[-1].child_time += duration
+        self._add(span.name, duration, duration - span.child_time, span.attrs)
+        if span.otel_span is not None:
+            if exc is not None:
+                span.otel_span.record_exception(exc)
+            span.otel_span.set_attributes(_otel_attrs(span.attrs))
+            span.otel_span.end()
+
+    def _add(self, name, duration, self_time, attrs):
+        with self.lock:
+            stats = self.stages.get(name)
+            if stats is None:
+                stats = self.stages[name] = StageStats(name)
+            stats.add(duration, self_time, attrs, self.keep_slowest)
+
+    def span(self, name, **attrs):
+        return Span(self, name, attrs)
+
+    def record(self, name, duration, **attrs):
+        """records a span timed elsewhere, for example time spent waiting in a queue"""
+        self._add(name, duration, duration, attrs)
+        if self.otel_tracer is not None:
+            end = time.time_ns()
+            s = self.otel_tracer.start_span(name, context=self.otel_context, attributes=_otel_attrs(attrs),
+                                            start_time=end - int(duration * 1e9))
+            s.end(end_time=end)
+
+    def timed_iterator(self, name, it, **attrs):
+        """times every next() on a lazy iterator, time of nested spans
+        (for example the listing feeding a diff) is excluded from the self time"""
+        it = iter(it)
+        while True:
+            span = Span(self, name, attrs)
+            span.__enter__()
+            try:
+                x = next(it)
+            except StopIteration:
+                span.__exit__(None, None, None)
+                return
+            except BaseException as e:
+                span.__exit__(type(e), e, None)
+                raise
+            span.__exit__(None, None, None)
+            yield x
+
+    def breakdown(self):
+        with self.lock:
+            stages = [s.to_dict() for s in self.stages.values()]
+        stages.sort(key=lambda s: s['self'], reverse=True)
+        return {'wall': time.perf_counter() - self.started, 'stages': stages}
+
+    def format_breakdown(self):
+        b = self.breakdown()
+        lines = [f'wall time {b["wall"]:.3f}s',
+                 f'{"stage":<16}{"count":>10}{"total":>12}{"self":>12}{"avg":>12}{"max":>12}']
+        for s in b['stages']:
+            lines.append(f'{s["stage"]:<16}{s["count"]:>10}{s["total"]:>12.3f}{s["self"]:>12.3f}'
+                         f'{s["avg"]:>12.6f}{s["max"]:>12.6f}')
+        for s in b['stages']:
+            for slow in s['slowest'][:3]:
+                lines.append(f'  slowest {s["stage"]}: {slow}')
+        return '\n'.join(lines)
+
+    def finish(self):
+        """called at the end of every operation, dumps the breakdown in profile mode"""
+        if self.profile is True:
+            log.info('profile breakdown\n%s', self.format_breakdown())
+        elif self.profile:
+            with open(self.profile, 'w') as f:
+                json.dump(self.breakdown(), f, indent=2, default=str)
+        if self.otel_root is not None:
+            self.otel_root.end()
+            self._init_otel()
+
+
+def _otel_attrs(attrs):
+    return {k: v if isinstance(v, (str, bool, int, float)) else str(v) for k, v in attrs.items()}
+
+
+def default_tracer():
+    """a profiling tracer when S3SHUTIL_PROFILE is set (1 logs, anything else is a json path),
+    otherwise the no-op tracer"""
+    profile = os.environ.get('S3SHUTIL_PROFILE')
+    if not profile:
+        return NullTracer()
+    return Tracer(profile=True if profile == '1' else profile)
@@ -0,0 +1,460 @@
+"""Continuous replication, see watch()
+
+Changes of a local directory are found with inotify on Linux, or by walking the directory every few seconds
+elsewhere, so after the initial sync nothing is listed in the destination except when a directory is deleted.
+Changes of an s3 prefix are read from its event notifications, and a full sync reconciles now and then.
+"""
+import os
+import re
+import json
+import time
+import errno
+import struct
+import select
+import logging
+import threading
+import ctypes
+import ctypes.util
+import urllib.parse
+
+import boto3
+
+from s3shutil.s3shutil import Engine, generic_parse_path, _is_s3
+
+log = logging.getLogger('s3shutil.watch')
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+_EVENT = struct.Struct('iIII')
+
+
+class InotifyWatcher:
+    """recursive inotify watch of root, read() returns (relative path, is directory) pairs,
+    and (None, True) when the kernel queue overflowed and events were lost"""
+
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self, root):
+        self.root = root
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self.dirs = {}
+        self.add_tree('')
+
+    def add_tree(self, rel):
+        """watches rel, a directory relative to root ending with / (or the root itself), and all its subdirectories"""
+        path = os.path.join(self.root, rel)
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            if e in (errno.ENOENT, errno.ENOTDIR):
+                return
+            raise OSError(e, os.strerror(e), path)
+        # watching a directory again, after a rename, returns the same descriptor
+        self.dirs[wd] = rel
+        try:
+            entries = list(os.scandir(path))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                self.add_tree(rel + entry.name + '/')
+
+    def forget_tree(self, rel):
+        """a directory was moved away, its descriptors stay valid but must not map to the old names"""
+        for wd, d in list(self.dirs.items()):
+            if d.startswith(rel):
+                del self.dirs[wd]
+
+    def read(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 256 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            name = data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b'\0')
+            offset += _EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                events.append((None, True))
+                continue
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            parent = self.dirs.get(wd)
+            if parent is None or not name:
+                continue
+            rel = parent + os.fsdecode(name)
+            is_dir = bool(mask & IN_ISDIR)
+            if is_dir and mask & (IN_CREATE | IN_MOVED_TO):
+                # files written before the watch was added have no events, the whole directory is reported
+                self.add_tree(rel + '/')
+            elif is_dir and mask & IN_MOVED_FROM:
+                self.forget_tree(rel + '/')
+            events.append((rel, is_dir))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """the fallback where inotify is not available, compares the (mtime, size) of all files every interval seconds"""
+
+    def __init__(self, root, interval=2.0):
+        self.root = root
+        self.interval = interval
+        self.last = time.monotonic()
+        self.files = self.scan()
+
+    def scan(self):
+        files = {}
+        for directory, _, names in os.walk(self.root):
+            rel = os.path.relpath(directory, self.root).replace(os.sep, '/')
+            rel = '' if rel == '.' else rel + '/'
+            for name in names:
+                try:
+                    st = os.stat(os.path.join(directory, name))
+                except FileNotFoundError:
+                    continue
+                files[rel + name] = (st.st_mtime_ns, st.st_size)
+        return files
+
+    def read(self, timeout):
+        wait = self.last + self.interval - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(wait, 0))
+        self.last = time.monotonic()
+        files = self.scan()
+        changed = [rel for rel, stat in files.items() if self.files.get(rel) != stat]
+        changed += [rel for rel in self.files if rel not in files]
+        self.files = files
+        return [(rel, False) for rel in changed]
+
+    def close(self):
+        pass
+
+
+def make_watcher(root, poll_interval=2.0):
+    try:
+        return InotifyWatcher(root)
+    except (OSError, AttributeError) as e:
+        log.warning('inotify is not available (%s), polling every %ss', e, poll_interval)
+        return PollingWatcher(root, poll_interval)
+
+
+class Watch:
+    """Replicates changes under the local directory src to dst until stop is set.
+
+    Events are collected per path, a path is transferred once it had no event for debounce seconds
+    and its mtime is at least that old, so files being written are not uploaded half way.
+    A path that keeps changing is transferred anyway max_delay seconds after its first event.
+    All the paths that are ready are run as one batch through the engine.
+    A full sync that fails is run again retry_interval seconds later."""
+
+    def __init__(self, src, dst, debounce=1.0, max_delay=30.0, initial_sync=True, poll_interval=2.0,
+                 stop=None, retry_interval=60.0, **options):
+        self.src = generic_parse_path(src)
+        self.dst = generic_parse_path(dst)
+        if self.src.get_type() != 'fs':
+            raise ValueError(f'watch needs a local source, not {src}')
+        self.engine = Engine(**options)
+        self.engine.sides(self.src, self.dst)
+        self.ops = self.engine.generic_ops
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.initial_sync = initial_sync
+        self.poll_interval = poll_interval
+        self.stop = stop or threading.Event()
+        self.retry_interval = retry_interval
+        self.next_full_sync = None
+        self.pending = {}
+
+    def run(self):
+        watcher = make_watcher(self.src.get_path(), self.poll_interval)
+        try:
+            # watching starts first, so nothing written during the initial sync is missed
+            if self.initial_sync:
+                self.full_sync()
+            while not self.stop.is_set():
+                if self.next_full_sync is not None and time.monotonic() >= self.next_full_sync:
+                    self.full_sync()
+                self.collect(watcher.read(0.1 if self.pending else 0.5))
+                self.flush(self.ready())
+        finally:
+            watcher.close()
+            self.engine.finish()
+
+    def full_sync(self):
+        log.info('full sync %s to %s', self.src, self.dst)
+        self.pending.clear()
+        self.next_full_sync = None
+        try:
+            self.engine._generic_copy_tree(self.src, self.dst, sync=True)
+        except Exception:
+            log.exception('full sync failed, running another in %ss', self.retry_interval)
+            self.next_full_sync = time.monotonic() + self.retry_interval
+
+    def collect(self, events):
+        now = time.monotonic()
+        for rel, is_dir in events:
+            if rel is None:
+                log.warning('events were lost, syncing everything')
+                self.full_sync()
+                return
+            first, _, was_dir = self.pending.get(rel, (now, now, False))
+            self.pending[rel] = (first, now, was_dir or is_dir)
+
+    def ready(self):
+        now = time.monotonic()
+        ready = {}
+        for rel, (first, last, is_dir) in list(self.pending.items()):
+            if now - first < self.max_delay:
+                if now - last < self.debounce or self.recently_modified(rel):
+                    continue
+            ready[rel] = is_dir
+            del self.pending[rel]
+        return ready
+
+    def recently_modified(self, rel):
+        try:
+            mtime = os.stat(os.path.join(self.src.get_path(), rel)).st_mtime
+        except OSError:
+            return False
+        return time.time() - mtime < self.debounce
+
+    def flush(self, ready):
+        if not ready:
+            return
+        actions = {}
+        for rel, is_dir in sorted(ready.items()):
+            actions.update(self.actions_of(rel, is_dir))
+        actions = [(rel, action, size, None) for rel, (action, size) in sorted(actions.items())]
+        log.info('transferring %s changed paths', len(actions))
+        try:
+            self.engine.execute_actions(self.src, self.dst, actions)
+        except Exception:
+            log.exception('failed, the paths will be retried')
+            now = time.monotonic()
+            for rel, is_dir in ready.items():
+                self.pending.setdefault(rel, (now, now, is_dir))
+
+    def actions_of(self, rel, is_dir):
+        """the actions that bring the destination of rel up to date, from the current state of the source"""
+        key_filter = self.engine.key_filter
+        path = os.path.join(self.src.get_path(), rel)
+        if os.path.isdir(path):
+            for key, entry in self.ops.walk_sorted(path, rel + '/', key_filter=key_filter):
+                yield key, ('copy', entry.stat().st_size)
+        elif os.path.isfile(path):
+            if key_filter is None or key_filter.match(rel):
+                yield rel, ('copy', os.path.getsize(path))
+        elif is_dir:
+            for key, _, _ in self.ops.list_keys(self.dst.join(rel + '/')):
+                key = rel + '/' + key
+                if key_filter is None or key_filter.match(key):
+                    yield key, ('delete', None)
+        elif key_filter is None or key_filter.match(rel):
+            if self.dst.get_type() == 's3' or os.path.isfile(self.dst.join(rel).get_path()):
+                yield rel, ('delete', None)
+
+
+class SqsEvents:
+    """S3 event notifications delivered to an SQS queue, directly or through SNS"""
+
+    def __init__(self, queue_url, wait=10):
+        m = re.match(r'https://sqs\.([a-z0-9-]+)\.', queue_url)
+        self.sqs = boto3.Session().client('sqs', region_name=m.group(1) if m else None)
+        self.queue_url = queue_url
+        self.wait = wait
+
+    def receive(self, wait=None):
+        """a list of (message body, handle), waiting up to wait seconds for the first one"""
+        r = self.sqs.receive_message(QueueUrl=self.queue_url, MaxNumberOfMessages=10,
+                                     WaitTimeSeconds=int(self.wait if wait is None else wait))
+        return [(m['Body'], m['ReceiptHandle']) for m in r.get('Messages', [])]
+
+    def ack(self, handles):
+        for i in range(0, len(handles), 10):
+            entries = [{'Id': str(j), 'ReceiptHandle': h} for j, h in enumerate(handles[i:i + 10])]
+            self.sqs.delete_message_batch(QueueUrl=self.queue_url, Entries=entries)
+
+
+class FileEvents:
+    """the messages SQS would deliver, one json body per line of a file that is read as it grows.
+    For tests, and for notifications that arrive by other means"""
+
+    def __init__(self, path, wait=1):
+        self.path = path
+        self.wait = wait
+        self.offset = 0
+
+    def receive(self, wait=None):
+        messages = self.read()
+        if not messages:
+            time.sleep(self.wait if wait is None else wait)
+            messages = self.read()
+        return messages
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as f:
+            f.seek(self.offset)
+            lines = []
+            for line in iter(f.readline, ''):
+                if not line.endswith('\n'):
+                    break
+                lines.append(line)
+                self.offset = f.tell()
+        return [(line, None) for line in lines if line.strip()]
+
+    def ack(self, handles):
+        pass
+
+
+def parse_event_message(body):
+    """(bucket, key, created, sequencer) of every record of an S3 event notification message body"""
+    message = json.loads(body)
+    if 'Records' not in message and 'Message' in message:
+        # delivered through SNS
+        message = json.loads(message['Message'])
+    for record in message.get('Records', []):
+        if 's3' not in record:
+            continue
+        obj = record['s3']['object']
+        yield (record['s3']['bucket']['name'], urllib.parse.unquote_plus(obj['key']),
+               record['eventName'].startswith('ObjectCreated'), obj.get('sequencer', ''))
+
+
+def sequencer_key(sequencer):
+    """sequencers of one key are ordered as hex strings right padded with zeros"""
+    return sequencer.ljust(32, '0')
+
+
+class EventWatch:
+    """Mirrors the s3 prefix src to the local directory dst from its event notifications.
+
+    events is an SQS queue url, the path of a FileEvents file, or any object with receive() and ack().
+    Messages are applied in batches, only the latest event of every key counts. A full sync runs at start
+    (initial_sync), every reconcile_interval seconds, and retry_interval seconds after a batch or a full sync
+    failed, to fix what notifications miss: they can be lost, late or out of order across batches."""
+
+    def __init__(self, src, dst, events, initial_sync=True, reconcile_interval=3600, batch_size=1000,
+                 stop=None, retry_interval=60.0, **options):
+        self.src = generic_parse_path(src)
+        self.dst = generic_parse_path(dst)
+        if self.src.get_type() != 's3' or self.dst.get_type() != 'fs':
+            raise ValueError(f'watching events mirrors s3 to a local directory, not {src} to {dst}')
+        if isinstance(events, str):
+            events = SqsEvents(events) if events.startswith('https://') else FileEvents(events)
+        self.events = events
+        self.engine = Engine(**options)
+        self.engine.sides(self.src, self.dst)
+        self.initial_sync = initial_sync
+        self.reconcile_interval = reconcile_interval
+        self.batch_size = batch_size
+        self.retry_interval = retry_interval
+        self.stop = stop or threading.Event()
+        self.next_reconcile = time.monotonic() if initial_sync else time.monotonic() + reconcile_interval
+
+    def run(self):
+        try:
+            while not self.stop.is_set():
+                if time.monotonic() >= self.next_reconcile:
+                    self.reconcile()
+                messages = self.receive()
+                if messages:
+                    self.apply(messages)
+        finally:
+            self.engine.finish()
+
+    def reconcile(self):
+        log.info('full sync %s to %s', self.src, self.dst)
+        self.next_reconcile = time.monotonic() + self.reconcile_interval
+        try:
+            self.engine._generic_copy_tree(self.src, self.dst, sync=True)
+        except Exception:
+            log.exception('full sync failed, running another in %ss', self.retry_interval)
+            self.next_reconcile = time.monotonic() + self.retry_interval
+
+    def receive(self):
+        messages = self.events.receive()
+        while messages and len(messages) < self.batch_size:
+            more = self.events.receive(0)
+            if not more:
+                break
+            messages += more
+        return messages
+
+    def apply(self, messages):
+        latest = {}
+        bucket, prefix = self.src.get_path()
+        for body, _ in messages:
+            try:
+                records = list(parse_event_message(body))
+            except (ValueError, KeyError) as e:
+                log.warning('ignoring a message that is not an S3 event: %s', e)
+                continue
+            for b, key, created, sequencer in records:
+                if b != bucket or not key.startswith(prefix) or key == prefix:
+                    continue
+                previous = latest.get(key)
+                if previous is None or sequencer_key(sequencer) >= sequencer_key(previous[1]):
+                    latest[key] = (created, sequencer)
+
+        key_filter = self.engine.key_filter
+        actions = []
+        for key in sorted(latest):
+            rel = key[len(prefix):]
+            if key_filter is not None and not key_filter.match(rel):
+                continue
+            if latest[key][0]:
+                actions.append((rel, 'copy', None, None))
+            elif os.path.isfile(self.dst.join(rel).get_path()):
+                actions.append((rel, 'delete', None, None))
+
+        log.info('%s messages, applying %s changes', len(messages), len(actions))
+        try:
+            self.engine.execute_actions(self.src, self.dst, actions)
+        except Exception:
+            log.exception('failed, reconciling soon')
+            self.next_reconcile = min(self.next_reconcile, time.monotonic() + self.retry_interval)
+        self.events.ack([handle for _, handle in messages])
+
+
+def watch(src, dst, debounce=1.0, max_delay=30.0, initial_sync=True, poll_interval=2.0, stop=None,
+          events=None, reconcile_interval=3600, retry_interval=60.0, **options):
+    """Keeps dst in sync with src until stop (a threading.Event) is set.
+
+    From a local directory src, syncs to dst, then uploads and deletes the paths that change.
+    From an s3 prefix src to a local dst, applies the S3 event notifications read from events,
+    an SQS queue url or a json lines file, with a full sync at start and every reconcile_interval seconds.
+    A full sync that fails is run again retry_interval seconds later.
+    options are the tree operation options, include and exclude apply"""
+    if _is_s3(src):
+        if events is None:
+            raise ValueError('watching an s3 prefix needs its event notifications, pass events')
+        EventWatch(src, dst, events, initial_sync, reconcile_interval, stop=stop, retry_interval=retry_interval,
+                   **options).run()
+    else:
+        Watch(src, dst, debounce, max_delay, initial_sync, poll_interval, stop, retry_interval, **options).run()
@@ -0,0 +1,882 @@
+"""A small in-process S3 stand-in used by the unit tests and the benchmarks.
+
+It speaks enough of the S3 REST protocol (path style addressing) for boto3
+and s3transfer to work against it: buckets, ListObjectsV2, object versions,
+get/put/head/delete/copy, multipart uploads and additional checksums.
+
+Latency and faults can be injected to make throughput numbers reproducible
+and to exercise the throttling code paths:
+
+    with S3Emulator(latency=0.005, fault_rate=0.01) as emu:
+        os.environ.update(emu.environ())
+        s3shutil.tree_sync('/data', 's3://bucket/data/')
+"""
+import base64
+import bisect
+import collections
+import datetime
+import hashlib
+import http.server
+import logging
+import random
+import re
+import secrets
+import socketserver
+import threading
+import time
+import zlib
+from email.utils import formatdate
+from urllib.parse import urlsplit, parse_qs, unquote, quote
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+
+NS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+# every part of a multipart upload but the last
+MIN_PART_SIZE = 5 * 1024 * 1024
+log = logging.getLogger('s3emulator')
+
+
+def _crc32c(data, crc=0):
+    table = _crc32c_table()
+    crc ^= 0xffffffff
+    for b in data:
+        crc = table[(crc ^ b) & 0xff] ^ (crc >> 8)
+    return crc ^ 0xffffffff
+
+
+_crc32c_cache = []
+
+
+def _crc32c_table():
+    if not _crc32c_cache:
+        table = []
+        for i in range(256):
+            c = i
+            for _ in range(8):
+                c = (c >> 1) ^ 0x82f63b78 if c & 1 else c >> 1
+            table.append(c)
+        _crc32c_cache.append(table)
+    return _crc32c_cache[0]
+
+
+def _digest(algorithm, data):
+    if algorithm == 'crc32':
+        return zlib.crc32(data).to_bytes(4, 'big')
+    if algorithm == 'crc32c':
+        return _crc32c(data).to_bytes(4, 'big')
+    if algorithm == 'sha256':
+        return hashlib.sha256(data).digest()
+    if algorithm == 'sha1':
+        return hashlib.sha1(data).digest()
+    return None
+
+
+CHECKSUM_ALGORITHMS = ('crc32', 'crc32c', 'sha256', 'sha1', 'crc64nvme')
+
+
+class S3Error(Exception):
+
+    def __init__(self, status, code, message=''):
+        super().__init__(code)
+        self.status = status
+        self.code = code
+        self.message = message or code
+
+
+class Version:
+
+    def __init__(self, body=b'', version_id='null', delete_marker=False):
+        self.body = body
+        self.version_id = version_id
+        self.delete_marker = delete_marker
+        self.etag = '"%s"' % hashlib.md5(body).hexdigest()
+        self.last_modified = time.time()
+        self.content_type = 'binary/octet-stream'
+        self.metadata = {}
+        self.checksums = {}
+        self.checksum_type = 'FULL_OBJECT'
+        self.parts = []
+        self.encryption = None
+
+
+class Bucket:
+
+    def __init__(self, name):
+        self.name = name
+        self.created = time.time()
+        self.versioning = None
+        self.keys = {}
+        self.sorted_keys = []
+        self.uploads = {}
+
+    def current(self, key):
+        versions = self.keys.get(key)
+        if not versions or versions[-1].delete_marker:
+            return None
+        return versions[-1]
+
+    def add_version(self, key, version):
+        versions = self.keys.get(key)
+        if versions is None:
+            versions = self.keys[key] = []
+            bisect.insort(self.sorted_keys, key)
+        if self.versioning == 'Enabled':
+            version.version_id = secrets.token_hex(8)
+        else:
+            versions[:] = [v for v in versions if v.version_id != 'null']
+            version.version_id = 'null'
+        versions.append(version)
+
+    def remove_version(self, key, version_id):
+        versions = self.keys.get(key, [])
+        versions[:] = [v for v in versions if v.version_id != version_id]
+        if not versions:
+            self.drop_key(key)
+
+    def drop_key(self, key):
+        self.keys.pop(key, None)
+        i = bisect.bisect_left(self.sorted_keys, key)
+        if i < len(self.sorted_keys) and self.sorted_keys[i] == key:
+            del self.sorted_keys[i]
+
+
+class PrefixRateLimiter:
+    """Token bucket per key prefix, to imitate S3 per-partition request limits"""
+
+    def __init__(self, rate, depth=1):
+        self.rate = rate
+        self.depth = depth
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def prefix(self, key):
+        return '/'.join(key.split('/')[:self.depth])
+
+    def allow(self, bucket, key):
+        p = (bucket, self.prefix(key))
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.get(p, (self.rate, now))
+            tokens = min(self.rate, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self.buckets[p] = (tokens, now)
+                return False
+            self.buckets[p] = (tokens - 1, now)
+            return True
+
+
+class S3Emulator:
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0,
+                 fault_rate=0.0, prefix_rate_limit=None, prefix_depth=1,
+                 error_rules=None, bandwidth=None, region='us-east-1'):
+        """latency: seconds added to every request, plus up to jitter seconds
+        fault_rate: probability of answering 503 SlowDown to any request
+        prefix_rate_limit: requests per second allowed per key prefix
+        error_rules: list of (regex, status, code) matched against bucket/key
+        bandwidth: bytes per second for request and response bodies"""
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.fault_rate = fault_rate
+        self.prefix_limiter = PrefixRateLimiter(prefix_rate_limit, prefix_depth) if prefix_rate_limit else None
+        self.error_rules = [(re.compile(r), s, c) for r, s, c in (error_rules or [])]
+        self.bandwidth = bandwidth
+        self.region = region
+        self.buckets = {}
+        self.lock = threading.RLock()
+        self.requests = collections.Counter()
+        self.throttled = collections.Counter()
+        self.server = None
+        self.thread = None
+        self.random = random.Random(0)
+
+    @property
+    def endpoint_url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def environ(self):
+        return {
+            'AWS_ENDPOINT_URL': self.endpoint_url,
+            'AWS_ACCESS_KEY_ID': 'emulator',
+            'AWS_SECRET_ACCESS_KEY': 'emulator',
+            'AWS_DEFAULT_REGION': self.region,
+            'AWS_REGION': self.region,
+        }
+
+    def start(self):
+        emulator = self
+
+        class Handler(_Handler):
+            emu = emulator
+
+        self.server = _Server((self.host, self.port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, name='s3emulator', daemon=True)
+        self.thread.start()
+        log.info('S3 emulator listening on %s', self.endpoint_url)
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def create_bucket(self, name, versioning=None):
+        with self.lock:
+            b = self.buckets.setdefault(name, Bucket(name))
+            b.versioning = versioning or b.versioning
+            return b
+
+    def bucket(self, name):
+        b = self.buckets.get(name)
+        if b is None:
+            raise S3Error(404, 'NoSuchBucket')
+        return b
+
+    def inject(self, op, bucket, key):
+        if self.latency or self.jitter:
+            time.sleep(self.latency + self.random.random() * self.jitter)
+        target = f'{bucket}/{key}'
+        for regex, status, code in self.error_rules:
+            if regex.search(target):
+                raise S3Error(status, code)
+        if self.fault_rate and self.random.random() < self.fault_rate:
+            self.throttled[op] += 1
+            raise S3Error(503, 'SlowDown', 'Please reduce your request rate.')
+        if self.prefix_limiter and key and not self.prefix_limiter.allow(bucket, key):
+            self.throttled[self.prefix_limiter.prefix(key)] += 1
+            raise S3Error(503, 'SlowDown', 'Please reduce your request rate.')
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 256
+
+
+def _xml(tag, children):
+    """children is a list of (tag, value) where value is str, number, list or None"""
+    out = [f'<{tag}>' if tag != 'root' else '']
+    for k, v in children:
+        if v is None:
+            continue
+        if isinstance(v, list):
+            out.append(_xml(k, v))
+        elif isinstance(v, bool):
+            out.append(f'<{k}>{"true" if v else "false"}</{k}>')
+        else:
+            out.append(f'<{k}>{escape(str(v))}</{k}>')
+    out.append(f'</{tag}>' if tag != 'root' else '')
+    return ''.join(out)
+
+
+def _iso(ts):
+    return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+def _strip_ns(tree):
+    for el in tree.iter():
+        if '}' in el.tag:
+            el.tag = el.tag.split('}', 1)[1]
+    return tree
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    emu = None
+
+    def log_message(self, fmt, *args):
+        log.debug(fmt, *args)
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def do_HEAD(self):
+        self.dispatch('HEAD')
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if self.emu.bandwidth:
+            time.sleep(len(body) / self.emu.bandwidth)
+        if 'aws-chunked' in (self.headers.get('Content-Encoding') or ''):
+            body = self.decode_chunked(body)
+        return body
+
+    def decode_chunked(self, body):
+        out = []
+        self.trailers = {}
+        pos = 0
+        while True:
+            eol = body.index(b'\r\n', pos)
+            size = int(body[pos:eol].split(b';')[0], 16)
+            pos = eol + 2
+            if size == 0:
+                break
+            out.append(body[pos:pos + size])
+            pos += size + 2
+        for line in body[pos:].split(b'\r\n'):
+            if b':' in line:
+                k, v = line.decode().split(':', 1)
+                self.trailers[k.strip().lower()] = v.strip()
+        return b''.join(out)
+
+    def dispatch(self, method):
+        url = urlsplit(self.path)
+        self.query = {k: v[0] for k, v in parse_qs(url.query, keep_blank_values=True).items()}
+        parts = url.path.lstrip('/').split('/', 1)
+        bucket = unquote(parts[0])
+        key = unquote(parts[1]) if len(parts) > 1 else ''
+        self.trailers = {}
+        op = self.operation(method, bucket, key)
+        self.emu.requests[op] += 1
+        try:
+            body = self.read_body() if method in ('PUT', 'POST') else b''
+            self.emu.inject(op, bucket, key)
+            handler = getattr(self, f'op_{op}')
+            with self.emu.lock:
+                r = handler(bucket, key, body)
+            status, headers, payload = r
+        except S3Error as e:
+            status, headers = e.status, {}
+            payload = ('<?xml version="1.0" encoding="UTF-8"?>' +
+                       _xml('Error', [('Code', e.code), ('Message', e.message)])).encode()
+            headers['Content-Type'] = 'application/xml'
+        except Exception:
+            log.exception('emulator failure on %s %s', method, self.path)
+            status, headers, payload = 500, {}, b'<Error><Code>InternalError</Code></Error>'
+
+        if isinstance(payload, str):
+            payload = ('<?xml version="1.0" encoding="UTF-8"?>' + payload).encode()
+            headers.setdefault('Content-Type', 'application/xml')
+        self.send_response(status)
+        headers.setdefault('Content-Length', str(len(payload)))
+        headers['x-amz-request-id'] = secrets.token_hex(8)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        if method != 'HEAD':
+            if self.emu.bandwidth:
+                time.sleep(len(payload) / self.emu.bandwidth)
+            self.wfile.write(payload)
+
+    def operation(self, method, bucket, key):
+        q = self.query
+        if not bucket:
+            return 'ListBuckets'
+        if not key:
+            if method == 'GET':
+                if 'versioning' in q:
+                    return 'GetBucketVersioning'
+                if 'versions' in q:
+                    return 'ListObjectVersions'
+                if 'location' in q:
+                    return 'GetBucketLocation'
+                return 'ListObjectsV2'
+            if method == 'PUT':
+                return 'PutBucketVersioning' if 'versioning' in q else 'CreateBucket'
+            if method == 'POST' and 'delete' in q:
+                return 'DeleteObjects'
+            if method == 'HEAD':
+                return 'HeadBucket'
+            if method == 'DELETE':
+                return 'DeleteBucket'
+        if method == 'GET':
+            return 'GetObjectAttributes' if 'attributes' in q else 'GetObject'
+        if method == 'HEAD':
+            return 'HeadObject'
+        if method == 'PUT':
+            copy = 'x-amz-copy-source' in self.headers
+            if 'uploadId' in q:
+                return 'UploadPartCopy' if copy else 'UploadPart'
+            return 'CopyObject' if copy else 'PutObject'
+        if method == 'POST':
+            if 'uploads' in q:
+                return 'CreateMultipartUpload'
+            if 'uploadId' in q:
+                return 'CompleteMultipartUpload'
+        if method == 'DELETE':
+            return 'AbortMultipartUpload' if 'uploadId' in q else 'DeleteObject'
+        return 'Unsupported'
+
+    # buckets
+
+    def op_Unsupported(self, bucket, key, body):
+        raise S3Error(501, 'NotImplemented')
+
+    def op_ListBuckets(self, bucket, key, body):
+        buckets = [('Bucket', [('Name', b.name), ('CreationDate', _iso(b.created))])
+                   for b in sorted(self.emu.buckets.values(), key=lambda b: b.name)]
+        return 200, {}, _xml('ListAllMyBucketsResult', [('Buckets', buckets), ('Owner', [('ID', 'emulator')])])
+
+    def op_CreateBucket(self, bucket, key, body):
+        self.emu.create_bucket(bucket)
+        return 200, {'Location': f'/{bucket}'}, b''
+
+    def op_HeadBucket(self, bucket, key, body):
+        self.emu.bucket(bucket)
+        return 200, {}, b''
+
+    def op_DeleteBucket(self, bucket, key, body):
+        b = self.emu.bucket(bucket)
+        if b.keys:
+            raise S3Error(409, 'BucketNotEmpty')
+        del self.emu.buckets[bucket]
+        return 204, {}, b''
+
+    def op_GetBucketLocation(self, bucket, key, body):
+        self.emu.bucket(bucket)
+        return 200, {}, _xml('LocationConstraint', [])
+
+    def op_PutBucketVersioning(self, bucket, key, body):
+        b = self.emu.bucket(bucket)
+        tree = _strip_ns(ElementTree.fromstring(body))
+        b.versioning = tree.findtext('Status')
+        return 200, {}, b''
+
+    def op_GetBucketVersioning(self, bucket, key, body):
+        b = self.emu.bucket(bucket)
+        return 200, {}, _xml('VersioningConfiguration', [('Status', b.versioning)])
+
+    def op_ListObjectsV2(self, bucket, key, body):
+        b = self.emu.bucket(bucket)
+        q = self.query
+        prefix = q.get('prefix', '')
+        delimiter = q.get('delimiter', '')
+        max_keys = int(q.get('max-keys', 1000))
+        start = q.get('continuation-token') or q.get('start-after') or ''
+        if q.get('continuation-token'):
+            start = base64.urlsafe_b64decode(start.encode()).decode()
+
+        contents, prefixes, last, truncated = self.scan(b, prefix, delimiter, start, max_keys,
+                                                        lambda k: b.current(k) is not None)
+        entries = []
+        for k in contents:
+            v = b.current(k)
+            entry = [('Key', k), ('LastModified', _iso(v.last_modified)), ('ETag', v.etag),
+                     ('Size', len(v.body)), ('StorageClass', 'STANDARD')]
+            if v.checksums:
+                entry.append(('ChecksumAlgorithm', next(iter(v.checksums)).upper()))
+            entries.append(('Contents', entry))
+        children = [('Name', bucket), ('Prefix', prefix), ('KeyCount', len(contents) + len(prefixes)),
+                    ('MaxKeys', max_keys), ('IsTruncated', truncated)]
+        if delimiter:
+            children.append(('Delimiter', delimiter))
+        if q.get('start-after'):
+            children.append(('StartAfter', q['start-after']))
+        if truncated:
+            token = base64.urlsafe_b64encode(last.encode()).decode()
+            children.append(('NextContinuationToken', token))
+        children += entries
+        children += [('CommonPrefixes', [('Prefix', p)]) for p in prefixes]
+        return 200, {}, _xml('ListBucketResult', children)
+
+    def scan(self, b, prefix, delimiter, start, max_keys, visible):
+        """walks sorted keys after start, grouping by delimiter like S3 does"""
+        contents, prefixes = [], []
+        last = None
+        i = bisect.bisect_right(b.sorted_keys, start)
+        keys = b.sorted_keys
+        while i < len(keys):
+            k = keys[i]
+            if not k.startswith(prefix):
+                if k > prefix:
+                    break
+                i += 1
+                continue
+            if not visible(k):
+                i += 1
+                continue
+            if len(contents) + len(prefixes) >= max_keys:
+                return contents, prefixes, last, True
+            if delimiter:
+                pos = k.find(delimiter, len(prefix))
+                if pos >= 0:
+                    cp = k[:pos + len(delimiter)]
+                    prefixes.append(cp)
+                    last = cp + '\U0010ffff'
+                    i = bisect.bisect_right(keys, last)
+                    continue
+            contents.append(k)
+            last = k
+            i += 1
+        return contents, prefixes, last, False
+
+    def op_ListObjectVersions(self, bucket, key, body):
+        b = self.emu.bucket(bucket)
+        q = self.query
+        prefix = q.get('prefix', '')
+        max_keys = int(q.get('max-keys', 1000))
+        key_marker = q.get('key-marker', '')
+        vid_marker = q.get('version-id-marker', '')
+        delimiter = q.get('delimiter', '')
+
+        children = [('Name', bucket), ('Prefix', prefix), ('KeyMarker', key_marker), ('MaxKeys', max_keys)]
+        if delimiter:
+            children.append(('Delimiter', delimiter))
+        entries = []
+        prefixes = []
+        truncated = False
+        next_key = next_vid = None
+        i = bisect.bisect_left(b.sorted_keys, key_marker)
+        while i < len(b.sorted_keys) and not truncated:
+            k = b.sorted_keys[i]
+            i += 1
+            if not k.startswith(prefix):
+                if k > prefix:
+                    break
+                continue
+            if delimiter and delimiter in k[len(prefix):]:
+                common = k[:k.index(delimiter, len(prefix)) + len(delimiter)]
+                if common <= key_marker:
+                    continue
+                if len(entries) + len(prefixes) >= max_keys:
+                    truncated = True
+                    break
+                prefixes.append(common)
+                i = bisect.bisect_left(b.sorted_keys, common + '\U0010ffff')
+                next_key, next_vid = common, ''
+                continue
+            versions = list(reversed(b.keys[k]))
+            if k == key_marker:
+                ids = [v.version_id for v in versions]
+                if vid_marker in ids:
+                    versions = versions[ids.index(vid_marker) + 1:]
+                else:
+                    versions = []
+            for n, v in enumerate(versions):
+                if len(entries) + len(prefixes) >= max_keys:
+                    truncated = True
+                    break
+                tag = 'DeleteMarker' if v.delete_marker else 'Version'
+                entry = [('Key', k), ('VersionId', v.version_id), ('IsLatest', n == 0 and k != key_marker),
+                         ('LastModified', _iso(v.last_modified))]
+                if not v.delete_marker:
+                    entry += [('ETag', v.etag), ('Size', len(v.body)), ('StorageClass', 'STANDARD')]
+                entries.append((tag, entry))
+                next_key, next_vid = k, v.version_id
+        children.append(('IsTruncated', truncated))
+        if truncated:
+            children += [('NextKeyMarker', next_key), ('NextVersionIdMarker', next_vid)]
+        children += entries
+        children += [('CommonPrefixes', [('Prefix', p)]) for p in prefixes]
+        return 200, {}, _xml('ListVersionsResult', children)
+
+    def op_DeleteObjects(self, bucket, key, body):
+        b = self.emu.bucket(bucket)
+        tree = _strip_ns(ElementTree.fromstring(body))
+        quiet = tree.findtext('Quiet') == 'true'
+        deleted = []
+        for obj in tree.findall('Object'):
+            k = obj.findtext('Key')
+            vid = obj.findtext('VersionId')
+            marker = self.delete(b, k, vid)
+            entry = [('Key', k), ('VersionId', vid)]
+            if marker:
+                entry += [('DeleteMarker', True), ('DeleteMarkerVersionId', marker)]
+            if not quiet:
+                deleted.append(('Deleted', entry))
+        return 200, {}, _xml('DeleteResult', deleted)
+
+    def delete(self, b, k, vid):
+        if vid:
+            b.remove_version(k, vid)
+            return None
+        if b.versioning in ('Enabled', 'Suspended'):
+            if k in b.keys:
+                marker = Version(delete_marker=True)
+                b.add_version(k, marker)
+                return marker.version_id
+            return None
+        b.drop_key(k)
+        return None
+
+    # objects
+
+    def checksum_headers(self, v, enabled=True):
+        h = {}
+        if enabled:
+            for alg, value in v.checksums.items():
+                h[f'x-amz-checksum-{alg}'] = value
+            if v.checksums:
+                h['x-amz-checksum-type'] = v.checksum_type
+        return h
+
+    def object_headers(self, b, v):
+        h = {'ETag': v.etag, 'Last-Modified': formatdate(v.last_modified, usegmt=True),
+             'Content-Type': v.content_type, 'Accept-Ranges': 'bytes'}
+        if b.versioning:
+            h['x-amz-version-id'] = v.version_id
+        if v.parts:
+            h['x-amz-mp-parts-count'] = str(len(v.parts))
+        if v.encryption:
+            h['x-amz-server-side-encryption'] = v.encryption
+        for mk, mv in v.metadata.items():
+            h[f'x-amz-meta-{mk}'] = mv
+        h.update(self.checksum_headers(v, self.headers.get('x-amz-checksum-mode') == 'ENABLED'))
+        return h
+
+    def get_version(self, b, key):
+        vid = self.query.get('versionId')
+        if vid:
+            for v in b.keys.get(key, []):
+                if v.version_id == vid:
+                    return v
+            raise S3Error(404, 'NoSuchVersion')
+        v = b.current(key)
+        if v is None:
+            raise S3Error(404, 'NoSuchKey')
+        match = self.headers.get('If-Match')
+        if match and match != v.etag:
+            raise S3Error(412, 'PreconditionFailed')
+        return v
+
+    def op_GetObject(self, bucket, key, body):
+        b = self.emu.bucket(bucket)
+        v = self.get_version(b, key)
+        h = self.object_headers(b, v)
+        rng = self.headers.get('Range')
+        if rng:
+            m = re.match(r'bytes=(\d*)-(\d*)', rng)
+            size = len(v.body)
+            if m.group(1):
+                start = int(m.group(1))
+                end = int(m.group(2)) if m.group(2) else size - 1
+            else:
+                start = max(0, size - int(m.group(2)))
+                end = size - 1
+            end = min(end, size - 1)
+            if start >= size and size:
+                raise S3Error(416, 'InvalidRange')
+            for alg in CHECKSUM_ALGORITHMS:
+                h.pop(f'x-amz-checksum-{alg}', None)
+            h.pop('x-amz-checksum-type', None)
+            h['Content-Range'] = f'bytes {start}-{end}/{size}'
+            return 206, h, v.body[start:end + 1]
+        return 200, h, v.body
+
+    def op_HeadObject(self, bucket, key, body):
+        b = self.emu.bucket(bucket)
+        v = self.get_version(b, key)
+        h = self.object_headers(b, v)
+        h['Content-Length'] = str(len(v.body))
+        return 200, h, b''
+
+    def op_GetObjectAttributes(self, bucket, key, body):
+        b = self.emu.bucket(bucket)
+        v = self.get_version(b, key)
+        children = [('ETag', v.etag.strip('"')), ('ObjectSize', len(v.body))]
+        if v.checksums:
+            children.append(('Checksum', [(f'Checksum{alg.upper()}', value) for alg, value in v.checksums.items()]
+                             + [('ChecksumType', v.checksum_type)]))
+        if v.parts:
+            parts = []
+            for n, (size, cks) in enumerate(v.parts, 1):
+                parts.append(('Part', [('PartNumber', n), ('Size', size)] +
+                              [(f'Checksum{alg.upper()}', value) for alg, value in cks.items()]))
+            children.append(('ObjectParts', [('TotalPartsCount', len(v.parts)), ('PartsCount', len(v.parts))] + parts))
+        return 200, {}, _xml('GetObjectAttributesResponse', children)
+
+    def request_checksums(self, body):
+        sums = {}
+        for alg in CHECKSUM_ALGORITHMS:
+            value = self.headers.get(f'x-amz-checksum-{alg}') or self.trailers.get(f'x-amz-checksum-{alg}')
+            if value:
+                digest = _digest(alg, body)
+                if digest is not None and base64.b64encode(digest).decode() != value:
+                    raise S3Error(400, 'BadDigest', f'The {alg} you specified did not match the calculated checksum.')
+                sums[alg] = value
+        return sums
+
+    def metadata(self):
+        return {k[len('x-amz-meta-'):]: v for k, v in self.headers.items() if k.lower().startswith('x-amz-meta-')}
+
+    def op_PutObject(self, bucket, key, body):
+        b = self.emu.bucket(bucket)
+        v = Version(body)
+        v.checksums = self.request_checksums(body)
+        v.content_type = self.headers.get('Content-Type') or v.content_type
+        v.metadata = self.metadata()
+        v.encryption = self.headers.get('x-amz-server-side-encryption')
+        if v.encryption in ('aws:kms', 'aws:kms:dsse'):
+            # not the md5 of the body
+            v.etag = '"%s"' % secrets.token_hex(16)
+        b.add_version(key, v)
+        h = {'ETag': v.etag}
+        if v.encryption:
+            h['x-amz-server-side-encryption'] = v.encryption
+        h.update(self.checksum_headers(v))
+        if b.versioning:
+            h['x-amz-version-id'] = v.version_id
+        return 200, h, b''
+
+    def copy_source(self):
+        src = unquote(self.headers['x-amz-copy-source']).lstrip('/')
+        src, _, qs = src.partition('?')
+        src_bucket, src_key = src.split('/', 1)
+        b = self.emu.bucket(src_bucket)
+        vid = parse_qs(qs).get('versionId', [None])[0]
+        if vid:
+            for v in b.keys.get(src_key, []):
+                if v.version_id == vid:
+                    return v
+            raise S3Error(404, 'NoSuchVersion')
+        v = b.current(src_key)
+        if v is None:
+            raise S3Error(404, 'NoSuchKey')
+        return v
+
+    def op_CopyObject(self, bucket, key, body):
+        b = self.emu.bucket(bucket)
+        src = self.copy_source()
+        v = Version(src.body)
+        if self.headers.get('x-amz-metadata-directive') == 'REPLACE':
+            v.metadata = self.metadata()
+            v.content_type = self.headers.get('Content-Type') or v.content_type
+        else:
+            v.metadata = dict(src.metadata)
+            v.content_type = src.content_type
+        alg = (self.headers.get('x-amz-checksum-algorithm') or '').lower()
+        if alg:
+            digest = _digest(alg, v.body)
+            if digest is not None:
+                v.checksums = {alg: base64.b64encode(digest).decode()}
+        else:
+            v.checksums = dict(src.checksums)
+            v.checksum_type = src.checksum_type
+        b.add_version(key, v)
+        result = [('ETag', v.etag), ('LastModified', _iso(v.last_modified))]
+        result += [(f'Checksum{a.upper()}', value) for a, value in v.checksums.items()]
+        return 200, {}, _xml('CopyObjectResult', result)
+
+    # multipart
+
+    def op_CreateMultipartUpload(self, bucket, key, body):
+        b = self.emu.bucket(bucket)
+        upload_id = secrets.token_hex(16)
+        alg = (self.headers.get('x-amz-checksum-algorithm') or '').lower() or None
+        b.uploads[upload_id] = {'key': key, 'parts': {}, 'algorithm': alg, 'metadata': self.metadata(),
+                                'content_type': self.headers.get('Content-Type'),
+                                'checksum_type': self.headers.get('x-amz-checksum-type') or 'COMPOSITE'}
+        h = {}
+        if alg:
+            h['x-amz-checksum-algorithm'] = alg.upper()
+        return 200, h, _xml('InitiateMultipartUploadResult',
+                            [('Bucket', bucket), ('Key', key), ('UploadId', upload_id)])
+
+    def upload(self, b):
+        upload = b.uploads.get(self.query['uploadId'])
+        if upload is None:
+            raise S3Error(404, 'NoSuchUpload')
+        return upload
+
+    def op_UploadPart(self, bucket, key, body):
+        b = self.emu.bucket(bucket)
+        upload = self.upload(b)
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        checksums = self.request_checksums(body)
+        upload['parts'][int(self.query['partNumber'])] = (body, etag, checksums)
+        h = {'ETag': etag}
+        for alg, value in checksums.items():
+            h[f'x-amz-checksum-{alg}'] = value
+        return 200, h, b''
+
+    def op_UploadPartCopy(self, bucket, key, body):
+        b = self.emu.bucket(bucket)
+        upload = self.upload(b)
+        src = self.copy_source()
+        data = src.body
+        rng = self.headers.get('x-amz-copy-source-range')
+        if rng:
+            start, end = map(int, rng.split('=')[1].split('-'))
+            data = data[start:end + 1]
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        checksums = {}
+        if upload['algorithm']:
+            checksums[upload['algorithm']] = base64.b64encode(_digest(upload['algorithm'], data)).decode()
+        upload['parts'][int(self.query['partNumber'])] = (data, etag, checksums)
+        result = [('ETag', etag), ('LastModified', _iso(time.time()))]
+        result += [(f'Checksum{a.upper()}', value) for a, value in checksums.items()]
+        return 200, {}, _xml('CopyPartResult', result)
+
+    def op_CompleteMultipartUpload(self, bucket, key, body):
+        b = self.emu.bucket(bucket)
+        upload = self.upload(b)
+        tree = _strip_ns(ElementTree.fromstring(body))
+        numbers = [int(p.findtext('PartNumber')) for p in tree.findall('Part')]
+        if numbers != sorted(numbers):
+            raise S3Error(400, 'InvalidPartOrder')
+        try:
+            parts = [upload['parts'][n] for n in numbers]
+        except KeyError:
+            raise S3Error(400, 'InvalidPart')
+        if any(len(p[0]) < MIN_PART_SIZE for p in parts[:-1]):
+            raise S3Error(400, 'EntityTooSmall')
+        v = Version(b''.join(p[0] for p in parts))
+        md5s = b''.join(bytes.fromhex(p[1].strip('"')) for p in parts)
+        v.etag = '"%s-%s"' % (hashlib.md5(md5s).hexdigest(), len(parts))
+        v.parts = [(len(p[0]), p[2]) for p in parts]
+        v.metadata = upload['metadata']
+        v.content_type = upload['content_type'] or v.content_type
+        alg = upload['algorithm'] or next(iter(parts[0][2]), None) if parts else None
+        if alg and all(alg in p[2] for p in parts):
+            if upload['checksum_type'] == 'FULL_OBJECT' and alg in ('crc32', 'crc32c'):
+                v.checksums = {alg: base64.b64encode(_digest(alg, v.body)).decode()}
+                v.checksum_type = 'FULL_OBJECT'
+            else:
+                digests = b''.join(base64.b64decode(p[2][alg]) for p in parts)
+                combined = base64.b64encode(_digest(alg, digests)).decode()
+                v.checksums = {alg: f'{combined}-{len(parts)}'}
+                v.checksum_type = 'COMPOSITE'
+        del b.uploads[self.query['uploadId']]
+        b.add_version(key, v)
+        h = {}
+        if b.versioning:
+            h['x-amz-version-id'] = v.version_id
+        result = [('Location', f'/{bucket}/{quote(key)}'), ('Bucket', bucket), ('Key', key), ('ETag', v.etag)]
+        result += [(f'Checksum{a.upper()}', value) for a, value in v.checksums.items()]
+        return 200, h, _xml('CompleteMultipartUploadResult', result)
+
+    def op_AbortMultipartUpload(self, bucket, key, body):
+        b = self.emu.bucket(bucket)
+        b.uploads.pop(self.query['uploadId'], None)
+        return 204, {}, b''
+
+    def op_DeleteObject(self, bucket, key, body):
+        b = self.emu.bucket(bucket)
+        marker = self.delete(b, key, self.query.get('versionId'))
+        h = {}
+        if marker:
+            h.update({'x-amz-delete-marker': 'true', 'x-amz-version-id': marker})
+        return 204, h, b''
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    emu = S3Emulator(port=9000).start()
+    for k, v in emu.environ().items():
+        print(f'export {k}={v}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        emu.stop()
@@ -5,6 +5,20 @@ import logging
 import os
 import base64
 
+_emulator = None
+
+
+def use_emulator():
+    """When S3SHUTIL_TEST_EMULATOR is set, starts the in-process S3 emulator
+    and points boto3 to it. Returns the emulator or None"""
+    global _emulator
+    if not os.environ.get('S3SHUTIL_TEST_EMULATOR'):
+        return None
+    if _emulator is None:
+        from unittests.s3emulator import S3Emulator
+        _emulator = S3Emulator().start()
+        os.environ.update(_emulator.environ())
+    return _emulator
 
 class S3TestHelp:
 
@@ -65,7 +79,7 @@ class S3TestHelp:
             text = r['Body'].read()
             head_100 = text[:100]
             encoded = base64.b64encode(head_100)
-            rel = key.replace(prefix, '')
+            rel = key[len(prefix):]
             entry = {'Key': rel, 'Size': elem['Size'], 'Body': encoded}
             result.append(entry)
 
@@ -1,15 +1,28 @@
 import unittest
 import s3shutil
 from unittests import s3testhelp
+from s3shutil.inventory import Inventory
 import boto3
+import botocore.config
+import botocore.exceptions
 import tempfile
 import shutil
 import deepdiff
 import os
+import re
+import csv
+import gzip
+import json
+import urllib.parse
+import time
+import threading
 import random
 import secrets
 import logging
 import sys
+import collections
+import io
+import base64
 
 
 
@@ -21,7 +34,8 @@ logging.getLogger('tests').setLevel(logging.INFO)
 logging.basicConfig(stream=sys.stdout, format='%(levelname)s:[%(threadName)s]:%(name)s:%(message)s')
 
 
-caller = boto3.client('sts').get_caller_identity()
+if s3testhelp.use_emulator() is None:
+    caller = boto3.client('sts').get_caller_identity()
 
 class TestS3Shutil(unittest.TestCase):
 
@@ -171,6 +185,7 @@ class TestS3Shutil(unittest.TestCase):
         self.populate1()      
         s3shutil.copytree(self.fsroot1, self.s3root1)
         j1 = self.s3th.s3_root_to_json(self.s3root1)
+        self.assertObjEq(j1, self.s3th.fs_root_to_json(self.fsroot1))
         s3shutil.rmtree(self.s3root1)
         j2 = self.s3th.s3_root_to_json(self.s3root1)
         self.assertObjEq(j2, [])
@@ -196,6 +211,39 @@ class TestS3Shutil(unittest.TestCase):
         #recreate self.fsroot1 so that teardown does not complain
         os.mkdir(self.fsroot1)
 
+    def test_move_with_filter(self):
+        self.populate1()
+        keys = [x['Key'] for x in self.s3th.fs_root_to_json(self.fsroot1)]
+        s3shutil.move(self.fsroot1, self.s3root1, exclude='d3/')
+        moved = sorted(x['Key'] for x in self.s3th.s3_root_to_json(self.s3root1))
+        left = sorted(x['Key'] for x in self.s3th.fs_root_to_json(self.fsroot1))
+        self.assertEqual(moved, sorted(k for k in keys if not k.startswith('d3/')))
+        self.assertEqual(left, sorted(k for k in keys if k.startswith('d3/')))
+
+    def test_move_sharded(self):
+        for d in range(10):
+            for c in 'abcd':
+                os.makedirs(os.path.join(self.fsroot1, f'{c}{d}'), exist_ok=True)
+                self.write(os.path.join(self.fsroot1, f'{c}{d}', 'f'), b'f')
+        s3shutil.copytree(self.fsroot1, self.s3root1)
+        keys = {x['Key'] for x in self.s3th.fs_root_to_json(self.fsroot1)}
+
+        def check():
+            src = {x['Key'] for x in self.s3th.s3_root_to_json(self.s3root1)}
+            dst = {x['Key'] for x in self.s3th.s3_root_to_json(self.s3root2)}
+            self.assertEqual(src | dst, keys, 'keys were lost')
+            self.assertEqual(src & dst, set())
+            return dst
+
+        # the boundaries computed by the move itself
+        s3shutil.move(self.s3root1, self.s3root2, shard=(1, 4))
+        self.assertEqual(len(check()), 10)
+        boundaries = s3shutil.shard_boundaries(self.s3root1, 4)
+        for i in range(4):
+            s3shutil.move(self.s3root1, self.s3root2, shard=(i, 4), shard_boundaries=boundaries)
+            check()
+        self.assertEqual(check(), keys)
+
     def test_move_s3_to_fs(self):
         self.populate1()
 
@@ -450,6 +498,806 @@ class TestS3Shutil(unittest.TestCase):
         self.assertObjEq(j1, j2)
 
 
+    def test_sync_order_of_files_and_dirs(self):
+        # os.walk yields z.txt before a/x, s3 lists a/x first
+        self.write(f'{self.fsroot1}/z.txt')
+        os.mkdir(f'{self.fsroot1}/a')
+        self.write(f'{self.fsroot1}/a/x')
+        self.write(f'{self.fsroot1}/a.txt')
+        s3shutil.tree_sync(self.fsroot1, self.s3root1)
+
+        p = s3shutil.plan(self.fsroot1, self.s3root1)
+        self.assertEqual(p.counts['copy'], 0)
+        self.assertEqual(p.counts['delete'], 0)
+
+        j1 = self.s3th.s3_root_to_json(self.s3root1)
+        j2 = self.s3th.fs_root_to_json(self.fsroot1)
+        self.assertObjEq(j1, j2)
+
+    def test_tracing(self):
+        from unittest import mock
+        from s3shutil.tracing import Tracer, NullTracer, default_tracer
+        tracer = Tracer(keep_slowest=2)
+        with tracer.span('outer', path='x'):
+            time.sleep(0.05)
+            with tracer.span('inner') as span:
+                span.set(size=3)
+                time.sleep(0.1)
+            # spans of other threads are not nested in this one
+            other = threading.Thread(target=lambda: tracer.span('other').__enter__().__exit__(None, None, None))
+            other.start()
+            other.join()
+        stages = {s['stage']: s for s in tracer.breakdown()['stages']}
+        outer, inner = stages['outer'], stages['inner']
+        self.assertGreaterEqual(outer['total'], 0.15)
+        self.assertAlmostEqual(outer['self'], outer['total'] - inner['total'])
+        self.assertLess(outer['self'], 0.1)
+        self.assertEqual(inner['self'], inner['total'])
+        self.assertEqual((inner['count'], inner['slowest'][0]['size']), (1, 3))
+        self.assertEqual(outer['slowest'][0]['path'], 'x')
+        self.assertEqual(stages['other']['count'], 1)
+
+        # every next() is a span, the spans of the iterator it pulls from are not its self time
+        def pages():
+            for i in range(3):
+                with tracer.span('page'):
+                    time.sleep(0.02)
+                yield i
+        self.assertEqual(list(tracer.timed_iterator('diff', pages())), [0, 1, 2])
+        stages = {s['stage']: s for s in tracer.breakdown()['stages']}
+        self.assertEqual((stages['diff']['count'], stages['page']['count']), (4, 3))
+        self.assertGreaterEqual(stages['diff']['total'], 0.06)
+        self.assertLess(stages['diff']['self'], 0.02)
+
+        # the profile of an operation written as json
+        profile = os.path.join(self.fsroot2, 'profile.json')
+        self.populate1()
+        s3shutil.copytree(self.fsroot1, self.s3root1, tracer=Tracer(profile=profile))
+        with open(profile) as f:
+            breakdown = json.load(f)
+        stages = {s['stage']: s for s in breakdown['stages']}
+        self.assertEqual(stages['transfer']['count'], 12)
+        self.assertIn('list.walk', stages)
+        self.assertGreater(breakdown['wall'], 0)
+
+        # one profile for the copy and the delete of a move
+        with mock.patch.dict(os.environ, {'S3SHUTIL_PROFILE': profile}):
+            s3shutil.move(self.s3root1, self.s3root2)
+        with open(profile) as f:
+            stages = {s['stage']: s for s in json.load(f)['stages']}
+        self.assertEqual(stages['transfer']['count'], 12)
+        self.assertIn('delete', stages)
+
+        with mock.patch.dict(os.environ, {'S3SHUTIL_PROFILE': profile}):
+            self.assertEqual(default_tracer().profile, profile)
+        with mock.patch.dict(os.environ, {'S3SHUTIL_PROFILE': '1'}):
+            self.assertIs(default_tracer().profile, True)
+        with mock.patch.dict(os.environ, {'S3SHUTIL_PROFILE': ''}):
+            self.assertIsInstance(default_tracer(), NullTracer)
+
+        null = NullTracer()
+        self.assertFalse(null.enabled)
+        with null.span('x', a=1) as span:
+            span.set(b=2)
+        null.record('x', 1.0)
+        it = iter([1, 2])
+        self.assertIs(null.timed_iterator('x', it), it)
+        null.finish()
+
+    def test_spread_by_prefix(self):
+        from s3shutil.s3shutil import spread_by_prefix, key_prefix, Engine
+        keys = ['a/1', 'a/2', 'a/3', 'b/1', 'b/2', 'c/1']
+        self.assertEqual(list(spread_by_prefix(keys, key_prefix)), ['a/1', 'b/1', 'c/1', 'a/2', 'b/2', 'a/3'])
+        # only the window is reordered
+        self.assertEqual(list(spread_by_prefix(keys, key_prefix, window=2)), ['a/1', 'a/2', 'a/3', 'b/1', 'b/2', 'c/1'])
+        # a deferred prefix waits while there are others
+        deferred = lambda p: p == 'a'
+        self.assertEqual(list(spread_by_prefix(keys, key_prefix, deferred=deferred)),
+                         ['b/1', 'c/1', 'b/2', 'a/1', 'a/2', 'a/3'])
+        self.assertEqual((key_prefix('a/b/c', 2), key_prefix('a/b/c'), key_prefix('x')), ('a/b', 'a', ''))
+
+        engine = Engine()
+        engine.prefix_throttled('a')
+        self.assertTrue(engine.prefix_cooling('a'))
+        self.assertFalse(engine.prefix_cooling('b'))
+        self.assertFalse(engine.prefix_cooling('a', cooldown=0))
+
+    @unittest.skipUnless(s3testhelp.use_emulator(), 'prefix rate limits need the S3 emulator')
+    def test_throttled_prefixes(self):
+        from s3shutil.s3shutil import Engine, generic_parse_path
+        from unittests.s3emulator import PrefixRateLimiter
+        for d, count in ('hot', 60), ('cold1', 3), ('cold2', 3):
+            os.mkdir(os.path.join(self.fsroot1, d))
+            for i in range(count):
+                self.write(os.path.join(self.fsroot1, d, str(i)), b'x')
+        emulator = s3testhelp.use_emulator()
+        # the prefixes of the emulator are of full keys, one level below the test root
+        depth = self.s3root1[5:].split('/', 1)[1].count('/') + 1
+        emulator.prefix_limiter = PrefixRateLimiter(20, depth)
+        engine = Engine(concurrency=8)
+        try:
+            engine.generic_copy_tree(generic_parse_path(self.fsroot1), generic_parse_path(self.s3root1))
+        finally:
+            emulator.prefix_limiter = None
+        self.assertEqual(set(engine.throttled_prefixes), {'hot'})
+        self.assertObjEq(self.s3th.s3_root_to_json(self.s3root1), self.s3th.fs_root_to_json(self.fsroot1))
+
+    def test_plan_and_execute(self):
+        self.populate1()
+        s3shutil.copytree(self.fsroot1, self.s3root1)
+        os.unlink(os.path.join(self.fsroot1, 'd2', 'y'))
+        self.write(os.path.join(self.fsroot1, 'd1', 'new'), 'new file')
+
+        plan_path = os.path.join(self.fsroot2, 'plan.jsonl.gz')
+        p = s3shutil.plan(self.fsroot1, self.s3root1, plan_path)
+        self.assertEqual(p.counts['copy'], 1)
+        self.assertEqual(p.counts['delete'], 1)
+        self.assertEqual(p.bytes['copy'], len('new file'))
+
+        # nothing was transferred yet
+        j0 = self.s3th.s3_root_to_json(self.s3root1)
+        self.assertNotIn('d1/new', [x['Key'] for x in j0])
+
+        s3shutil.execute(plan_path)
+        os.unlink(plan_path)
+        j1 = self.s3th.s3_root_to_json(self.s3root1)
+        j2 = self.s3th.fs_root_to_json(self.fsroot1)
+        self.assertObjEq(j1, j2)
+
+    def test_sharded_sync(self):
+        self.populate1()
+        for i in range(3):
+            s3shutil.tree_sync(self.fsroot1, self.s3root1, shard=(i, 3))
+        for i in range(4):
+            s3shutil.tree_sync(self.s3root1, self.s3root2, shard=(i, 4), shard_mode='hash')
+
+        j0 = self.s3th.fs_root_to_json(self.fsroot1)
+        j1 = self.s3th.s3_root_to_json(self.s3root1)
+        j2 = self.s3th.s3_root_to_json(self.s3root2)
+        self.assertObjEq(j0, j1)
+        self.assertObjEq(j1, j2)
+
+        # deleting a range shard whose boundaries would move as the tree is deleted
+        with self.assertRaises(ValueError):
+            s3shutil.rmtree(self.s3root1, shard=(0, 4))
+        boundaries = s3shutil.shard_boundaries(self.s3root1, 4)
+        for i in range(4):
+            s3shutil.rmtree(self.s3root1, shard=(i, 4), shard_boundaries=boundaries)
+            s3shutil.rmtree(self.s3root2, shard=(i, 4), shard_mode='hash')
+        self.assertEqual(self.s3th.s3_root_to_json(self.s3root1), [])
+        self.assertEqual(self.s3th.s3_root_to_json(self.s3root2), [])
+
+    def test_disk_usage(self):
+        self.populate1()
+        s3shutil.copytree(self.fsroot1, self.s3root1)
+
+        j = self.s3th.fs_root_to_json(self.fsroot1)
+        total = sum(x['Size'] for x in j)
+        d3 = sum(x['Size'] for x in j if x['Key'].startswith('d3/'))
+
+        for root in self.fsroot1, self.s3root1:
+            du = s3shutil.disk_usage(root)
+            self.assertEqual(du.objects, len(j))
+            self.assertEqual(du.bytes, total)
+            self.assertEqual(du.prefixes['d3'], [6, d3])
+            self.assertEqual(du.prefixes[''][0], 3)
+            self.assertEqual(sum(du.histogram.values()), len(j))
+
+    def test_include_exclude(self):
+        self.populate1()
+        s3shutil.copytree(self.fsroot1, self.s3root1)
+        keys = [x['Key'] for x in self.s3th.fs_root_to_json(self.fsroot1)]
+        expected = [k for k in keys if k in ('a.txt', 'd2/x', 'd2/y') or k.startswith('d3/d4/')]
+        options = {'include': ['d3/*', re.compile(r'd2/[xy]'), 'a.txt'], 'exclude': 'd3/d5/'}
+        for root in self.fsroot1, self.s3root1:
+            self.assertEqual(s3shutil.disk_usage(root, **options).objects, len(expected))
+            # every branch of an alternation is listed
+            self.assertEqual(s3shutil.disk_usage(root, include=re.compile('d2/x|a.txt')).objects, 2)
+
+        # the excluded files of the destination are not deleted
+        self.write(os.path.join(self.fsroot2, 'skip.tmp'))
+        s3shutil.tree_sync(self.s3root1, self.fsroot2, exclude=['*.tmp', 'd3/'])
+        keys = sorted(x['Key'] for x in self.s3th.fs_root_to_json(self.fsroot2))
+        self.assertEqual(keys, ['a.txt', 'b.txt', 'c.txt', 'd2/x', 'd2/y', 'd2/z', 'skip.tmp'])
+
+    def test_watch(self):
+        self.populate1()
+        stop = threading.Event()
+        t = threading.Thread(target=s3shutil.watch, args=(self.fsroot1, self.s3root1),
+                             kwargs={'debounce': 0.2, 'poll_interval': 0.2, 'stop': stop})
+        t.start()
+        try:
+            self.wait_until_synced()
+            self.write(os.path.join(self.fsroot1, 'new.txt'))
+            os.makedirs(os.path.join(self.fsroot1, 'd6', 'd7'))
+            self.write(os.path.join(self.fsroot1, 'd6', 'd7', 'x'))
+            os.unlink(os.path.join(self.fsroot1, 'a.txt'))
+            shutil.rmtree(os.path.join(self.fsroot1, 'd3'))
+            self.wait_until_synced()
+        finally:
+            stop.set()
+            t.join()
+
+    @unittest.skipUnless(s3testhelp.use_emulator(), 'fault injection needs the S3 emulator')
+    def test_watch_sync_failure(self):
+        self.populate1()
+        emulator = s3testhelp.use_emulator()
+        emulator.error_rules = [(re.compile('/d2/'), 403, 'AccessDenied')]
+        stop = threading.Event()
+        t = threading.Thread(target=s3shutil.watch, args=(self.fsroot1, self.s3root1),
+                             kwargs={'debounce': 0.2, 'poll_interval': 0.2, 'stop': stop, 'retry_interval': 0.5})
+        t.start()
+        try:
+            deadline = time.time() + 30
+            while len(self.s3th.s3_root_to_json(self.s3root1)) < 9 and time.time() < deadline:
+                time.sleep(0.1)
+            time.sleep(1)
+            # the failed full sync is run again
+            emulator.error_rules = []
+            self.wait_until_synced()
+            self.assertTrue(t.is_alive())
+        finally:
+            emulator.error_rules = []
+            stop.set()
+            t.join()
+
+    def test_watch_events(self):
+        self.populate1()
+        s3shutil.copytree(self.fsroot1, self.s3root1)
+        bucket, prefix = self.s3root1[5:].split('/', 1)
+        events = os.path.join(self.fsroot2, '.events')
+        stop = threading.Event()
+        dst = os.path.join(self.fsroot2, 'mirror')
+        t = threading.Thread(target=s3shutil.watch, args=(self.s3root1, dst),
+                             kwargs={'events': events, 'stop': stop})
+        t.start()
+
+        def notify(key, event, sequencer):
+            record = {'eventName': event, 's3': {'bucket': {'name': bucket},
+                                                 'object': {'key': urllib.parse.quote_plus(prefix + key),
+                                                            'sequencer': sequencer}}}
+            with open(events, 'a') as f:
+                f.write(json.dumps({'Records': [record]}) + '\n')
+
+        try:
+            deadline = time.time() + 30
+            while not os.path.exists(os.path.join(dst, 'd3', 'd5', 'z')) and time.time() < deadline:
+                time.sleep(0.1)
+            s3 = boto3.client('s3')
+            s3.put_object(Bucket=bucket, Key=prefix + 'new file.txt', Body=b'new')
+            notify('new file.txt', 'ObjectCreated:Put', '0055AED6DCD90281E5')
+            s3.delete_object(Bucket=bucket, Key=prefix + 'a.txt')
+            # out of order, the delete is the latest
+            notify('a.txt', 'ObjectRemoved:Delete', '0055AED6DCD90281E7')
+            notify('a.txt', 'ObjectCreated:Put', '0055AED6DCD90281E6')
+            while os.path.exists(os.path.join(dst, 'a.txt')) and time.time() < deadline:
+                time.sleep(0.1)
+        finally:
+            stop.set()
+            t.join()
+        self.assertObjEq(self.s3th.s3_root_to_json(self.s3root1), self.s3th.fs_root_to_json(dst))
+
+    @unittest.skipUnless(s3testhelp.use_emulator(), 'fault injection needs the S3 emulator')
+    def test_watch_events_reconcile_failure(self):
+        self.populate1()
+        s3shutil.copytree(self.fsroot1, self.s3root1)
+        emulator = s3testhelp.use_emulator()
+        emulator.error_rules = [(re.compile('/d2/'), 403, 'AccessDenied')]
+        stop = threading.Event()
+        dst = os.path.join(self.fsroot2, 'mirror')
+        t = threading.Thread(target=s3shutil.watch, args=(self.s3root1, dst),
+                             kwargs={'events': os.path.join(self.fsroot2, '.events'), 'stop': stop,
+                                     'retry_interval': 0.5})
+        t.start()
+        try:
+            deadline = time.time() + 30
+            while not os.path.exists(os.path.join(dst, 'd3', 'd5', 'z')) and time.time() < deadline:
+                time.sleep(0.1)
+            time.sleep(1)
+            # the failed full sync is run again
+            emulator.error_rules = []
+            while not os.path.exists(os.path.join(dst, 'd2', 'z')) and time.time() < deadline:
+                time.sleep(0.1)
+            self.assertTrue(t.is_alive())
+        finally:
+            emulator.error_rules = []
+            stop.set()
+            t.join()
+        self.assertObjEq(self.s3th.s3_root_to_json(self.s3root1), self.s3th.fs_root_to_json(dst))
+
+    def test_relative_keys(self):
+        from s3shutil.s3shutil import s3_path, fs_path
+        root = s3_path(('bucket', 'data/'))
+        self.assertEqual(s3_path(('bucket', 'data/x/data/y')).relative(root), 'x/data/y')
+        root = fs_path(self.fsroot1)
+        self.assertEqual(root.join('d/x').relative(root), 'd/x')
+
+        # a key that repeats the root prefix
+        bucket, prefix = self.s3root1[5:].split('/', 1)
+        boto3.client('s3').put_object(Bucket=bucket, Key=f'{prefix}x/{prefix}y', Body=b'y')
+        s3shutil.copytree(self.s3root1, self.fsroot2)
+        self.assertObjEq(self.s3th.s3_root_to_json(self.s3root1), self.s3th.fs_root_to_json(self.fsroot2))
+
+    def test_small_objects(self):
+        self.populate1()
+        self.write(os.path.join(self.fsroot1, 'empty'), b'')
+        self.write(os.path.join(self.fsroot1, 'big'), secrets.token_bytes(200_000))
+        # big goes through the transfer manager, the others through put_object and get_object
+        s3shutil.copytree(self.fsroot1, self.s3root1, small_object=100_000, checksum='SHA256')
+        s3shutil.copytree(self.s3root1, self.fsroot2, small_object=100_000, checksum='SHA256')
+        self.assertObjEq(self.s3th.fs_root_to_json(self.fsroot1), self.s3th.s3_root_to_json(self.s3root1))
+        # no temporary file is left next to the downloads
+        self.assertObjEq(self.s3th.fs_root_to_json(self.fsroot1), self.s3th.fs_root_to_json(self.fsroot2))
+
+        # a file replaced by a download
+        self.write(os.path.join(self.fsroot2, 'a.txt'), b'old')
+        s3shutil.copyfile(f'{self.s3root1}a.txt', os.path.join(self.fsroot2, 'a.txt'))
+        self.assertObjEq(self.s3th.fs_root_to_json(self.fsroot1), self.s3th.fs_root_to_json(self.fsroot2))
+
+    def test_shared_transfer_manager(self):
+        from s3shutil.s3shutil import Engine, generic_parse_path
+        self.populate1()
+        self.write(os.path.join(self.fsroot1, 'big'), secrets.token_bytes(9 * 1024 * 1024))
+        # every file through one manager
+        e = Engine(small_object=0, concurrency=4)
+        e.generic_copy_tree(generic_parse_path(self.fsroot1), generic_parse_path(self.s3root1))
+        self.assertEqual(e.generic_ops.transfer_managers, {})
+        e.generic_copy_tree(generic_parse_path(self.s3root1), generic_parse_path(self.fsroot2))
+        self.assertEqual(e.generic_ops.transfer_managers, {})
+        self.assertObjEq(self.s3th.fs_root_to_json(self.fsroot1), self.s3th.fs_root_to_json(self.fsroot2))
+
+    def test_relay_between_endpoints(self):
+        self.populate1()
+        self.write(os.path.join(self.fsroot1, 'big'), secrets.token_bytes(20 * 1024 * 1024))
+        s3shutil.copytree(self.fsroot1, self.s3root1)
+        # the same service, but another endpoint as far as s3shutil knows
+        endpoint = {'region_name': boto3.Session().region_name or 'us-east-1'}
+        s3shutil.copytree(self.s3root1, self.s3root2, dst_endpoint=endpoint, checksum='CRC32')
+        self.assertObjEq(self.s3th.s3_root_to_json(self.s3root1), self.s3th.s3_root_to_json(self.s3root2))
+        bucket, prefix = self.s3root2[5:].split('/', 1)
+        head = boto3.client('s3').head_object(Bucket=bucket, Key=f'{prefix}big')
+        # a multipart upload of 8 MB parts, not a copy_object
+        self.assertTrue(head['ETag'].endswith('-3"'))
+
+        report = s3shutil.verify(self.s3root1, self.s3root2, src_endpoint=endpoint)
+        self.assertEqual((report.verified, report.mismatched), (13, []))
+
+    @unittest.skipUnless(s3testhelp.use_emulator(), 'needs a second S3 emulator')
+    def test_move_between_endpoints(self):
+        from unittests.s3emulator import S3Emulator
+        self.populate1()
+        s3shutil.copytree(self.fsroot1, self.s3root1)
+        with S3Emulator() as other:
+            other.create_bucket('other')
+            endpoint = {'endpoint_url': other.endpoint_url}
+            src_endpoint = {'endpoint_url': s3testhelp.use_emulator().endpoint_url}
+            s3shutil.move(self.s3root1, 's3://other/moved/', src_endpoint=src_endpoint, dst_endpoint=endpoint,
+                          verify='full')
+            moved = list(other.bucket('other').sorted_keys)
+        keys = sorted('moved/' + x['Key'] for x in self.s3th.fs_root_to_json(self.fsroot1))
+        self.assertEqual(moved, keys)
+        # the source is deleted where it is
+        self.assertObjEq(self.s3th.s3_root_to_json(self.s3root1), [])
+
+    def test_copyfileobj_and_stdio(self):
+        import io
+        from unittest import mock
+
+        class Pipe:
+            """a stream of unknown length that can not seek"""
+            def __init__(self, data):
+                self.f = io.BytesIO(data)
+
+            def read(self, size=-1):
+                return self.f.read(min(size, 1000_000) if size > 0 else size)
+
+        data = secrets.token_bytes(12 * 1024 * 1024 + 5)
+        s3shutil.copyfileobj(Pipe(data), f'{self.s3root1}piped', part_size=5 * 1024 * 1024, checksum='CRC32')
+        out = io.BytesIO(b'header')
+        out.seek(0, io.SEEK_END)
+        s3shutil.copyfileobj(f'{self.s3root1}piped', out, part_size=5 * 1024 * 1024)
+        self.assertEqual(out.getvalue(), b'header' + data)
+        bucket, prefix = self.s3root1[5:].split('/', 1)
+        self.assertTrue(boto3.client('s3').head_object(Bucket=bucket, Key=f'{prefix}piped')['ETag'].endswith('-3"'))
+
+        stdin = io.TextIOWrapper(io.BytesIO(b'from stdin'))
+        with mock.patch('sys.stdin', stdin):
+            s3shutil.copyfile('-', f'{self.s3root1}stdin')
+        stdout = io.TextIOWrapper(io.BytesIO())
+        with mock.patch('sys.stdout', stdout):
+            s3shutil.copyfile(f'{self.s3root1}stdin', '-')
+        self.assertEqual(stdout.buffer.getvalue(), b'from stdin')
+
+    def test_failure_manifest(self):
+        self.populate1()
+        plan = s3shutil.plan(self.fsroot1, self.s3root1, path=os.path.join(self.fsroot2, 'plan.jsonl'))
+        # vanish between the plan and its execution
+        moved = {}
+        for rel in 'a.txt', 'd3/d4/y':
+            path = os.path.join(self.fsroot1, rel)
+            moved[path] = path + '.moved'
+            os.rename(path, moved[path])
+        manifest = os.path.join(self.fsroot2, 'failed.jsonl.gz')
+        with self.assertRaises(s3shutil.TransferError) as cm:
+            s3shutil.execute(plan, failure_manifest=manifest)
+        report = cm.exception.report
+        self.assertEqual((report.count, report.succeeded, report.systematic), (2, 10, None))
+        self.assertEqual(dict(report.errors), {'FileNotFoundError': 2})
+        failed = s3shutil.TransferPlan.load(manifest)
+        self.assertEqual(sorted(key for key, action, size, _ in failed.actions()), ['a.txt', 'd3/d4/y'])
+        self.assertEqual(failed.counts['copy'], 2)
+
+        for path, moved_to in moved.items():
+            os.rename(moved_to, path)
+        s3shutil.execute(manifest)
+        self.assertObjEq(self.s3th.fs_root_to_json(self.fsroot1), self.s3th.s3_root_to_json(self.s3root1))
+
+    def test_fail_fast(self):
+        self.populate1()
+        s3shutil.copytree(self.fsroot1, self.s3root1)
+        # every download fails the same way, under a file
+        self.write(os.path.join(self.fsroot2, 'file'), b'')
+        with self.assertRaises(s3shutil.TransferError) as cm:
+            s3shutil.copytree(self.s3root1, os.path.join(self.fsroot2, 'file', 'dir'), concurrency=1, fail_fast=3)
+        report = cm.exception.report
+        self.assertEqual((report.systematic, report.succeeded), ('NotADirectoryError', 0))
+        # the next one may have been submitted before the third failure was counted, not all 13
+        self.assertIn(report.count, (3, 4))
+        # no manifest unless one is asked for
+        self.assertIsNone(cm.exception.manifest)
+
+    def test_incremental_sync(self):
+        self.populate1()
+        state = os.path.join(self.fsroot2, 'state.json')
+        # the files must be older than the high water mark, ctimes can not be set back
+        time.sleep(2.5)
+        s3shutil.tree_sync(self.fsroot1, self.s3root1, incremental=state)
+        self.assertObjEq(self.s3th.fs_root_to_json(self.fsroot1), self.s3th.s3_root_to_json(self.s3root1))
+
+        bucket, prefix = self.s3root1[5:].split('/', 1)
+        s3 = boto3.client('s3')
+        # unchanged directories are not listed, this one is not restored
+        s3.delete_object(Bucket=bucket, Key=f'{prefix}d3/d4/x')
+        self.write(os.path.join(self.fsroot1, 'd3', 'd4', 'y'))
+        os.unlink(os.path.join(self.fsroot1, 'd2', 'x'))
+        shutil.rmtree(os.path.join(self.fsroot1, 'd3', 'd5'))
+        os.makedirs(os.path.join(self.fsroot2, 'moved', 'sub'))
+        self.write(os.path.join(self.fsroot2, 'moved', 'sub', 'old'))
+        os.rename(os.path.join(self.fsroot2, 'moved'), os.path.join(self.fsroot1, 'd1', 'moved'))
+        s3shutil.tree_sync(self.fsroot1, self.s3root1, incremental=state)
+
+        expected = [o for o in self.s3th.fs_root_to_json(self.fsroot1) if o['Key'] != 'd3/d4/x']
+        self.assertObjEq(expected, self.s3th.s3_root_to_json(self.s3root1))
+        # a full sync brings it back
+        s3shutil.tree_sync(self.fsroot1, self.s3root1)
+        self.assertObjEq(self.s3th.fs_root_to_json(self.fsroot1), self.s3th.s3_root_to_json(self.s3root1))
+
+    def test_fan_out(self):
+        from unittest import mock
+        self.populate1()
+        self.write(os.path.join(self.fsroot1, 'big'), secrets.token_bytes(12 * 1024 * 1024))
+        s3shutil.copytree(self.fsroot1, self.s3root2)
+        bucket, prefix = self.s3root2[5:].split('/', 1)
+        s3 = boto3.client('s3')
+        s3.delete_object(Bucket=bucket, Key=f'{prefix}d2/x')
+        s3.put_object(Bucket=bucket, Key=f'{prefix}stale', Body=b'stale')
+        s3root3 = self.s3th.get_tests_root()
+        self.addCleanup(s3shutil.rmtree, s3root3)
+        dsts = [self.s3root1, self.s3root2, s3root3]
+
+        with mock.patch('s3shutil.s3shutil.open', side_effect=open, create=True) as opened:
+            s3shutil.tree_sync(self.fsroot1, dsts, part_size=5 * 1024 * 1024, checksum='SHA256')
+        # every file read once, whatever the number of destinations missing it
+        read = [c.args[0] for c in opened.call_args_list if c.args[0].startswith(self.fsroot1)]
+        self.assertEqual(len(read), 13)
+        self.assertEqual(len(set(read)), 13)
+
+        expected = self.s3th.fs_root_to_json(self.fsroot1)
+        for dst in dsts:
+            self.assertObjEq(expected, self.s3th.s3_root_to_json(dst))
+            report = s3shutil.verify(self.fsroot1, dst)
+            self.assertEqual((report.verified, report.mismatched), (13, []))
+        bucket, prefix = s3root3[5:].split('/', 1)
+        self.assertTrue(s3.head_object(Bucket=bucket, Key=f'{prefix}big')['ETag'].endswith('-3"'))
+
+    def test_dedup(self):
+        from unittest import mock
+        from s3shutil.s3shutil import GenericOps
+        same, other, big = secrets.token_bytes(20_000), secrets.token_bytes(20_000), secrets.token_bytes(9_000_000)
+        for d in 'd1', 'd2', 'd3':
+            os.mkdir(os.path.join(self.fsroot1, d))
+        self.write(os.path.join(self.fsroot1, 'a.txt'), same)
+        self.write(os.path.join(self.fsroot1, 'd1', 'copy'), same)
+        os.link(os.path.join(self.fsroot1, 'a.txt'), os.path.join(self.fsroot1, 'd2', 'link'))
+        self.write(os.path.join(self.fsroot1, 'd2', 'other'), other)
+        self.write(os.path.join(self.fsroot1, 'd3', 'small'), b'small')
+        self.write(os.path.join(self.fsroot1, 'd3', 'small2'), b'small')
+        self.write(os.path.join(self.fsroot1, 'big'), big)
+        self.write(os.path.join(self.fsroot1, 'd3', 'big2'), big)
+
+        with mock.patch.object(GenericOps, '_generic_copy', autospec=True,
+                               side_effect=GenericOps._generic_copy) as copies:
+            s3shutil.copytree(self.fsroot1, self.s3root1, dedup=10_000, checksum='SHA256')
+        sources = collections.Counter(c.args[1].get_type() for c in copies.call_args_list)
+        # one upload of same, other and big, the small files are not deduplicated
+        self.assertEqual(sources, {'fs': 5, 's3': 3})
+        self.assertObjEq(self.s3th.fs_root_to_json(self.fsroot1), self.s3th.s3_root_to_json(self.s3root1))
+        report = s3shutil.verify(self.fsroot1, self.s3root1)
+        self.assertEqual((report.verified, report.mismatched), (8, []))
+
+    def test_transfer_report(self):
+        self.populate1()
+        size = sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(self.fsroot1) for f in files)
+        report = s3shutil.copytree(self.fsroot1, self.s3root1)
+        self.assertEqual((report.counts['copied'], report.bytes['copied']), (12, size))
+        self.assertEqual(report.requests['PutObject'], 12)
+        self.assertLessEqual(report.percentile(50), report.percentile(99))
+        self.assertEqual(set(report.phases), {'list', 'transfer'})
+
+        os.unlink(os.path.join(self.fsroot1, 'a.txt'))
+        self.write(os.path.join(self.fsroot1, 'new'), b'new')
+        report = s3shutil.tree_sync(self.fsroot1, self.s3root1)
+        self.assertEqual(dict(report.counts), {'copied': 1, 'skipped': 11, 'deleted': 1, 'failed': 0})
+        self.assertEqual(report.bytes['copied'], 3)
+        self.assertEqual((report.requests['PutObject'], report.requests['DeleteObjects']), (1, 1))
+        self.assertEqual(report.requests['ListObjectsV2'], 1)
+        self.assertEqual(json.loads(json.dumps(report.to_dict()))['counts']['skipped'], 11)
+
+        report = s3shutil.copyfile(f'{self.s3root1}new', os.path.join(self.fsroot2, 'new'))
+        self.assertEqual((report.counts['copied'], report.bytes['copied']), (1, 3))
+        self.assertEqual(report.requests['GetObject'], 1)
+
+    def test_transfer_order(self):
+        from unittest import mock
+        from s3shutil.s3shutil import GenericOps, order_within_window
+        names = ['a', 'b', 'c', 'd/e', 'd/f']
+        sizes = dict(zip(names, [300, 100, 500, 200, 400]))
+        mtimes = dict(zip(names, [1_000_000, 5_000_000, 3_000_000, 2_000_000, 4_000_000]))
+        os.mkdir(os.path.join(self.fsroot1, 'd'))
+        for name in names:
+            path = os.path.join(self.fsroot1, name)
+            self.write(path, secrets.token_bytes(sizes[name]))
+            os.utime(path, (mtimes[name], mtimes[name]))
+
+        def copied(**options):
+            s3shutil.rmtree(self.s3root1)
+            with mock.patch.object(GenericOps, '_generic_copy', autospec=True,
+                                   side_effect=GenericOps._generic_copy) as copies:
+                s3shutil.copytree(self.fsroot1, self.s3root1, concurrency=1, **options)
+            return [c.args[1].get_path()[len(self.fsroot1) + 1:] for c in copies.call_args_list]
+
+        self.assertEqual(copied(order='key'), names)
+        self.assertEqual(copied(order='largest'), sorted(names, key=lambda n: -sizes[n]))
+        self.assertEqual(copied(order='smallest'), sorted(names, key=lambda n: sizes[n]))
+        self.assertEqual(copied(order='newest'), sorted(names, key=lambda n: -mtimes[n]))
+        self.assertEqual(copied(order='locality'), ['a', 'b', 'c', 'd/e', 'd/f'])
+        self.assertEqual(copied(order=lambda x: x[0] != 'c'), ['c', 'a', 'b', 'd/e', 'd/f'])
+        with self.assertRaises(ValueError):
+            s3shutil.copytree(self.fsroot1, self.s3root1, order='random')
+        # an item overtakes at most window - 1 others
+        self.assertEqual(list(order_within_window([1, 2, 3, 9, 4, 5], lambda x: -x, 2)), [2, 3, 9, 4, 5, 1])
+
+    def test_pack_and_unpack(self):
+        self.populate1()
+        self.write(os.path.join(self.fsroot1, 'big'), secrets.token_bytes(100_000))
+        self.write(os.path.join(self.fsroot1, 'empty'), b'')
+        files, shards = s3shutil.pack(self.fsroot1, self.s3root1, shard_size=20_000, small=50_000)
+        self.assertEqual(files, 14)
+        self.assertGreater(shards, 2)
+
+        tree = s3shutil.PackedTree(self.s3root1)
+        with open(os.path.join(self.fsroot1, 'd3', 'd5', 'y'), 'rb') as f:
+            self.assertEqual(tree.read('d3/d5/y'), f.read())
+        self.assertEqual(tree.read('empty'), b'')
+        self.assertEqual(len(tree.read('big')), 100_000)
+
+        s3shutil.unpack(self.s3root1, self.fsroot2)
+        self.assertObjEq(self.s3th.fs_root_to_json(self.fsroot1), self.s3th.fs_root_to_json(self.fsroot2))
+
+        # the engine is finished when a shard is missing
+        from unittest import mock
+        bucket, prefix = self.s3root1[5:].split('/', 1)
+        boto3.client('s3').delete_object(Bucket=bucket, Key=prefix + tree.shards()[0])
+        with mock.patch.object(tree.engine, 'finish', wraps=tree.engine.finish) as finish:
+            with self.assertRaises(botocore.exceptions.ClientError):
+                tree.extract(os.path.join(self.fsroot2, 'again'))
+        finish.assert_called_once()
+
+    def test_checksums_and_verify(self):
+        self.populate1()
+        self.write(os.path.join(self.fsroot1, 'big'), secrets.token_bytes(9 * 1024 * 1024))
+        s3shutil.copytree(self.fsroot1, self.s3root1, checksum='SHA256', verify='full')
+        s3shutil.copytree(self.s3root1, self.s3root2, checksum='SHA256', verify='full')
+        s3shutil.copytree(self.s3root1, self.fsroot2, checksum='SHA256', verify=0.5)
+
+        report = s3shutil.verify(self.fsroot1, self.s3root1)
+        self.assertEqual((report.verified, report.mismatched, report.unverifiable), (13, [], []))
+
+        # same size, other content
+        self.write(os.path.join(self.fsroot1, 'd2', 'x'), b'0' * os.path.getsize(os.path.join(self.fsroot1, 'd2', 'x')))
+        self.assertEqual(s3shutil.verify(self.fsroot1, self.s3root1).mismatched, ['d2/x'])
+        self.assertEqual(s3shutil.verify(self.fsroot1, self.fsroot2).mismatched, ['d2/x'])
+        # big is multipart in one and copied in one part in the other, their checksums can not be compared
+        report = s3shutil.verify(self.s3root1, self.s3root2)
+        self.assertEqual((report.verified, report.mismatched, report.unverifiable), (12, [], ['big']))
+
+    @unittest.skipUnless(s3testhelp.use_emulator(), 'corrupting a stored checksum needs the S3 emulator')
+    def test_checksums_of_encrypted_and_large_objects(self):
+        self.populate1()
+        s3shutil.copytree(self.fsroot1, self.s3root1)
+        bucket, prefix = self.s3root1[5:].split('/', 1)
+        # the ETag of SSE-KMS objects is not their md5, and this one has no additional checksum
+        s3 = boto3.client('s3', config=botocore.config.Config(request_checksum_calculation='when_required'))
+        s3.put_object(Bucket=bucket, Key=prefix + 'd2/x', ServerSideEncryption='aws:kms',
+                      Body=open(os.path.join(self.fsroot1, 'd2', 'x'), 'rb').read())
+        report = s3shutil.verify(self.fsroot1, self.s3root1)
+        self.assertEqual((report.verified, report.mismatched, report.unverifiable), (11, [], ['d2/x']))
+
+        # downloads through the transfer manager are checked too
+        self.write(os.path.join(self.fsroot1, 'big'), secrets.token_bytes(9 * 1024 * 1024))
+        s3shutil.copytree(self.fsroot1, self.s3root2, checksum='SHA256')
+        big = s3testhelp.use_emulator().bucket(bucket).current(self.s3root2[5:].split('/', 1)[1] + 'big')
+        big.checksums['sha256'] = base64.b64encode(b'0' * 32).decode()
+        with self.assertRaises(s3shutil.TransferError):
+            s3shutil.copytree(self.s3root2, self.fsroot2, checksum='SHA256')
+        self.assertFalse(os.path.exists(os.path.join(self.fsroot2, 'big')))
+
+    def write_inventory(self, root, directory):
+        """a local CSV S3 Inventory report of the objects under the s3 root, in reverse key order"""
+        bucket, prefix = root[5:].split('/', 1)
+        os.makedirs(os.path.join(directory, 'data'))
+        os.makedirs(os.path.join(directory, '2026-10-19T01-00Z'))
+        s3 = boto3.client('s3')
+        objects = [o for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix)
+                   for o in page.get('Contents', [])]
+        with gzip.open(os.path.join(directory, 'data', 'part-0.csv.gz'), 'wt', newline='') as f:
+            w = csv.writer(f, quoting=csv.QUOTE_ALL)
+            for o in reversed(objects):
+                w.writerow([bucket, urllib.parse.quote_plus(o['Key']), o['Size']])
+        manifest = os.path.join(directory, '2026-10-19T01-00Z', 'manifest.json')
+        with open(manifest, 'w') as f:
+            json.dump({'sourceBucket': bucket, 'destinationBucket': 'arn:aws:s3:::inventories',
+                       'fileFormat': 'CSV', 'fileSchema': 'Bucket, Key, Size', 'creationTimestamp': '1792371600000',
+                       'files': [{'key': 'inv/data/part-0.csv.gz', 'size': 0}]}, f)
+        return manifest
+
+    def test_sync_from_inventory(self):
+        self.populate1()
+        self.write(os.path.join(self.fsroot1, 'd3', 'with space+plus'))
+        s3shutil.copytree(self.fsroot1, self.s3root1)
+        manifest = self.write_inventory(self.s3root1, os.path.join(self.fsroot2, 'inv'))
+        dst = os.path.join(self.fsroot2, 'dst')
+        s3shutil.tree_sync(self.s3root1, dst, src_inventory=manifest)
+        self.assertObjEq(self.s3th.s3_root_to_json(self.s3root1), self.s3th.fs_root_to_json(dst))
+
+        # sorted through runs spilled to disk
+        keys = [k for k, _ in Inventory(manifest, run_size=4).objects()]
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(len(keys), len(self.s3th.fs_root_to_json(dst)))
+        self.assertObjEq(self.s3th.s3_root_to_json(self.s3root1), self.s3th.fs_root_to_json(dst))
+
+        # objects deleted after the report are skipped, the ones written since are seen when checking
+        bucket, prefix = self.s3root1[5:].split('/', 1)
+        s3 = boto3.client('s3')
+        s3.delete_object(Bucket=bucket, Key=prefix + 'a.txt')
+        s3.put_object(Bucket=bucket, Key=prefix + 'b.txt', Body=b'changed')
+        s3.put_object(Bucket=bucket, Key=prefix + 'new', Body=b'new')
+        shutil.rmtree(dst)
+        report = s3shutil.tree_sync(self.s3root1, dst, src_inventory=manifest)
+        self.assertEqual(report.counts['skipped'], 1)
+        self.assertNotIn('new', [x['Key'] for x in self.s3th.fs_root_to_json(dst)])
+        s3shutil.tree_sync(self.s3root1, dst, src_inventory=manifest, check_inventory=True)
+        self.assertObjEq(self.s3th.s3_root_to_json(self.s3root1), self.s3th.fs_root_to_json(dst))
+
+        # a destination object deleted since its report is taken as present, unless checking
+        s3shutil.copytree(self.s3root1, self.s3root2)
+        manifest = self.write_inventory(self.s3root2, os.path.join(self.fsroot2, 'inv2'))
+        bucket, prefix = self.s3root2[5:].split('/', 1)
+        s3.delete_object(Bucket=bucket, Key=prefix + 'c.txt')
+        s3shutil.tree_sync(self.s3root1, self.s3root2, dst_inventory=manifest)
+        self.assertNotIn('c.txt', [x['Key'] for x in self.s3th.s3_root_to_json(self.s3root2)])
+        s3shutil.tree_sync(self.s3root1, self.s3root2, dst_inventory=manifest, check_inventory=True)
+        self.assertObjEq(self.s3th.s3_root_to_json(self.s3root1), self.s3th.s3_root_to_json(self.s3root2))
+
+        # a move would delete the objects the report does not have without copying them
+        with self.assertRaises(ValueError):
+            s3shutil.move(self.s3root2, self.s3root1, src_inventory=manifest)
+        self.assertObjEq(self.s3th.s3_root_to_json(self.s3root1), self.s3th.s3_root_to_json(self.s3root2))
+
+    def wait_until_synced(self, timeout=30):
+        j2 = self.s3th.fs_root_to_json(self.fsroot1)
+        deadline = time.time() + timeout
+        while True:
+            try:
+                j1 = self.s3th.s3_root_to_json(self.s3root1)
+            except botocore.exceptions.ClientError:
+                # deleted between the listing and the get
+                j1 = None
+            if j1 is not None and not deepdiff.DeepDiff(j1, j2) or time.time() > deadline:
+                break
+            time.sleep(0.2)
+        self.assertObjEq(j1, j2)
+
+    @unittest.skipUnless(s3testhelp.use_emulator(), 'needs a versioned bucket of the S3 emulator')
+    def test_rmtree_versions(self):
+        bucket = 's3shutil-versioned-' + secrets.token_hex(4)
+        s3testhelp.use_emulator().create_bucket(bucket, versioning='Enabled')
+        s3 = boto3.client('s3')
+        for i in range(1500):
+            for body in b'1', b'22':
+                s3.put_object(Bucket=bucket, Key=f'data/d{i % 7}/f{i}', Body=body)
+        s3.put_object(Bucket=bucket, Key='keep/f', Body=b'1')
+        s3shutil.rmtree(f's3://{bucket}/data/')
+
+        report = s3shutil.rmtree(f's3://{bucket}/data/', versions=True)
+        self.assertEqual((report.versions, report.delete_markers, report.bytes), (3000, 1500, 4500))
+        r = s3.list_object_versions(Bucket=bucket)
+        self.assertEqual([v['Key'] for v in r.get('Versions', [])], ['keep/f'])
+        self.assertNotIn('DeleteMarkers', r)
+
+    @unittest.skipUnless(s3testhelp.use_emulator(), 'fault injection needs the S3 emulator')
+    def test_copytree_with_throttling(self):
+        self.populate1()
+        emulator = s3testhelp.use_emulator()
+        emulator.fault_rate = 0.2
+        try:
+            s3shutil.copytree(self.fsroot1, self.s3root1)
+        finally:
+            emulator.fault_rate = 0.0
+        j1 = self.s3th.s3_root_to_json(self.s3root1)
+        j2 = self.s3th.fs_root_to_json(self.fsroot1)
+        self.assertObjEq(j1, j2)
+
+    @unittest.skipUnless(s3testhelp.use_emulator(), 'fault injection needs the S3 emulator')
+    def test_retries_at_fixed_concurrency(self):
+        # every worker retrying at once must not wait for a slot held by a task queued behind it
+        self.populate1()
+        emulator = s3testhelp.use_emulator()
+        emulator.fault_rate = 0.3
+        errors = []
+
+        def run():
+            try:
+                s3shutil.copytree(self.fsroot1, self.s3root1, concurrency=1)
+            except Exception as e:
+                errors.append(e)
+        t = threading.Thread(target=run, daemon=True)
+        try:
+            t.start()
+            t.join(120)
+        finally:
+            emulator.fault_rate = 0.0
+        self.assertFalse(t.is_alive(), 'copytree is stuck')
+        self.assertEqual(errors, [])
+        self.assertObjEq(self.s3th.s3_root_to_json(self.s3root1), self.s3th.fs_root_to_json(self.fsroot1))
+
+        budget = s3shutil.s3shutil.RetryBudget(tokens=1, refill=0, per_second=20)
+        self.assertTrue(budget.spend())
+        self.assertFalse(budget.spend())
+        time.sleep(0.2)
+        self.assertTrue(budget.spend())
+
+    @unittest.skipUnless(s3testhelp.use_emulator(), 'fault injection needs the S3 emulator')
+    def test_single_copies_with_throttling(self):
+        # single copies are retried by the engine, the parts of the transfer manager by botocore
+        src = f'{self.fsroot1}/a'
+        self.write(src, b'a' * 1000)
+        big = secrets.token_bytes(20 * 1024 * 1024)
+        emulator = s3testhelp.use_emulator()
+        emulator.fault_rate = 0.5
+        try:
+            for i in range(20):
+                s3shutil.copyfile(src, f'{self.s3root1}a{i}')
+            emulator.fault_rate = 0.1
+            s3shutil.copyfileobj(io.BytesIO(big), f'{self.s3root1}big')
+        finally:
+            emulator.fault_rate = 0.0
+        self.assertEqual(len(self.s3th.s3_root_to_json(self.s3root1)), 21)
+        out = io.BytesIO()
+        s3shutil.copyfileobj(f'{self.s3root1}big', out)
+        self.assertEqual(out.getvalue(), big)
+
+
 
 if __name__ == '__main__':
     unittest.main()